@@ -6,6 +6,7 @@ import traceback
 try:
     from ACIConnection import *
     from ACIServer import *
+    from sharding import ShardedServer
     from errors import *
     from database import *
     Client = Connection
@@ -22,17 +23,22 @@ def create(aci_class, port=8765, ip="127.0.0.1", name="main"):
     """
     Call from host to start ACI
 
+    The instance runs on its own event loop in a daemon thread, which synchronous calls are handed off to. The loop
+    is running when this returns, so synchronous calls can be made straight away and wait for the connection.
+
     :param aci_class:
     :param port:
     :param ip:
     :param name:
     :return:
     """
-    loop = asyncio.get_event_loop()
+    loop = asyncio.new_event_loop()
     result = aci_class(loop, ip, port, name)
 
     if asyncio.iscoroutinefunction(result.start):
-        return asyncio.run(async_create(aci_class, port=8765, ip=ip, name="main"))
+        running = threading.Event()
+        threading.Thread(target=_run_loop, args=(loop, result.start, running), daemon=True).start()
+        running.wait()
     else:
         threading.Thread(target=result.start, daemon=True).start()
 
@@ -49,15 +55,15 @@ async def async_create(aci_class, port=8765, ip="127.0.0.1", name="main"):
     :param name:
     :return:
     """
-    loop = asyncio.get_event_loop()
-    result = aci_class(loop, ip, port, name)
+    return create(aci_class, port=port, ip=ip, name=name)
 
-    def wrapper():
-        asyncio.run(result.start())
 
-    threading.Thread(target=wrapper, daemon=True).start()
-
-    return result
+def _run_loop(loop, start, running):
+    asyncio.set_event_loop(loop)
+    task = loop.create_task(start())
+    # Called after the first step of start, which sets up what synchronous calls wait on
+    loop.call_soon(running.set)
+    loop.run_until_complete(task)
 
 
 def stop():
@@ -1,13 +1,23 @@
 import asyncio
+import collections
 import websockets
 import json
-import time
-from queue import SimpleQueue
+import random
+import itertools
+import traceback
 
 try:
     from utils import allow_sync
+    from codec import CODECS, available_codecs, decode_frame
+    from readcache import ReadCache
+    from errors import ACIException, ACIConnectionError, ACIConflictError
+    from streaming import chunk_kind, split_chunks, DEFAULT_CHUNK_SIZE, DEFAULT_WINDOW
 except Exception:
     from ACIpy.utils import allow_sync
+    from ACIpy.codec import CODECS, available_codecs, decode_frame
+    from ACIpy.readcache import ReadCache
+    from ACIpy.errors import ACIException, ACIConnectionError, ACIConflictError
+    from ACIpy.streaming import chunk_kind, split_chunks, DEFAULT_CHUNK_SIZE, DEFAULT_WINDOW
 
 
 ACIVersion = "2020.07.14.1"
@@ -15,74 +25,80 @@ ACIVersion = "2020.07.14.1"
 connections = {}
 
 
-async def _recv_handler(websocket, _, responses):
+# Field of each Server response packet holding the returned value
+_response_fields = {"getResp": "val"}
+
+# Commands without side effects, sent again if the connection drops before they are answered
+_replayable_commands = {"get_value", "get_index", "get_list_length", "get_recent", "get_range", "aggregate",
+                        "list_databases", "subscribe", "unsubscribe", "flush_stats", "stats", "a_auth",
+                        "snapshot_status"}
+
+
+async def _recv_handler(websocket, _, connection):
     """
     Handles a Server response
 
+    A message which can not be handled is reported and skipped, so it does not take the connection down.
     :param websocket:
     :param _:
-    :param responses:
+    :param connection:
     :return:
     """
     raw = await websocket.recv()
-    cmd = json.loads(raw)
-
-    if cmd["cmd"] == "getResp":
-        value = json.dumps({"cmd_typ": "get_val", "key":cmd["key"], "db_key": cmd["db_key"], "val": cmd["val"]})
-        responses.put(value)
-
-    if cmd["cmd"] == "setResp":
-        value = json.dumps({"cmd_typ": "set_val", "val": cmd["msg"]})
-        responses.put(value)
-
-    if cmd["cmd"] == "ldResp":
-        value = json.dumps({"cmd_typ": "ld", "val": cmd["msg"]})
-        responses.put(value)
-
-    if cmd["cmd"] == "a_auth_response":
-        value = json.dumps({"cmd_typ": "auth_msg", "val": cmd["msg"]})
-        responses.put(value)
+    try:
+        cmd = decode_frame(connection.codec, raw)
+        _handle_message(connection, cmd)
+    except Exception:
+        traceback.print_exc()
+        print("WARNING - ACI connection %s could not handle a message from the Server" % connection.name)
 
-    if cmd["cmd"] == "get_indexResp":
-        value = json.dumps({"cmd_typ": "get_indexResp", "val": cmd["msg"]})
-        responses.put(value)
 
-    if cmd["cmd"] == "set_indexResp":
-        value = json.dumps({"cmd_typ": "set_indexResp", "val": cmd["msg"]})
-        responses.put(value)
+def _run_callback(function, cmd):
+    # A failing user callback must not keep the other callbacks or the responses behind it from running
+    try:
+        function(cmd)
+    except Exception:
+        traceback.print_exc()
+        print("WARNING - ACI callback for %s failed" % cmd.get("event_id"))
 
-    if cmd["cmd"] == "app_indexResp":
-        value = json.dumps({"cmd_typ": "app_indexResp", "val": cmd["msg"]})
-        responses.put(value)
-
-    if cmd["cmd"] == "get_len_indexResp":
-        value = json.dumps({"cmd_typ": "get_len_indexResp", "val": cmd["msg"]})
-        responses.put(value)
-
-    if cmd["cmd"] == "get_recent_indexResp":
-        value = json.dumps({"cmd_typ":"get_recent_indexResp", "val": cmd["msg"]})
-        responses.put(value)
 
+def _handle_message(connection, cmd):
     if cmd["cmd"] == "event":
         for index in connections:
             for callback_index in connections[index].event_callbacks:
                 if callback_index.event_id == cmd["event_id"]:
-                    callback_index.function(cmd)
-        
+                    _run_callback(callback_index.function, cmd)
+
+        if cmd["event_id"] == "key_changed":
+            if cmd["db_key"] in connection.interfaces:
+                connection.interfaces[cmd["db_key"]].invalidate(cmd["key"], cmd["data"].get("seq"))
+            for callback in list(connection.subscriptions.get((cmd["db_key"], cmd["key"]), ())):
+                _run_callback(callback, cmd)
+        return
+
+    if cmd.get("req_id") in connection._streams:
+        connection.feed_stream(cmd["req_id"], cmd)
+    elif cmd.get("req_id") is not None:
+        connection.resolve_response(cmd["req_id"], cmd)
 
 
 class ContextualDatabaseInterface:
+    """
+        Transaction over a Database, writes are held locally and committed together when the context exits
+
+        The commit fails with an ACIConflictError, writing nothing, if a key read in the context changed meanwhile.
+    """
     def __init__(self, interface):
         self._interface = interface
         self.conn = interface.conn
         self.db_key = interface.db_key
 
         self.record = {}
+        # Version of each key read from the Server, checked when committing
+        self.reads = {}
 
     def __getitem__(self, item):
-        if item in self._record:
-            return self._record[item]
-        return self.interface[item]
+        return self.get_item(item)
 
     def __setitem__(self, item, val):
         self.record[item] = val
@@ -93,19 +109,44 @@ class ContextualDatabaseInterface:
 
     @allow_sync
     async def get_item(self, key):
-        return self[key]
+        if key in self.record:
+            return self.record[key]
+
+        val, version = await self._interface.get_versioned(key)
+        # The first read is the one the block's writes were based on
+        self.reads.setdefault(key, version)
+        return val
+
+    @allow_sync
+    async def commit(self):
+        """
+        Writes every recorded value in one round trip, if no key read has changed since
+
+        :return:
+        """
+        if not self.record:
+            return
+
+        for key in self.record:
+            self._interface.invalidate(key)
+        response = await self.conn.request({"cmd": "transaction", "db_key": self.db_key, "reads": self.reads,
+                                            "writes": self.record}, full=True)
+        if response.get("conflicts"):
+            raise ACIConflictError(response["conflicts"])
+        if response.get("msg") != "Success":
+            raise ACIException(str(response.get("msg")))
 
     @allow_sync
     async def list_databases(self):
-        return await self.conn.list_databases()
+        return await self._interface.list_databases()
 
     @allow_sync
     async def read_from_disk(self):
-        await self.conn.read_from_disk()
+        await self._interface.read_from_disk()
 
     @allow_sync
     async def write_to_disk(self):
-        await self.conn.write_to_disk()
+        await self._interface.write_to_disk()
 
 
 class DatabaseInterface:
@@ -117,6 +158,41 @@ class DatabaseInterface:
         self.db_key = db_key
 
         self._contextual = None
+        self._cache = None
+
+    def enable_cache(self, max_size=1024, ttl=None):
+        """
+        Serves repeated get_value calls from a local cache, kept coherent by Server change notifications
+
+        Cached values are shared between callers and must not be mutated.
+        :param max_size: number of keys kept, least recently used keys are evicted past it
+        :param ttl: seconds a value may be served from the cache, None keeps it until it changes
+        :return:
+        """
+        self._cache = ReadCache(max_size, ttl)
+
+    @allow_sync
+    async def disable_cache(self):
+        cache, self._cache = self._cache, None
+        if cache is not None:
+            for key in list(cache._entries):
+                self._unwatch(key)
+
+    def invalidate(self, key, version=None):
+        """
+        Drops a key from the local cache
+
+        :param key:
+        :param version: version of the change which made the cached value stale
+        :return:
+        """
+        if self._cache is not None:
+            self._cache.invalidate(key, version)
+
+    def _unwatch(self, key):
+        # Keys the user subscribed to keep their Server subscription
+        if (self.db_key, key) not in self.conn.subscriptions:
+            asyncio.ensure_future(self.conn.send_command({"cmd": "unsubscribe", "key": key, "db_key": self.db_key}))
 
     @allow_sync
     async def write_to_disk(self):
@@ -125,7 +201,16 @@ class DatabaseInterface:
 
         :return:
         """
-        await self.conn.ws.send(json.dumps({"cmd": "wtd", "db_key": self.db_key}))
+        await self.conn.send_command({"cmd": "wtd", "db_key": self.db_key})
+
+    @allow_sync
+    async def snapshot_status(self):
+        """
+        Gets the progress and duration of the Database's latest background write to disk
+
+        :return: dict of the snapshot status by db_key, None if the Database was not written yet
+        """
+        return await self.conn.request({"cmd": "snapshot_status", "db_key": self.db_key})
 
     @allow_sync
     async def read_from_disk(self):
@@ -134,7 +219,7 @@ class DatabaseInterface:
 
         :return:
         """
-        await self.conn.ws.send(json.dumps({"cmd": "rfd", "db_key": self.db_key}))
+        await self.conn.send_command({"cmd": "rfd", "db_key": self.db_key})
 
     @allow_sync
     async def list_databases(self):
@@ -143,23 +228,33 @@ class DatabaseInterface:
 
         :return:
         """
-        await self.conn.ws.send(json.dumps({"cmd": "list_databases", "db_key": self.db_key}))
-        return json.loads(await self.conn.wait_for_response("ld", None, self.db_key))
+        return json.loads(await self.conn.request({"cmd": "list_databases", "db_key": self.db_key}))
 
     async def _get_value(self, key):
-        await self.conn.ws.send(json.dumps({"cmd": "get_val", "key": key, "db_key": self.db_key}))
-        response = await self.conn.wait_for_response("get_val", key, self.db_key, cmd_type="get_val")
-        return response
+        if self._cache is None:
+            return await self.conn.request({"cmd": "get_value", "key": key, "db_key": self.db_key})
+
+        cache = self._cache
+        hit, value = cache.get(key)
+        if hit:
+            return value
+
+        cache.begin_fill(key)
+        response = await self.conn.request({"cmd": "get_value", "key": key, "db_key": self.db_key, "watch": True},
+                                           full=True)
+        for evicted in cache.fill(key, response["val"], response.get("ver")):
+            self._unwatch(evicted)
+        return response["val"]
 
     @allow_sync
     async def set_value(self, key, val):
-        await self.conn.ws.send(json.dumps({"cmd": "set_val", "key": key, "db_key": self.db_key, "val": val}))
-        response = await self.conn.wait_for_response(cmd_type="set_val")
-        return response
+        self.invalidate(key)
+        return await self.conn.request({"cmd": "set_value", "key": key, "db_key": self.db_key, "val": val})
 
     @allow_sync
     async def set_value_noack(self, key, val):
-        await self.conn.ws.send(json.dumps({"cmd": "set_val", "key": key, "db_key": self.db_key, "val": val}))
+        self.invalidate(key)
+        await self.conn.send_command({"cmd": "set_value", "key": key, "db_key": self.db_key, "val": val})
         return "no ack"
 
     @allow_sync
@@ -168,43 +263,321 @@ class DatabaseInterface:
 
     @allow_sync
     async def get_index(self, key, index):
-        await self.conn.ws.send(json.dumps({"cmd": "get_index", "key": key, "db_key": self.db_key, "index":index}))
-        response = await self.conn.wait_for_response("get_indexResp", key, self.db_key)
-        return response
+        return await self.conn.request({"cmd": "get_index", "key": key, "db_key": self.db_key, "index": index})
 
     @allow_sync
     async def set_index(self, key, index, value):
-        await self.conn.ws.send(json.dumps({"cmd": "set_index", "key": key, "db_key": self.db_key, "index":index, "value": value}))
-        response = await self.conn.wait_for_response("set_indexResp", key, self.db_key)
-        return response
+        self.invalidate(key)
+        return await self.conn.request({"cmd": "set_index", "key": key, "db_key": self.db_key, "index": index,
+                                        "value": value})
 
     @allow_sync
     async def set_index_noack(self, key, index, value):
-        await self.conn.ws.send(json.dumps({"cmd": "set_index", "key": key, "db_key": self.db_key, "index":index, "value": value}))
+        self.invalidate(key)
+        await self.conn.send_command({"cmd": "set_index", "key": key, "db_key": self.db_key, "index": index,
+                                      "value": value})
         return "no ack"
 
     @allow_sync
     async def append_index(self, key, value):
-        await self.conn.ws.send(json.dumps({"cmd": "append_index", "key": key, "db_key": self.db_key, "value": value}))
-        response = await self.conn.wait_for_response("app_indexResp", key, self.db_key)
-        return response
+        self.invalidate(key)
+        return await self.conn.request({"cmd": "append_list", "key": key, "db_key": self.db_key, "value": value})
 
     @allow_sync
     async def append_index_noack(self, key, value):
-        await self.conn.ws.send(json.dumps({"cmd": "append_index", "key": key, "db_key": self.db_key, "value": value}))
+        self.invalidate(key)
+        await self.conn.send_command({"cmd": "append_list", "key": key, "db_key": self.db_key, "value": value})
         return "no ack"
 
+    @allow_sync
+    async def get_versioned(self, key):
+        """
+        Gets a value with its version, for compare_and_set and push_trim
+
+        :param key:
+        :return: (value, version), the version is None if the key does not exist
+        """
+        response = await self.conn.request({"cmd": "get_value", "key": key, "db_key": self.db_key}, full=True)
+        return response["val"], response.get("ver")
+
+    @allow_sync
+    async def increment(self, key, amount=1):
+        """
+        Adds to a number on the Server in one round trip, a missing key counts as 0
+
+        :param key:
+        :param amount:
+        :return: the new value
+        """
+        self.invalidate(key)
+        return await self.conn.request({"cmd": "increment", "key": key, "db_key": self.db_key, "amount": amount})
+
+    @allow_sync
+    async def decrement(self, key, amount=1):
+        self.invalidate(key)
+        return await self.conn.request({"cmd": "decrement", "key": key, "db_key": self.db_key, "amount": amount})
+
+    @allow_sync
+    async def append_string(self, key, value):
+        """
+        Appends to a string on the Server in one round trip, a missing key counts as empty
+
+        :param key:
+        :param value:
+        :return: the new value
+        """
+        self.invalidate(key)
+        return await self.conn.request({"cmd": "append_string", "key": key, "db_key": self.db_key, "value": value})
+
+    @allow_sync
+    async def compare_and_set(self, key, val, expected, by="value"):
+        """
+        Sets a value only if the key still holds the expected value, or version from get_versioned
+
+        A missing key holds None at version None, so an expected None sets the value only if the key does not exist.
+        :param key:
+        :param val:
+        :param expected:
+        :param by: "value" or "version"
+        :return: True if the value was set, False if the key did not match
+        """
+        self.invalidate(key)
+        return await self.conn.request({"cmd": "compare_and_set", "key": key, "db_key": self.db_key, "val": val,
+                                        "expected": expected, "by": by})
+
+    @allow_sync
+    async def get_and_set(self, key, val):
+        """
+        Sets a value and gets the one it replaced in one round trip
+
+        :param key:
+        :param val:
+        :return: the previous value, None if the key did not exist
+        """
+        self.invalidate(key)
+        return await self.conn.request({"cmd": "get_and_set", "key": key, "db_key": self.db_key, "val": val})
+
+    @allow_sync
+    async def push_trim(self, key, value, max_len=None, expected_version=None):
+        """
+        Appends to a list and evicts its oldest elements past max_len in one round trip
+
+        :param key:
+        :param value: a value or a list of values
+        :param max_len: number of elements kept, None only applies the list's own limit
+        :param expected_version: only appends if the list is still at this version, from get_versioned
+        :return: the length of the list, or False if the version did not match
+        """
+        self.invalidate(key)
+        return await self.conn.request({"cmd": "push_trim", "key": key, "db_key": self.db_key, "value": value,
+                                        "max_len": max_len, "expected_version": expected_version})
+
     @allow_sync
     async def get_len_index(self, key):
-        await self.conn.ws.send(json.dumps({"cmd": "get_len_index", "key": key, "db_key": self.db_key}))
-        response = await self.conn.wait_for_response("get_len_indexResp", key, self.db_key)
-        return response
+        return await self.conn.request({"cmd": "get_list_length", "key": key, "db_key": self.db_key})
 
     @allow_sync
     async def get_recent_index(self, key, num):
-        await self.conn.ws.send(json.dumps({"cmd": "get_recent_index", "key": key, "db_key": self.db_key, "num":num}))
-        response = await self.conn.wait_for_response("get_recent_indexResp", key, self.db_key)
-        return response   
+        return await self.conn.request({"cmd": "get_recent", "key": key, "db_key": self.db_key, "num": num})
+
+    @allow_sync
+    async def create_series(self, key, dtype, capacity=None):
+        """
+        Creates a typed numeric list, stored by the Server in array buffers
+
+        :param key:
+        :param dtype: "int64", "float64" or "timeseries", whose elements are [timestamp, value]
+        :param capacity: number of elements kept, the oldest are evicted past it
+        :return:
+        """
+        return await self.conn.request({"cmd": "create_series", "key": key, "db_key": self.db_key, "type": dtype,
+                                        "capacity": capacity})
+
+    @allow_sync
+    async def append_sample(self, key, value, timestamp=None):
+        """
+        Appends a value to a timeseries, stamped with the Server's clock unless a timestamp is given
+
+        :param key:
+        :param value:
+        :param timestamp: seconds since the epoch
+        :return:
+        """
+        return await self.append_index(key, value if timestamp is None else [[timestamp, value]])
+
+    @allow_sync
+    async def aggregate(self, key, op, window=None, start=None, stop=None, since=None, q=None, bucket=None):
+        """
+        Has the Server reduce a list of numbers, so only the result is sent
+
+        :param key:
+        :param op: "sum", "mean", "min", "max", "count" or "percentile"
+        :param window: only the newest window elements
+        :param start: first index, negative indexes count back from the end
+        :param stop: index after the last one
+        :param since: only timeseries elements from the last since seconds
+        :param q: percentile from 0 to 100
+        :param bucket: downsample, returning one aggregate per bucket elements
+        :return: the number, or a list of numbers when downsampling
+        """
+        return await self.conn.request({"cmd": "aggregate", "key": key, "db_key": self.db_key, "op": op,
+                                        "window": window, "start": start, "stop": stop, "since": since, "q": q,
+                                        "bucket": bucket})
+
+    @allow_sync
+    async def get_range(self, key, start=None, stop=None, step=None):
+        """
+        Reads a slice of a list in one request, bounds follow python slice rules including negative indexes
+
+        :param key:
+        :param start:
+        :param stop:
+        :param step:
+        :return: list of the elements in the slice
+        """
+        return await self.conn.request({"cmd": "get_range", "key": key, "db_key": self.db_key, "start": start,
+                                        "stop": stop, "step": step})
+
+    async def stream_value(self, key, chunk_size=DEFAULT_CHUNK_SIZE, window=DEFAULT_WINDOW):
+        """
+        Reads a value in chunks, for use as: async for chunk in interface.stream_value(key)
+
+        Lists arrive as lists of up to chunk_size elements and strings as substrings, any other value arrives whole
+        as a single chunk. The Server sends at most window chunks ahead of the ones consumed.
+        :param key:
+        :param chunk_size:
+        :param window:
+        :return: async iterator of chunks
+        """
+        queue = asyncio.Queue()
+        req_id = await self.conn.open_stream({"cmd": "stream_value", "key": key, "db_key": self.db_key,
+                                              "chunk_size": chunk_size, "window": window},
+                                             queue, asyncio.get_running_loop())
+        finished = False
+        try:
+            while True:
+                packet = await queue.get()
+                if packet["cmd"] == "stream_chunk":
+                    yield packet["data"]
+                    await self.conn.send_stream_control({"cmd": "stream_ack", "stream_id": req_id,
+                                                         "seq": packet["seq"], "db_key": self.db_key})
+                elif packet["cmd"] == "stream_lost":
+                    finished = True
+                    raise ACIConnectionError("Connection lost while streaming " + str(key))
+                else:
+                    finished = True
+                    if packet.get("msg") != "Success":
+                        raise ACIException(str(packet.get("msg")))
+                    return
+        finally:
+            self.conn._streams.pop(req_id, None)
+            if not finished:
+                await self.conn.send_stream_control({"cmd": "stream_cancel", "stream_id": req_id,
+                                                     "db_key": self.db_key})
+
+    @allow_sync
+    async def upload_value(self, key, value, chunk_size=DEFAULT_CHUNK_SIZE, window=DEFAULT_WINDOW):
+        """
+        Writes a value in chunks, applied by the Server as a single write once every chunk has arrived
+
+        :param key:
+        :param value: lists and strings are split into chunks of chunk_size elements or characters
+        :param chunk_size:
+        :param window: number of chunks sent ahead of the Server's acknowledgements
+        :return:
+        """
+        self.invalidate(key)
+        response = await self.conn.request({"cmd": "upload_begin", "key": key, "db_key": self.db_key,
+                                            "kind": chunk_kind(value)}, full=True)
+        if response.get("msg") != "Success":
+            return response.get("msg")
+
+        upload_id = response["upload_id"]
+        in_flight = collections.deque()
+        try:
+            for seq, chunk in enumerate(split_chunks(value, chunk_size)):
+                if len(in_flight) >= window:
+                    result = await in_flight.popleft()
+                    if result != "Success":
+                        return result
+
+                in_flight.append(asyncio.ensure_future(self.conn.request(
+                    {"cmd": "upload_chunk", "upload_id": upload_id, "seq": seq, "data": chunk,
+                     "db_key": self.db_key})))
+
+            while in_flight:
+                result = await in_flight.popleft()
+                if result != "Success":
+                    return result
+        finally:
+            for future in in_flight:
+                future.cancel()
+
+        return await self.conn.request({"cmd": "upload_end", "upload_id": upload_id, "db_key": self.db_key})
+
+    @allow_sync
+    async def subscribe(self, key, callback=None):
+        """
+        Asks the Server to push every change of a key
+
+        Changes arrive as "key_changed" events, passed to callback and to any matching event callbacks.
+        :param key:
+        :param callback: called with the event packet
+        :return:
+        """
+        # Recorded even without a callback, so the subscription is resumed after a reconnect and kept by the cache
+        callbacks = self.conn.subscriptions.setdefault((self.db_key, key), [])
+        if callback is not None:
+            callbacks.append(callback)
+        return await self.conn.request({"cmd": "subscribe", "key": key, "db_key": self.db_key})
+
+    @allow_sync
+    async def unsubscribe(self, key):
+        """
+        Stops the Server pushing changes of a key, dropping its callbacks
+
+        :param key:
+        :return:
+        """
+        self.conn.subscriptions.pop((self.db_key, key), None)
+        return await self.conn.request({"cmd": "unsubscribe", "key": key, "db_key": self.db_key})
+
+    async def _batch(self, ops):
+        return await self.conn.request({"cmd": "batch", "db_key": self.db_key, "ops": ops})
+
+    @allow_sync
+    async def get_many(self, keys):
+        """
+        Gets the values of many keys in a single round trip
+
+        :param keys: list of keys
+        :return: list of values, in the order of keys
+        """
+        return await self._batch([{"cmd": "get_value", "key": key} for key in keys])
+
+    @allow_sync
+    async def set_many(self, values):
+        """
+        Sets many keys in a single round trip
+
+        :param values: dict of key to value
+        :return: list of results, in the order of values
+        """
+        for key in values:
+            self.invalidate(key)
+        return await self._batch([{"cmd": "set_value", "key": key, "val": values[key]} for key in values])
+
+    @allow_sync
+    async def append_many(self, values):
+        """
+        Appends to many lists in a single round trip
+
+        :param values: dict of key to the value (or list of values) to append
+        :return: list of results, in the order of values
+        """
+        for key in values:
+            self.invalidate(key)
+        return await self._batch([{"cmd": "append_list", "key": key, "value": values[key]} for key in values])
 
     def __getitem__(self, key):
         return self.get_value(key)
@@ -217,8 +590,10 @@ class DatabaseInterface:
         return self._contextual
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
-        for key in self._contextual.record:
-            await self.set_value(key, self._contextual.record[key])
+        contextual, self._contextual = self._contextual, None
+        # A block left by an exception writes nothing
+        if exc_type is None:
+            await contextual.commit()
 
 
 class event_callback:
@@ -230,99 +605,310 @@ class Connection:
     """
         ACI Connection
     """
-    def __init__(self, loop, ip, port, name):
+    # Seconds before the first reconnect attempt, doubled for each failed attempt up to reconnect_max
+    reconnect_base = 0.1
+    reconnect_max = 30.0
+    # Seconds to wait for the answer to hello, Servers which predate it never answer and json is kept
+    hello_timeout = 5.0
+
+    def __init__(self, loop, ip, port, name, codecs=None):
         """
         :param ip:
         :param port:
         :param loop:
+        :param codecs: wire encodings to offer the Server, most preferred first
         """
         global connections
 
         self.ip = ip
         self.port = port
         self.ws = 0
-        self.responses = SimpleQueue()
         self.loop = loop
         self.name = name
         self.id = "not-authed"
+        self.codecs = codecs if codecs is not None else available_codecs()
+        self.codec = CODECS["json"]
 
         self.interfaces = {}
         self.event_callbacks = []
+        # Callbacks for pushed changes, keyed by (db_key, key)
+        self.subscriptions = {}
+
+        # Futures awaiting a Server response, keyed by the request id echoed back by the Server
+        self._pending = {}
+        # Packets of the requests sent on the current websocket which have not been answered yet
+        self._in_flight = {}
+        self._request_ids = itertools.count()
+        # Chunk queues of the open streams, keyed by request id, with the loop their reader runs on
+        self._streams = {}
+
+        # Set while connected and, after a reconnect, once the session has been resumed
+        self._ready = None
+        self._credentials = None
+        self._closing = False
 
         connections[name] = self
 
     async def start(self):
-        await self._create(self.port, self.ip, self.loop, self.responses)
+        # Synchronous calls are handed off to whichever loop the connection actually runs on
+        self.loop = asyncio.get_running_loop()
+        self._ready = asyncio.Event()
+        await self._create(self.port, self.ip, self.loop)
+
+    async def _wait_ready(self):
+        if self._ready is None:
+            raise ACIConnectionError("Connection %s has not been started" % self.name)
+        await self._ready.wait()
 
-    async def wait_for_response(self, _, key="none", db_key="none", cmd_type="any"):
+    async def send_command(self, packet):
         """
-        Waits for a response
-        :param _:
-        :param key:
-        :param db_key:
+        Sends a command without waiting for a response, waiting for the connection if it is down
+
+        :param packet:
         :return:
         """
         while True:
-            if not self.responses.empty():
-                value = self.responses.get_nowait()
-                cmd = json.loads(value)
-                if cmd["cmd_typ"] == cmd_type or cmd_type == "any":
-
-                    if cmd["cmd_typ"] == "get_val" and cmd["key"] == key and cmd["db_key"] == db_key:
-                        return cmd["val"]
-                    elif cmd["cmd_typ"] == "set_val":
-                        return cmd["val"]
-                    elif cmd["cmd_typ"] == "ld":
-                        return cmd["val"]
-                    elif cmd["cmd_typ"] == "auth_msg":
-                        return cmd["val"]
-                    elif cmd["cmd_typ"] == "get_indexResp" and cmd["key"] == key and cmd["db_key"] == db_key:
-                        return cmd["val"]
-                    elif cmd["cmd_typ"] == "set_indexResp" and cmd["key"] == key and cmd["db_key"] == db_key:
-                        return cmd["val"]
-                    elif cmd["cmd_typ"] == "app_indexResp" and cmd["key"] == key and cmd["db_key"] == db_key:
-                        return cmd["val"]
-                    elif cmd["cmd_typ"] == "get_len_indexResp" and cmd["key"] == key and cmd["db_key"] == db_key:
-                        return cmd["val"]
-                    elif cmd["cmd_typ"] == "get_recent_indexResp" and cmd["key"] == key and cmd["db_key"] == db_key:
-                        return cmd["val"]
-
-    async def _create(self, port, ip, loop, responses):
+            await self._wait_ready()
+            try:
+                await self.ws.send(self.codec.encode(packet))
+                return
+            except websockets.ConnectionClosed:
+                continue
+
+    async def request(self, packet, full=False):
+        """
+        Sends a command tagged with a new request id and waits for the matching response
+
+        Reads interrupted by a lost connection are sent again once it is back, other commands fail with
+        ACIConnectionError as it is unknown whether the Server applied them.
+        :param packet:
+        :param full: return the whole response packet instead of just its value
+        :return:
+        """
+        await self._wait_ready()
+        return await self._request(packet, full)
+
+    async def _request(self, packet, full=False):
+        req_id = next(self._request_ids)
+        packet["req_id"] = req_id
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending[req_id] = future
+        try:
+            while True:
+                try:
+                    await self.ws.send(self.codec.encode(packet))
+                    break
+                except (websockets.ConnectionClosed, AttributeError):
+                    if packet["cmd"] not in _replayable_commands:
+                        raise ACIConnectionError("Connection lost before %s was sent" % packet["cmd"])
+                    await self._wait_ready()
+
+            self._in_flight[req_id] = packet
+            response = await future
+        finally:
+            self._pending.pop(req_id, None)
+            self._in_flight.pop(req_id, None)
+
+        if full:
+            return response
+        return response.get(_response_fields.get(response["cmd"], "msg"))
+
+    @allow_sync
+    async def open_stream(self, packet, queue, loop):
+        """
+        Starts a stream whose chunks are put on a queue read from the given loop
+
+        :param packet:
+        :param queue:
+        :param loop:
+        :return: the request id of the stream
+        """
+        await self._wait_ready()
+        req_id = next(self._request_ids)
+        packet["req_id"] = req_id
+        self._streams[req_id] = (queue, loop)
+        try:
+            await self.ws.send(self.codec.encode(packet))
+        except (websockets.ConnectionClosed, AttributeError):
+            self._streams.pop(req_id, None)
+            raise ACIConnectionError("Connection lost before the stream was started")
+        return req_id
+
+    @allow_sync
+    async def send_stream_control(self, packet):
+        try:
+            await self.ws.send(self.codec.encode(packet))
+        except (websockets.ConnectionClosed, AttributeError):
+            # The stream ended with the connection
+            pass
+
+    def feed_stream(self, req_id, packet):
+        entry = self._streams.get(req_id)
+        if entry is None:
+            return
+        queue, loop = entry
+        if loop is self.loop:
+            queue.put_nowait(packet)
+        else:
+            loop.call_soon_threadsafe(queue.put_nowait, packet)
+
+    def resolve_response(self, req_id, value):
+        """
+        Completes the request waiting on the given request id
+
+        :param req_id:
+        :param value:
+        :return:
+        """
+        future = self._pending.get(req_id)
+        if future is None:
+            return
+
+        loop = future.get_loop()
+        try:
+            same_loop = asyncio.get_running_loop() is loop
+        except RuntimeError:
+            same_loop = False
+
+        if same_loop:
+            _set_future_result(future, value)
+        else:
+            loop.call_soon_threadsafe(_set_future_result, future, value)
+
+    async def _create(self, port, ip, loop):
         """
         Initializes the connection
 
         :param port:
         :param ip:
         :param loop:
-        :param responses:
         :return:
         """
-        await self.handler(loop, responses, ip, port)
+        await self.handler(loop, ip, port)
 
-    async def handler(self, loop, responses, ip="127.0.0.1", port=8765):
+    async def handler(self, loop, ip="127.0.0.1", port=8765):
         """
-        Creates a handler
+        Creates a handler, reconnecting with jittered exponential backoff whenever the connection drops
 
         :param loop:
-        :param responses:
         :param ip:
         :param port:
         :return:
         """
         asyncio.set_event_loop(loop)
         uri = "ws://%s:%s" % (ip, port)
+        attempt = 0
+        resuming = False
+
+        while not self._closing:
+            try:
+                async with websockets.connect(uri) as websocket:
+                    # print(websocket)
+                    await self._negotiate_codec(websocket)
+                    self.ws = websocket
+                    attempt = 0
+
+                    if resuming:
+                        asyncio.ensure_future(self._resume())
+                    else:
+                        self._ready.set()
+                    resuming = True
+
+                    while True:
+                        await _recv_handler(websocket, uri, self)
+            except (websockets.ConnectionClosed, OSError) as e:
+                if not self._closing and self.ws != 0:
+                    print("ACI connection %s to %s lost: %r" % (self.name, uri, e))
+            except Exception as e:
+                # Such as a failed handshake with a Server still starting up, retried like a refused connection
+                if not self._closing:
+                    print("ACI connection %s to %s failed: %r" % (self.name, uri, e))
+
+            self._ready.clear()
+            self.ws = 0
+            self._fail_in_flight()
+            if self._closing:
+                break
+
+            # Full jitter keeps a fleet of clients from reconnecting in lockstep after a Server restart
+            delay = random.uniform(0, min(self.reconnect_max, self.reconnect_base * 2 ** attempt))
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    def _fail_in_flight(self):
+        """
+        Fails the sent requests which are not safe to send again, the rest are replayed on reconnect
 
-        async with websockets.connect(uri) as websocket:
-            # print(websocket)
-            self.ws = websocket
-            time.sleep(0.25)
-            while True:
-                consumer_task = asyncio.ensure_future(_recv_handler(self.ws, uri, responses))
+        :return:
+        """
+        for req_id in list(self._in_flight):
+            if self._in_flight[req_id]["cmd"] not in _replayable_commands:
+                packet = self._in_flight.pop(req_id)
+                future = self._pending.get(req_id)
+                if future is not None and not future.done():
+                    future.set_exception(ACIConnectionError("Connection lost while waiting for " + packet["cmd"]))
+
+        # Streams are not resumed, the Server forgets them with the session
+        for req_id in list(self._streams):
+            self.feed_stream(req_id, {"cmd": "stream_lost", "req_id": req_id})
+
+    async def _resume(self):
+        """
+        Restores the session on a new websocket: authentication, subscriptions, then interrupted reads
+
+        :return:
+        """
+        try:
+            if self._credentials is not None:
+                print("ACI connection %s re-authenticating: %s" % (self.name, await self._request(
+                    {"cmd": "a_auth", "id": self._credentials[0], "token": self._credentials[1]})))
+
+            for interface in self.interfaces.values():
+                # Changes made while disconnected were never pushed
+                if interface._cache is not None:
+                    interface._cache.clear()
+
+            for db_key, key in list(self.subscriptions):
+                await self._request({"cmd": "subscribe", "key": key, "db_key": db_key})
 
-                done, pending = await asyncio.wait([consumer_task], return_when=asyncio.FIRST_COMPLETED)
+            for req_id in list(self._in_flight):
+                await self.ws.send(self.codec.encode(self._in_flight[req_id]))
+        except (websockets.ConnectionClosed, ACIConnectionError):
+            return
 
-                for task in pending:
-                    task.cancel()
+        self._ready.set()
+
+    @allow_sync
+    async def close(self):
+        """
+        Closes the connection without reconnecting
+
+        :return:
+        """
+        self._closing = True
+        if self.ws != 0:
+            await self.ws.close()
+
+    async def _negotiate_codec(self, websocket):
+        """
+        Agrees on a wire encoding with the Server, keeping json if it does not know the hello command
+
+        :param websocket:
+        :return:
+        """
+        self.codec = CODECS["json"]
+        if self.codecs == ["json"]:
+            return
+
+        await websocket.send(json.dumps({"cmd": "hello", "codecs": self.codecs, "req_id": "hello"}))
+        try:
+            response = json.loads(await asyncio.wait_for(websocket.recv(), self.hello_timeout))
+        except asyncio.TimeoutError:
+            print("ACI connection %s got no answer to hello, using json" % self.name)
+            return
+        if response.get("cmd") == "helloResp" and response.get("msg") in CODECS:
+            self.codec = CODECS[response["msg"]]
 
     def _get_interface(self, database_key):
         """
@@ -339,17 +925,45 @@ class Connection:
         return self.interfaces[key]
 
     async def create_database(self, db_key):
-        await self.ws.send(json.dumps({"cmd": "cdb", "db_key": db_key}))
+        await self.send_command({"cmd": "cdb", "db_key": db_key})
 
     @allow_sync
     async def authenticate(self, id, token):
         self.id = id
-        await self.ws.send(json.dumps({"cmd":"a_auth", "id":id, "token":token}))
-        return await self.wait_for_response("auth_msg", None, None)
+        response = await self.request({"cmd": "a_auth", "id": id, "token": token})
+        if response == "success":
+            # Used to authenticate again after reconnecting
+            self._credentials = (id, token)
+        return response
 
     @allow_sync
     async def send_event(self, destination, event_id, data):
-        await self.ws.send(json.dumps({"cmd":"event", "event_id":event_id, "destination": destination, "data": data, "origin":self.id}))
+        await self.send_command({"cmd": "event", "event_id": event_id, "destination": destination, "data": data,
+                                 "origin": self.id})
+
+    @allow_sync
+    async def stats(self, format=None):
+        """
+        Gets the Server's metrics: command counts and latency histograms, persistence timings and gauges
+
+        :param format: None for a dict, "prometheus" for the Prometheus text format
+        :return:
+        """
+        return await self.request({"cmd": "stats", "format": format})
+
+    @allow_sync
+    async def flush_stats(self):
+        """
+        Gets the Server's disk writer queue and flush lag statistics
+
+        :return:
+        """
+        return await self.request({"cmd": "flush_stats"})
 
     def add_event_callback(self, event_callback):
         self.event_callbacks.append(event_callback)
+
+
+def _set_future_result(future, value):
+    if not future.done():
+        future.set_result(value)
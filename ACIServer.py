@@ -1,6 +1,7 @@
 import websockets
 import asyncio
 import json
+import time
 import traceback
 import requests
 import random
@@ -8,30 +9,108 @@ from google.oauth2 import id_token
 from google.auth.transport import requests
 
 try:
-    from database import Database
+    from database import Database, ItemCache, LIST_TYPES
+    from flusher import Flusher
+    from metrics import Metrics
+    from tracing import Tracer, current_trace
+    from codec import CODECS, decode_frame, negotiate
+    from streaming import StreamState, UploadState, split_chunks, chunk_kind, DEFAULT_CHUNK_SIZE, DEFAULT_WINDOW
 except Exception as e:
     tb_str = traceback.format_exception(etype=type(e), value=e, tb=e.__traceback__)
     print(tb_str)
-    from ACIpy.database import Database
+    from ACIpy.database import Database, ItemCache, LIST_TYPES
+    from ACIpy.flusher import Flusher
+    from ACIpy.metrics import Metrics
+    from ACIpy.tracing import Tracer, current_trace
+    from ACIpy.codec import CODECS, decode_frame, negotiate
+    from ACIpy.streaming import StreamState, UploadState, split_chunks, chunk_kind, DEFAULT_CHUNK_SIZE, \
+        DEFAULT_WINDOW
 
 ACIVersion = "2020.07.01.1"
 
+def command(*names):
+    """
+    Marks a Server method as the handler for the given command names
+
+    :param names: the command name followed by any legacy aliases
+    :return:
+    """
+    def decorator(func):
+        func.command_names = names
+        return func
+
+    return decorator
+
+
 class ServerClient:
-    def __init__(self, clientID, user_type, clientWebsocket, user_id):
-        self.id = clientID
+    """
+        Session bound to a single client websocket
+    """
+    def __init__(self, clientWebsocket):
+        self.id = None
         self.websocket = clientWebsocket
+        self.user_type = None
+        self.user_id = None
+        self.user = "NotAuthed"
+        # Wire encoding agreed on by the hello command
+        self.codec = CODECS["json"]
+        # (Database, key) of every item this session is subscribed to
+        self.subscriptions = set()
+        # Outgoing streams and staged uploads, keyed by the request id which started them
+        self.streams = {}
+        self.uploads = {}
+
+    def authenticate(self, clientID, user_type, user_id):
+        self.id = clientID
         self.user_type = user_type
         self.user_id = user_id
+        self.user = {"user_type": user_type, "user_id": user_id}
+
+    async def send(self, packet):
+        trace = current_trace()
+        if trace is None:
+            await self.websocket.send(self.codec.encode(packet))
+            return
+
+        started = time.perf_counter()
+        frame = self.codec.encode(packet)
+        encoded = time.perf_counter()
+        await self.websocket.send(frame)
+        trace.add("encode", encoded - started)
+        trace.add("send", time.perf_counter() - encoded)
 
 
 class Server:
+    # Commands which may not be issued from inside a batch command
+    unbatchable_commands = {"batch", "hello", "g_auth", "a_auth", "stream_value", "upload_begin"}
+
     def __init__(self, loop, ip="localhost", port=8765, _=""):
         self.ip = ip
         self.port = port
         self.dbs = {}
-        self.clients = []
+        self.clients = {}
         self.loop = loop
         self.rootDir = "./"
+        self.flusher = Flusher()
+        # Shared memory budget for the items loaded across every database
+        self.item_cache = ItemCache()
+        # Storage engine of newly created databases, existing databases keep the layout found on disk
+        self.storage = None
+
+        self.metrics = Metrics()
+        self.flusher.metrics = self.metrics
+        self.session_count = 0
+        # Port of the Prometheus text endpoint, None to not serve it
+        self.metrics_port = None
+        self.register_metrics()
+        # Slow command log and stack sampler, only set up when the config asks for it
+        self.tracer = None
+
+        self.commands = {}
+        for attr in dir(type(self)):
+            handler = getattr(self, attr)
+            for name in getattr(handler, "command_names", ()):
+                self.register_command(name, handler)
 
     def start(self):
         """
@@ -43,144 +122,624 @@ class Server:
         start_server = websockets.serve(self.connection_handler, self.ip, self.port)
 
         asyncio.get_event_loop().run_until_complete(start_server)
+        self.serve_metrics()
         asyncio.get_event_loop().run_forever()
 
-    async def connection_handler(self, websocket, path):
-        websocket.user = "NotAuthed"
-        while True:
-            raw_cmd = await websocket.recv()
-            cmd = json.loads(raw_cmd)
-            response = ""
+    def register_metrics(self):
+        """
+        Describes the Server's metrics and registers the gauges read from its state when a snapshot is taken
+        :return:
+        """
+        describe = self.metrics.describe
+        describe("aci_commands_total", "Commands handled, by command and database")
+        describe("aci_command_errors_total", "Commands answered with an error, by command")
+        describe("aci_command_seconds", "Time from receiving a command to sending its response")
+        describe("aci_received_bytes_total", "Bytes of commands received")
+        describe("aci_events_total", "Events routed between clients")
+        describe("aci_pushes_total", "Change notifications pushed to subscribed sessions, by database")
+        describe("aci_log_record_seconds", "Time to apply the bookkeeping of and queue a write-ahead log record")
+        describe("aci_log_write_seconds", "Time to write and fsync a batch of write-ahead log records")
+        describe("aci_log_records_total", "Write-ahead log records written to disk, by database")
+        describe("aci_compaction_seconds", "Time to write a compaction of changed items and truncate the log")
+        describe("aci_compaction_bytes_total", "Bytes of items written by compactions, by database")
+        describe("aci_item_load_seconds", "Time to read and decode an item from storage")
+        describe("aci_flush_seconds", "Time the flusher spends on one batch of writes")
+        describe("aci_flush_lag_seconds", "Age of the oldest write when the flusher picks up a batch")
+        describe("aci_snapshot_seconds", "Time from starting a background snapshot to handing it to the writer")
+        describe("aci_snapshot_copied_on_write_total", "Items serialized early by a snapshot because they were written")
 
-            clientIndex = "NotFound"
-            for index, Client in enumerate(self.clients):
-                if Client.user_type + Client.user_id == websocket.user:
-                    clientIndex = index
+        gauge = self.metrics.gauge
+        gauge("aci_sessions", lambda: self.session_count)
+        gauge("aci_authenticated_sessions",
+              lambda: sum(len(sessions) for user_id, sessions in self.clients.items() if user_id is not None))
+        gauge("aci_loaded_items", lambda: {(("db", name),): len(self.dbs[name].data._items) for name in self.dbs})
+        gauge("aci_dirty_items", lambda: {(("db", name),): len(self.dbs[name].dirty) for name in self.dbs})
+        gauge("aci_log_bytes", lambda: {(("db", name),): self.dbs[name].log_bytes for name in self.dbs})
+        gauge("aci_item_cache_bytes", lambda: self.item_cache.size)
+        gauge("aci_snapshot_progress", lambda: {(("db", name),): self.dbs[name].snapshot.status()["progress"]
+                                                for name in self.dbs if self.dbs[name].snapshot is not None})
+        for stat in ("pending", "lag", "max_lag", "flushes", "fsyncs", "records_written", "records_coalesced",
+                     "compactions"):
+            gauge("aci_flusher_" + stat, lambda stat=stat: self.flusher.stats()[stat])
 
-            if clientIndex != "NotFound":
-                user = self.clients[clientIndex]
-            else:
-                user = "NotAuthed"
-
-
-            if cmd["cmd"] == "get_value":
-                response = self.get_response_packet(cmd["key"], cmd["db_key"], websocket.user)
-                await websocket.send(response)
-            
-            if cmd["cmd"] == "set_value":
-                newValue = self.dbs[cmd["db_key"]].set(cmd["key"], cmd["val"], websocket.user)
-                response = json.dumps({"cmd": "setResp", "msg": str(cmd["db_key"]) + "[" + str(cmd["key"]) + "] = " + str(newValue)})
-                await websocket.send(response)
-
-            if cmd["cmd"] == "get_index":
-                response = json.dumps({"cmd": "get_indexResp", "msg": self.dbs[cmd["db_key"]].data[cmd["key"]].get_index(cmd["index"], websocket.user), "key":cmd["key"], "db_key":cmd["db_key"]})
-                await websocket.send(response)
-
-            if cmd["cmd"] == "set_index":
-                response = json.dumps({"cmd": "set_indexResp", "msg": self.dbs[cmd["db_key"]].data[cmd["key"]].set_index(cmd["index"], cmd["value"], websocket.user), "key":cmd["key"], "db_key":cmd["db_key"]})
-                await websocket.send(response)
-
-            if cmd["cmd"] == "append_list":
-                response = json.dumps({"cmd": "app_indexResp", "msg": self.dbs[cmd["db_key"]].data[cmd["key"]].append_index(cmd["value"], websocket.user), "key":cmd["key"], "db_key":cmd["db_key"]})
-                await websocket.send(response)
-
-            if cmd["cmd"] == "get_list_length":
-                response = json.dumps({"cmd": "get_len_indexResp", "msg": self.dbs[cmd["db_key"]].data[cmd["key"]].get_len(websocket.user), "key":cmd["key"], "db_key":cmd["db_key"]})
-                await websocket.send(response)
-
-            if cmd["cmd"] == "get_recent":
-                print("Client is requesting recent index")
-                response = json.dumps({"cmd": "get_recent_indexResp", "msg": self.dbs[cmd["db_key"]].data[cmd["key"]].get_recent(cmd["num"], websocket.user), "key":cmd["key"], "db_key":cmd["db_key"]})
-                await websocket.send(response)
-                print("sent")
-
-            
-            if cmd["cmd"] == "event":
-                print(cmd)
-                print(self.clients)
-                for index in self.clients:
-                    print(index.user_id)
-                    if index.user_id == cmd["destination"]:
-                        print("Sending event to " + cmd["destination"])
-                        try:
-                            await index.websocket.send(raw_cmd)
-                        except:
-                            pass
-
-            if cmd["cmd"] == "wtd":
-                self.write_to_disk(cmd["db_key"])
-
-            if cmd["cmd"] == "rfd":
-                self.read_from_disk(cmd["db_key"])
-
-            if (cmd["cmd"] == "cdb"):
-                self.dbs[cmd["db_key"]] = Database(cmd["db_key"], read=False, root_dir=self.rootDir)
-                
-            if cmd["cmd"] == "list_databases":
-                response = json.dumps({"cmd": "ldResp",
-                                       "msg": json.dumps(list(self.dbs[cmd["db_key"]].data.keys()))})
-                await websocket.send(response)
-
-            if cmd["cmd"] == "g_auth":
-                print("Starting Google Auth")
-                try:
-                    token = cmd["id_token"]
-                    # Specify the CLIENT_ID of the app that accesses the backend:
-                    idinfo = id_token.verify_oauth2_token(token, requests.Request())
-
-                    # Or, if multiple clients access the backend server:
-                    # idinfo = id_token.verify_oauth2_token(token, requests.Request())
-                    # if idinfo['aud'] not in [CLIENT_ID_1, CLIENT_ID_2, CLIENT_ID_3]:
-                    #     raise ValueError('Could not verify audience.')
-
-                    if idinfo['iss'] not in ['accounts.google.com', 'https://accounts.google.com']:
-                        raise ValueError('Wrong issuer.')
-
-                    # If auth request is from a G Suite domain:
-                    GSUITE_DOMAIN_NAME = "scienceandpizza.com"
-                    if idinfo['hd'] != GSUITE_DOMAIN_NAME:
-                        raise ValueError('Wrong hosted domain.')
-
-                    # ID token is valid. Get the user's Google Account ID from the decoded token.
-                    userid = idinfo['sub']
-                    print(idinfo["email"] + " Authentication Complete")
-                    self.clients.append(ServerClient(token, "g_user", websocket, idinfo["email"]))
-                    websocket.user = {"user_type":"g_user", "user_id":idinfo["email"]}
-                except ValueError as e:
-                    tb_str = traceback.format_exception(etype=type(e), value=e, tb=e.__traceback__)
-                    print(tb_str)
-                    print("Invalid Token")
-                    print(cmd["id_token"])
-                    # Invalid token
-                    pass
-
-            if cmd["cmd"] == "a_auth":
-                a_users = self.dbs["config"].get("a_users", "backend")
-                if cmd["id"] in a_users:
-                    if cmd["token"] in a_users[cmd["id"]]["tokens"]:
-                        websocket.user = {"user_type":"a_user", "user_id":cmd["id"]}
-                        response = json.dumps({"cmd": "a_auth_response", "msg": "success"})
-                        self.clients.append(ServerClient(cmd["id"], "a_user", websocket, cmd["id"]))
-                        await websocket.send(response)
-                    else:
-                        response = json.dumps({"cmd": "a_auth_response", "msg": "Failed, token incorrect"})
-                        await websocket.send(response)
+    def serve_metrics(self):
+        if self.metrics_port:
+            self.loop.run_until_complete(asyncio.start_server(self._metrics_handler, self.ip, self.metrics_port))
+            print("Serving metrics on port %s" % self.metrics_port)
+
+    async def _metrics_handler(self, reader, writer):
+        """
+        Answers any HTTP request with the Prometheus text dump
+        :param reader:
+        :param writer:
+        :return:
+        """
+        try:
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            body = self.metrics.to_prometheus().encode()
+            writer.write(b"HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: %i\r\n\r\n"
+                         % len(body) + body)
+            await writer.drain()
+        finally:
+            writer.close()
+
+    def register_command(self, name, handler):
+        """
+        Registers a coroutine handling a command
+
+        The handler is called with the ServerClient session and the decoded command, and returns the response
+        packet to send back, or None if the command has no response.
+        :param name:
+        :param handler:
+        :return:
+        """
+        self.commands[name] = handler
+
+    def create_session(self, websocket):
+        """
+        Creates the session of a newly connected client websocket
+
+        :param websocket:
+        :return:
+        """
+        return ServerClient(websocket)
+
+    async def connection_handler(self, websocket, path=None):
+        session = self.create_session(websocket)
+        websocket.session = session
+        self.session_count += 1
+        try:
+            while True:
+                raw_cmd = await websocket.recv()
+                started = time.perf_counter()
+                trace = self.tracer.begin(len(raw_cmd)) if self.tracer is not None else None
+                cmd = decode_frame(session.codec, raw_cmd)
+
+                if trace is None:
+                    response = await self.execute(session, cmd)
                 else:
-                    response = json.dumps({"cmd": "a_auth_response", "msg": "Failed, a_user not found"})
-                    await websocket.send(response)
+                    decoded = time.perf_counter()
+                    trace.describe(cmd)
+                    trace.add("decode", decoded - started)
+                    response = await self.execute(session, cmd)
+                    trace.add("execute", time.perf_counter() - decoded)
+
+                if response is not None:
+                    await self.send_response(session, cmd, response)
+
+                self.record_command(cmd, response, len(raw_cmd), time.perf_counter() - started)
+                if trace is not None:
+                    self.tracer.end(trace)
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            self.session_count -= 1
+            self.close_session(session)
+
+    async def execute(self, session, cmd):
+        """
+        Dispatches a command, holding back its response until its writes are on disk in the per_write flush mode
+
+        :param session:
+        :param cmd:
+        :return: the response packet, or None
+        """
+        submitted = self.flusher.submitted
+        response = await self.dispatch(session, cmd)
+        if response is not None and self.flusher.mode == "per_write" and self.flusher.submitted != submitted:
+            await self.flusher.wait_written()
+        return response
+
+    def record_command(self, cmd, response, size, elapsed):
+        """
+        Counts and times a handled command
+        :param cmd:
+        :param response:
+        :param size: bytes received
+        :param elapsed: seconds from receiving the command to sending its response
+        :return:
+        """
+        # Only known names are used as labels, so clients can not create unbounded series
+        name = cmd.get("cmd") if cmd.get("cmd") in self.commands else "unknown"
+        labels = (("cmd", name), ("db", cmd.get("db_key") if cmd.get("db_key") in self.dbs else ""))
+        self.metrics.inc("aci_commands_total", labels)
+        self.metrics.observe("aci_command_seconds", elapsed, labels)
+        self.metrics.inc("aci_received_bytes_total", amount=size)
+        if response is not None and response.get("cmd") == "error":
+            self.metrics.inc("aci_command_errors_total", (("cmd", name),))
+
+    async def dispatch(self, session, cmd, errors=False):
+        """
+        Runs the handler registered for a command
+        :param session:
+        :param cmd:
+        :param errors: answers a failed command with an error packet even without a req_id, as for the ops of a batch
+        :return: the response packet, or None
+        """
+        handler = self.commands.get(cmd.get("cmd"))
+        if handler is None:
+            print("Unknown command " + str(cmd.get("cmd")))
+            if cmd.get("req_id") is None and not errors:
+                return None
+            return {"cmd": "error", "msg": "ERROR - Unknown command " + str(cmd.get("cmd"))}
+
+        try:
+            return await handler(session, cmd)
+        except Exception as e:
+            traceback.print_exc()
+            if cmd.get("req_id") is None and not errors:
+                return None
+            return {"cmd": "error", "msg": "ERROR - " + repr(e)}
+
+    def add_session(self, session):
+        self.clients.setdefault(session.user_id, set()).add(session)
+
+    def remove_session(self, session):
+        sessions = self.clients.get(session.user_id)
+        if sessions is not None:
+            sessions.discard(session)
+            if len(sessions) == 0:
+                del self.clients[session.user_id]
+
+    def close_session(self, session):
+        """
+        Forgets a disconnected session and its subscriptions
+        :param session:
+        :return:
+        """
+        self.remove_session(session)
+        for database, key in session.subscriptions:
+            if key in database.data:
+                database.data[key].subs.discard(session)
+        session.subscriptions.clear()
+        for stream in session.streams.values():
+            stream.cancel()
+        session.uploads.clear()
+
+    def notify_subscribers(self, database, record):
+        """
+        Pushes a logged mutation to the sessions subscribed to the item
+        :param database:
+        :param record:
+        :return:
+        """
+        subs = database.data[record["key"]].subs
+        if not subs:
+            return
+
+        self.metrics.inc("aci_pushes_total", (("db", database.name),), len(subs))
+        data = dict(record, db_key=database.name)
+        packet = {"cmd": "event", "event_id": "key_changed", "db_key": database.name, "key": record["key"],
+                  "data": data, "origin": "server"}
+        for session in list(subs):
+            asyncio.ensure_future(self._push(session, packet))
+
+    async def _push(self, session, packet):
+        try:
+            await session.send(packet)
+        except websockets.ConnectionClosed:
+            pass
+
+    @command("hello")
+    async def _hello(self, session, cmd):
+        codec = negotiate(cmd.get("codecs", []))
+        # Answered in the old encoding, everything after it uses the new one
+        await self.send_response(session, cmd, {"cmd": "helloResp", "msg": codec.name})
+        session.codec = codec
+
+    @command("get_value", "get_val")
+    async def _get_value(self, session, cmd):
+        if cmd.get("watch"):
+            # Readers caching the value are told when it changes
+            await self._subscribe(session, cmd)
+        return self.get_response_packet(cmd["key"], cmd["db_key"], session.user)
+
+    @command("set_value", "set_val")
+    async def _set_value(self, session, cmd):
+        newValue = self.dbs[cmd["db_key"]].set(cmd["key"], cmd["val"], session.user)
+        return {"cmd": "setResp", "msg": str(cmd["db_key"]) + "[" + str(cmd["key"]) + "] = " + str(newValue)}
+
+    @command("increment", "incr")
+    async def _increment(self, session, cmd):
+        return {"cmd": "incrementResp",
+                "msg": self.dbs[cmd["db_key"]].increment(cmd["key"], cmd.get("amount", 1), session.user),
+                "key": cmd["key"], "db_key": cmd["db_key"]}
+
+    @command("decrement", "decr")
+    async def _decrement(self, session, cmd):
+        return {"cmd": "decrementResp",
+                "msg": self.dbs[cmd["db_key"]].decrement(cmd["key"], cmd.get("amount", 1), session.user),
+                "key": cmd["key"], "db_key": cmd["db_key"]}
+
+    @command("append_string")
+    async def _append_string(self, session, cmd):
+        return {"cmd": "append_stringResp",
+                "msg": self.dbs[cmd["db_key"]].append_string(cmd["key"], cmd["value"], session.user),
+                "key": cmd["key"], "db_key": cmd["db_key"]}
+
+    @command("compare_and_set", "cas")
+    async def _compare_and_set(self, session, cmd):
+        database = self.dbs[cmd["db_key"]]
+        swapped = database.compare_and_set(cmd["key"], cmd["val"], session.user, cmd.get("expected"),
+                                           cmd.get("by", "value"))
+        return {"cmd": "compare_and_setResp", "msg": swapped, "key": cmd["key"], "db_key": cmd["db_key"],
+                "ver": database.get_version(cmd["key"])}
+
+    @command("get_and_set")
+    async def _get_and_set(self, session, cmd):
+        return {"cmd": "get_and_setResp",
+                "msg": self.dbs[cmd["db_key"]].get_and_set(cmd["key"], cmd["val"], session.user),
+                "key": cmd["key"], "db_key": cmd["db_key"]}
+
+    @command("transaction")
+    async def _transaction(self, session, cmd):
+        result = self.dbs[cmd["db_key"]].transaction(cmd.get("reads", {}), cmd.get("writes", {}), session.user)
+        if isinstance(result, list):
+            return {"cmd": "transactionResp", "msg": "Conflict", "conflicts": result, "db_key": cmd["db_key"]}
+        return {"cmd": "transactionResp", "msg": result, "db_key": cmd["db_key"]}
+
+    @command("push_trim")
+    async def _push_trim(self, session, cmd):
+        return {"cmd": "push_trimResp",
+                "msg": self.dbs[cmd["db_key"]].push_trim(cmd["key"], cmd["value"], session.user, cmd.get("max_len"),
+                                                         cmd.get("expected_version")),
+                "key": cmd["key"], "db_key": cmd["db_key"]}
+
+    @command("get_index")
+    async def _get_index(self, session, cmd):
+        return {"cmd": "get_indexResp",
+                "msg": self.dbs[cmd["db_key"]].data[cmd["key"]].get_index(cmd["index"], session.user),
+                "key": cmd["key"], "db_key": cmd["db_key"]}
+
+    @command("set_index")
+    async def _set_index(self, session, cmd):
+        return {"cmd": "set_indexResp",
+                "msg": self.dbs[cmd["db_key"]].set_index(cmd["key"], cmd["index"], cmd["value"], session.user),
+                "key": cmd["key"], "db_key": cmd["db_key"]}
+
+    @command("append_list", "append_index")
+    async def _append_list(self, session, cmd):
+        return {"cmd": "app_indexResp",
+                "msg": self.dbs[cmd["db_key"]].append_index(cmd["key"], cmd["value"], session.user),
+                "key": cmd["key"], "db_key": cmd["db_key"]}
+
+    @command("get_list_length", "get_len_index")
+    async def _get_list_length(self, session, cmd):
+        return {"cmd": "get_len_indexResp",
+                "msg": self.dbs[cmd["db_key"]].data[cmd["key"]].get_len(session.user),
+                "key": cmd["key"], "db_key": cmd["db_key"]}
+
+    @command("get_recent", "get_recent_index")
+    async def _get_recent(self, session, cmd):
+        return {"cmd": "get_recent_indexResp",
+                "msg": self.dbs[cmd["db_key"]].data[cmd["key"]].get_recent(cmd["num"], session.user),
+                "key": cmd["key"], "db_key": cmd["db_key"]}
+
+    @command("create_series")
+    async def _create_series(self, session, cmd):
+        return {"cmd": "create_seriesResp",
+                "msg": self.dbs[cmd["db_key"]].create_series(cmd["key"], cmd["type"], session.user,
+                                                             cmd.get("capacity")),
+                "key": cmd["key"], "db_key": cmd["db_key"]}
+
+    @command("aggregate")
+    async def _aggregate(self, session, cmd):
+        return {"cmd": "aggregateResp",
+                "msg": self.dbs[cmd["db_key"]].data[cmd["key"]].aggregate(
+                    cmd["op"], session.user, cmd.get("window"), cmd.get("start"), cmd.get("stop"), cmd.get("since"),
+                    cmd.get("q"), cmd.get("bucket")),
+                "key": cmd["key"], "db_key": cmd["db_key"]}
+
+    @command("get_range")
+    async def _get_range(self, session, cmd):
+        return {"cmd": "get_rangeResp",
+                "msg": self.dbs[cmd["db_key"]].data[cmd["key"]].get_range(cmd.get("start"), cmd.get("stop"),
+                                                                           cmd.get("step"), session.user),
+                "key": cmd["key"], "db_key": cmd["db_key"]}
+
+    @command("stream_value")
+    async def _stream_value(self, session, cmd):
+        database = self.dbs[cmd["db_key"]]
+        if cmd["key"] not in database.data:
+            return {"cmd": "stream_end", "msg": "ERROR - key does not exist"}
+        item = database.data[cmd["key"]]
+        if not item.authenticate(session.user, "read"):
+            return {"cmd": "stream_end", "msg": "Access Denied"}
+
+        # Copying the list only copies references, the chunks are encoded one at a time as the client reads them
+        value = item.value.to_list() if isinstance(item.value, LIST_TYPES) else item.value
+        stream = session.streams[cmd["req_id"]] = StreamState(cmd.get("window", DEFAULT_WINDOW))
+        asyncio.ensure_future(self._send_stream(session, cmd, value, item.seq, stream))
+
+    async def _send_stream(self, session, cmd, value, version, stream):
+        """
+        Sends a value in chunks, waiting for the client to ack chunks once the window is full
+        :param session:
+        :param cmd:
+        :param value:
+        :param version:
+        :param stream:
+        :return:
+        """
+        seq = 0
+        try:
+            for chunk in split_chunks(value, max(int(cmd.get("chunk_size", DEFAULT_CHUNK_SIZE)), 1)):
+                await stream.wait_for_credit(seq)
+                if stream.cancelled:
+                    return
+                await session.send({"cmd": "stream_chunk", "req_id": cmd["req_id"], "seq": seq, "data": chunk})
+                seq += 1
+
+            await session.send({"cmd": "stream_end", "req_id": cmd["req_id"], "msg": "Success", "chunks": seq,
+                                "kind": chunk_kind(value), "ver": version})
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            session.streams.pop(cmd["req_id"], None)
+
+    @command("stream_ack")
+    async def _stream_ack(self, session, cmd):
+        stream = session.streams.get(cmd["stream_id"])
+        if stream is not None:
+            stream.ack(cmd["seq"])
+
+    @command("stream_cancel")
+    async def _stream_cancel(self, session, cmd):
+        stream = session.streams.get(cmd["stream_id"])
+        if stream is not None:
+            stream.cancel()
+
+    @command("upload_begin")
+    async def _upload_begin(self, session, cmd):
+        database = self.dbs[cmd["db_key"]]
+        if cmd["key"] in database.data and not database.data[cmd["key"]].authenticate(session.user, "write"):
+            return {"cmd": "upload_beginResp", "msg": "Access Denied"}
+
+        session.uploads[cmd["req_id"]] = UploadState(cmd["key"], cmd["kind"])
+        return {"cmd": "upload_beginResp", "msg": "Success", "upload_id": cmd["req_id"]}
+
+    @command("upload_chunk")
+    async def _upload_chunk(self, session, cmd):
+        upload = session.uploads.get(cmd["upload_id"])
+        if upload is None:
+            return {"cmd": "upload_chunkResp", "msg": "ERROR - unknown upload"}
+
+        upload.add(cmd["seq"], cmd["data"])
+        return {"cmd": "upload_chunkResp", "msg": "Success"}
+
+    @command("upload_end")
+    async def _upload_end(self, session, cmd):
+        upload = session.uploads.pop(cmd["upload_id"], None)
+        if upload is None:
+            return {"cmd": "upload_endResp", "msg": "ERROR - unknown upload"}
+
+        # The whole value is applied and logged as one write, a missing key is created owned by the uploader
+        result = self.dbs[cmd["db_key"]].store(upload.key, upload.value(), session.user)
+        return {"cmd": "upload_endResp", "msg": result, "key": upload.key, "db_key": cmd["db_key"]}
+
+    @command("batch")
+    async def _batch(self, session, cmd):
+        results = []
+        for op in cmd["ops"]:
+            op = dict(op, db_key=cmd["db_key"])
+            if op.get("cmd") in self.unbatchable_commands:
+                results.append("ERROR - Command " + str(op["cmd"]) + " is not allowed in a batch")
+                continue
+
+            started = time.perf_counter()
+            response = await self.dispatch(session, op, errors=True)
+            self.record_command(op, response, 0, time.perf_counter() - started)
+
+            if response is None:
+                results.append(None)
+            elif response["cmd"] == "getResp":
+                results.append(response["val"])
+            else:
+                results.append(response.get("msg"))
+
+        return {"cmd": "batchResp", "msg": results, "db_key": cmd["db_key"]}
+
+    @command("subscribe")
+    async def _subscribe(self, session, cmd):
+        database = self.dbs[cmd["db_key"]]
+        if cmd["key"] not in database.data:
+            msg = "ERROR - key does not exist"
+        elif not database.data[cmd["key"]].authenticate(session.user, "read"):
+            msg = "Access Denied"
+        else:
+            database.data[cmd["key"]].subs.add(session)
+            session.subscriptions.add((database, cmd["key"]))
+            msg = "Success"
+        return {"cmd": "subscribeResp", "msg": msg, "key": cmd["key"], "db_key": cmd["db_key"]}
+
+    @command("unsubscribe")
+    async def _unsubscribe(self, session, cmd):
+        database = self.dbs[cmd["db_key"]]
+        if (database, cmd["key"]) in session.subscriptions:
+            session.subscriptions.discard((database, cmd["key"]))
+            database.data[cmd["key"]].subs.discard(session)
+        return {"cmd": "unsubscribeResp", "msg": "Success", "key": cmd["key"], "db_key": cmd["db_key"]}
+
+    @command("event")
+    async def _event(self, session, cmd):
+        self.metrics.inc("aci_events_total")
+        for destination in list(self.clients.get(cmd["destination"], ())):
+            print("Sending event to " + cmd["destination"])
+            try:
+                await destination.send(cmd)
+            except Exception:
+                pass
+
+    @command("wtd")
+    async def _write_to_disk(self, session, cmd):
+        self.write_to_disk(cmd["db_key"])
+
+    @command("snapshot_status")
+    async def _snapshot_status(self, session, cmd):
+        db_keys = [cmd["db_key"]] if cmd.get("db_key") else list(self.dbs)
+        return {"cmd": "snapshot_statusResp",
+                "msg": {db_key: self.dbs[db_key].snapshot.status() if self.dbs[db_key].snapshot is not None else None
+                        for db_key in db_keys if db_key in self.dbs}}
+
+    @command("rfd")
+    async def _read_from_disk(self, session, cmd):
+        self.read_from_disk(cmd["db_key"])
+
+    @command("cdb")
+    async def _create_database(self, session, cmd):
+        self.open_database(cmd["db_key"], read=False, storage=self.storage)
+
+    @command("flush_stats")
+    async def _flush_stats(self, session, cmd):
+        return {"cmd": "flush_statsResp", "msg": self.flusher.stats()}
+
+    @command("stats")
+    async def _stats(self, session, cmd):
+        if cmd.get("format") == "prometheus":
+            return {"cmd": "statsResp", "msg": self.metrics.to_prometheus()}
+        if cmd.get("format") == "raw":
+            return {"cmd": "statsResp", "msg": self.metrics.export()}
+        return {"cmd": "statsResp", "msg": self.metrics.snapshot()}
+
+    @command("list_databases")
+    async def _list_databases(self, session, cmd):
+        return {"cmd": "ldResp",
+                "msg": json.dumps(list(self.dbs[cmd["db_key"]].data.keys()))}
+
+    @command("g_auth")
+    async def _g_auth(self, session, cmd):
+        print("Starting Google Auth")
+        try:
+            token = cmd["id_token"]
+            # Specify the CLIENT_ID of the app that accesses the backend:
+            idinfo = id_token.verify_oauth2_token(token, requests.Request())
+
+            # Or, if multiple clients access the backend server:
+            # idinfo = id_token.verify_oauth2_token(token, requests.Request())
+            # if idinfo['aud'] not in [CLIENT_ID_1, CLIENT_ID_2, CLIENT_ID_3]:
+            #     raise ValueError('Could not verify audience.')
+
+            if idinfo['iss'] not in ['accounts.google.com', 'https://accounts.google.com']:
+                raise ValueError('Wrong issuer.')
+
+            # If auth request is from a G Suite domain:
+            GSUITE_DOMAIN_NAME = "scienceandpizza.com"
+            if idinfo['hd'] != GSUITE_DOMAIN_NAME:
+                raise ValueError('Wrong hosted domain.')
+
+            # ID token is valid. Get the user's Google Account ID from the decoded token.
+            userid = idinfo['sub']
+            print(idinfo["email"] + " Authentication Complete")
+            self.remove_session(session)
+            session.authenticate(token, "g_user", idinfo["email"])
+            self.add_session(session)
+        except ValueError:
+            traceback.print_exc()
+            print("Invalid Token")
+            print(cmd["id_token"])
+            # Invalid token
+            pass
+
+    @command("a_auth")
+    async def _a_auth(self, session, cmd):
+        a_users = self.dbs["config"].get("a_users", "backend")
+        if cmd["id"] in a_users:
+            if cmd["token"] in a_users[cmd["id"]]["tokens"]:
+                self.remove_session(session)
+                session.authenticate(cmd["id"], "a_user", cmd["id"])
+                self.add_session(session)
+                return {"cmd": "a_auth_response", "msg": "success"}
+            else:
+                return {"cmd": "a_auth_response", "msg": "Failed, token incorrect"}
+        else:
+            return {"cmd": "a_auth_response", "msg": "Failed, a_user not found"}
+
+    async def send_response(self, session, cmd, response):
+        """
+        Sends a response packet, echoing the request id of the command it answers
+        :param session:
+        :param cmd:
+        :param response:
+        :return:
+        """
+        response["req_id"] = cmd.get("req_id")
+        await session.send(response)
 
     def get_response_packet(self, key, db_key, user):
-        return json.dumps({"cmd": "getResp", "key": key, "val": self.dbs[db_key].get(key, user), "db_key": db_key})
+        return {"cmd": "getResp", "key": key, "val": self.dbs[db_key].get(key, user), "db_key": db_key,
+                "ver": self.dbs[db_key].get_version(key)}
 
     def write_to_disk(self, db_key):
+        """
+        Starts a background snapshot of a database, or of every database for an empty db_key
+
+        Commands keep being answered while the snapshot is serialized, snapshot_status reports its progress.
+        :param db_key:
+        :return:
+        """
         if db_key != "":
-            self.dbs[db_key].write_to_disk()
+            self.dbs[db_key].start_snapshot(self.loop.call_soon_threadsafe)
         else:
             for db in self.dbs:
-                self.dbs[db].write_to_disk()
+                self.dbs[db].start_snapshot(self.loop.call_soon_threadsafe)
     
     def read_from_disk(self, db_key):
-        self.dbs[db_key] = Database(db_key, read=True, root_dir=self.rootDir)
+        self.open_database(db_key, read=True)
+
+    def open_database(self, db_key, read, storage=None):
+        if db_key in self.dbs:
+            self.dbs[db_key].close()
+        database = Database(db_key, read=read, root_dir=self.rootDir, flusher=self.flusher, cache=self.item_cache,
+                            storage=storage, metrics=self.metrics)
+        database.listeners.append(self.notify_subscribers)
+        self.dbs[db_key] = database
+        return database
+
+    def trace_log_path(self):
+        return self.dbs["config"].get("trace_log", "backend") or self.rootDir + "trace.log"
+
+    def configure_tracing(self):
+        """
+        Sets up the slow command log when the config has a trace_threshold, in seconds
+
+        trace_sample_interval additionally samples the event loop's stack every that many seconds, logging the most
+        frequent stacks and any stall longer than trace_stall_threshold.
+        :return:
+        """
+        config = self.dbs["config"]
+        threshold = config.get("trace_threshold", "backend")
+        if threshold is None:
+            return
+
+        if self.tracer is not None:
+            self.tracer.close()
+        self.tracer = Tracer(float(threshold), self.trace_log_path(),
+                             sample_interval=config.get("trace_sample_interval", "backend"),
+                             stall_threshold=float(config.get("trace_stall_threshold", "backend") or 1.0))
+        # load_config runs on the loop's thread
+        self.tracer.start_sampling(self.loop)
+        print("Tracing commands slower than %ss to %s" % (threshold, self.trace_log_path()))
 
     def load_config(self):
         try:
@@ -189,6 +748,12 @@ class Server:
             self.port = self.dbs["config"].get("port", "backend")
             self.ip = self.dbs["config"].get("ip", "backend")
             self.rootDir = self.dbs["config"].get("rootDir", "backend")
+            self.flusher.configure(self.dbs["config"].get("flush_mode", "backend"),
+                                   self.dbs["config"].get("flush_interval", "backend"))
+            self.item_cache.budget = self.dbs["config"].get("memory_budget", "backend")
+            self.storage = self.dbs["config"].get("storage", "backend")
+            self.metrics_port = self.dbs["config"].get("metrics_port", "backend")
+            self.configure_tracing()
             for db in self.dbs["config"].get("dbs", "backend"):
                 self.read_from_disk(db)
             print("Config read complete")
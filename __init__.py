@@ -1,6 +1,7 @@
 from ACIpy.ACI import async_create, create, stop, run
 from ACIpy.ACIConnection import *
 from ACIpy.ACIServer import *
+from ACIpy.sharding import ShardedServer
 from ACIpy.errors import *
 from ACIpy.database import *
 
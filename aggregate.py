@@ -0,0 +1,91 @@
+import array
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+AGGREGATE_OPS = ("sum", "mean", "min", "max", "count", "percentile")
+
+
+def to_numbers(values):
+    """
+    Gets the values as a float64 or int64 array, which numpy reads without copying
+
+    :param values: array or list of numbers
+    :return: array
+    """
+    if isinstance(values, array.array):
+        return values
+    return array.array("d", values)
+
+
+def aggregate(values, op, q=None):
+    """
+    Reduces numbers to a single value, vectorized with numpy when it is installed
+
+    :param values: array of numbers
+    :param op: one of AGGREGATE_OPS
+    :param q: percentile from 0 to 100, for the percentile op
+    :return: the number, or None for an empty selection where the op has no value
+    """
+    if op not in AGGREGATE_OPS:
+        raise ValueError("Unknown aggregate " + str(op))
+    if op == "count":
+        return len(values)
+    if len(values) == 0:
+        return 0 if op == "sum" else None
+    if op == "percentile" and q is None:
+        raise ValueError("The percentile aggregate needs q")
+
+    if numpy is not None:
+        data = numpy.frombuffer(values, dtype=numpy.int64 if values.typecode == "q" else numpy.float64)
+        if op == "percentile":
+            return numpy.percentile(data, float(q)).item()
+        return getattr(numpy, op)(data).item()
+
+    if op == "sum":
+        return math.fsum(values) if values.typecode == "d" else sum(values)
+    if op == "mean":
+        return math.fsum(values) / len(values)
+    if op == "min":
+        return min(values)
+    if op == "max":
+        return max(values)
+    return _percentile(sorted(values), float(q))
+
+
+def _percentile(ordered, q):
+    # Linear interpolation between the closest ranks, as numpy does by default
+    rank = (len(ordered) - 1) * q / 100.0
+    lower = math.floor(rank)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (rank - lower)
+
+
+def downsample(values, op, bucket, q=None):
+    """
+    Aggregates consecutive buckets of numbers, the last bucket may be partial
+
+    :param values: array of numbers
+    :param op: one of AGGREGATE_OPS
+    :param bucket: numbers per bucket
+    :param q: percentile from 0 to 100, for the percentile op
+    :return: list with one aggregate per bucket
+    """
+    bucket = int(bucket)
+    if bucket < 1:
+        raise ValueError("Buckets hold at least one value")
+
+    full = len(values) // bucket * bucket
+    if numpy is not None and full > 0 and op not in ("count", "percentile"):
+        data = numpy.frombuffer(values, dtype=numpy.int64 if values.typecode == "q" else numpy.float64)
+        results = getattr(numpy, op)(data[:full].reshape(-1, bucket), axis=1).tolist()
+    else:
+        results = [aggregate(values[start:start + bucket], op, q) for start in range(0, full, bucket)]
+
+    if full < len(values):
+        results.append(aggregate(values[full:], op, q))
+    return results
@@ -0,0 +1,280 @@
+import argparse
+import asyncio
+import contextlib
+import json
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    from ACIServer import Server
+    from ACIConnection import Connection, event_callback
+    from database import Database
+    from codec import available_codecs
+except Exception:
+    from ACIpy.ACIServer import Server
+    from ACIpy.ACIConnection import Connection, event_callback
+    from ACIpy.database import Database
+    from ACIpy.codec import available_codecs
+
+
+SCENARIOS = ("get", "set", "set_noack", "append", "get_recent", "events", "auth")
+BENCH_DB = "bench"
+TOKEN = "bench-token"
+
+
+def make_root(root_dir, ip, port, connections):
+    """
+    Writes the config and benchmark databases of a throwaway Server
+
+    :param root_dir:
+    :param ip:
+    :param port:
+    :param connections: number of benchmark users to create
+    :return:
+    """
+    users = {"bench%i" % index: {"tokens": [TOKEN]} for index in range(connections)}
+    config = Database("config", read=False, root_dir=root_dir)
+    for key, value in (("port", port), ("ip", ip), ("rootDir", root_dir), ("dbs", [BENCH_DB]), ("a_users", users)):
+        config.set(key, value, "backend")
+    config.write_to_disk()
+    config.close()
+
+    bench = Database(BENCH_DB, read=False, root_dir=root_dir)
+    for index in range(connections):
+        bench.set("value%i" % index, "", "backend")
+        bench.set("list%i" % index, [], "backend")
+    for key in bench.data.keys():
+        bench.data[key].permissions = {"read": [["a_user", "authed"]], "write": [["a_user", "authed"]]}
+    bench.write_to_disk()
+    bench.close()
+
+
+def percentile(ordered, q):
+    """
+    Nearest rank percentile of sorted numbers
+
+    :param ordered:
+    :param q: from 0 to 100
+    :return:
+    """
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, max(0, int(round(q / 100.0 * len(ordered) + 0.5)) - 1))]
+
+
+def summarize(latencies, ops, seconds):
+    latencies = sorted(latencies)
+    return {"ops": ops,
+            "seconds": round(seconds, 6),
+            "throughput": round(ops / seconds, 2) if seconds > 0 else None,
+            "latency_ms": {"mean": round(sum(latencies) / len(latencies) * 1000, 4) if latencies else None,
+                           "p50": _ms(percentile(latencies, 50)),
+                           "p99": _ms(percentile(latencies, 99)),
+                           "p999": _ms(percentile(latencies, 99.9)),
+                           "max": _ms(latencies[-1] if latencies else None)}}
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 4)
+
+
+class Benchmark:
+    """
+        Drives a local Server with concurrent Connections and measures each scenario
+    """
+    def __init__(self, connections=4, ops=1000, value_sizes=(100,), scenarios=SCENARIOS, ip="127.0.0.1", port=8790,
+                 codecs=None, recent=100):
+        self.connection_count = connections
+        self.ops = ops
+        self.value_sizes = value_sizes
+        self.scenarios = scenarios
+        self.ip = ip
+        self.port = port
+        self.codecs = codecs
+        self.recent = recent
+
+        self.connections = []
+        self.server = None
+        self.root_dir = None
+
+    def start_server(self):
+        self.root_dir = tempfile.mkdtemp(prefix="aci-bench-") + "/"
+        make_root(self.root_dir, self.ip, self.port, self.connection_count)
+
+        self.server = Server(asyncio.new_event_loop(), self.ip, self.port)
+        self.server.rootDir = self.root_dir
+        threading.Thread(target=self.server.start, daemon=True).start()
+
+    async def connect(self):
+        for index in range(self.connection_count):
+            connection = Connection(asyncio.get_running_loop(), self.ip, self.port, "bench%i" % index,
+                                    codecs=self.codecs)
+            asyncio.ensure_future(connection.start())
+            self.connections.append(connection)
+
+        deadline = time.monotonic() + 10
+        for connection in self.connections:
+            while connection._ready is None or not connection._ready.is_set():
+                if time.monotonic() > deadline:
+                    raise RuntimeError("Could not connect to the benchmark Server on port %i" % self.port)
+                await asyncio.sleep(0.01)
+            response = await connection.authenticate(connection.name, TOKEN)
+            if response != "success":
+                raise RuntimeError("Benchmark user %s could not authenticate: %s" % (connection.name, response))
+
+    async def run(self):
+        """
+        Runs every scenario at every value size
+
+        :return: the report
+        """
+        self.start_server()
+        try:
+            await self.connect()
+            results = {}
+            for scenario in self.scenarios:
+                sizes = self.value_sizes if scenario in ("get", "set", "set_noack", "append", "events") else [None]
+                for size in sizes:
+                    name = scenario if size is None else "%s/%i" % (scenario, size)
+                    results[name] = await getattr(self, "_bench_" + scenario)(size)
+                    print("%-20s %s" % (name, json.dumps(results[name])), file=sys.stderr)
+        finally:
+            for connection in self.connections:
+                await connection.close()
+            shutil.rmtree(self.root_dir, ignore_errors=True)
+
+        return {"version": 1,
+                "config": {"connections": self.connection_count, "ops": self.ops, "value_sizes": list(self.value_sizes),
+                           "codec": self.connections[0].codec.name if self.connections else None,
+                           "flush_mode": self.server.flusher.mode, "python": sys.version.split()[0]},
+                "results": results}
+
+    async def _measure(self, operation):
+        """
+        Runs an operation ops times on every connection at once
+
+        :param operation: coroutine function of (index, connection, interface, n)
+        :return: the summary
+        """
+        latencies = []
+
+        async def worker(index, connection):
+            interface = connection[BENCH_DB]
+            for n in range(self.ops):
+                started = time.perf_counter()
+                await operation(index, connection, interface, n)
+                latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*[worker(index, connection) for index, connection in enumerate(self.connections)])
+        return summarize(latencies, len(latencies), time.perf_counter() - started)
+
+    async def _bench_get(self, size):
+        await asyncio.gather(*[connection[BENCH_DB].set_value("value%i" % index, "x" * size)
+                               for index, connection in enumerate(self.connections)])
+        return await self._measure(lambda index, connection, interface, n: interface.get_value("value%i" % index))
+
+    async def _bench_set(self, size):
+        value = "x" * size
+        return await self._measure(lambda index, connection, interface, n: interface.set_value("value%i" % index,
+                                                                                              value))
+
+    async def _bench_set_noack(self, size):
+        value = "x" * size
+        summary = await self._measure(lambda index, connection, interface, n:
+                                      interface.set_value_noack("value%i" % index, value))
+        # The sends only queue the writes, the time until the Server has applied them all is what counts
+        started = time.perf_counter()
+        await asyncio.gather(*[connection[BENCH_DB].get_value("value%i" % index)
+                               for index, connection in enumerate(self.connections)])
+        summary["seconds"] = round(summary["seconds"] + time.perf_counter() - started, 6)
+        summary["throughput"] = round(summary["ops"] / summary["seconds"], 2)
+        return summary
+
+    async def _bench_append(self, size):
+        value = list(range(max(size // 8, 1)))
+        return await self._measure(lambda index, connection, interface, n: interface.append_index("list%i" % index,
+                                                                                                 value))
+
+    async def _bench_get_recent(self, size):
+        for index, connection in enumerate(self.connections):
+            await connection[BENCH_DB].append_index("list%i" % index, list(range(self.recent)))
+        return await self._measure(lambda index, connection, interface, n:
+                                   interface.get_recent_index("list%i" % index, self.recent))
+
+    async def _bench_events(self, size):
+        """
+        Each connection sends events to the next one, latency is measured from sending to delivery
+
+        :param size:
+        :return:
+        """
+        latencies = []
+        expected = self.ops * len(self.connections)
+        delivered = asyncio.Event()
+
+        def received(cmd):
+            latencies.append(time.perf_counter() - cmd["data"]["sent"])
+            if len(latencies) >= expected:
+                delivered.set()
+
+        # Callbacks of every connection in the process run for each event, so one is enough
+        callback = event_callback("bench_event", received)
+        self.connections[0].add_event_callback(callback)
+        payload = "x" * size
+
+        async def sender(index, connection):
+            destination = "bench%i" % ((index + 1) % len(self.connections))
+            for _ in range(self.ops):
+                await connection.send_event(destination, "bench_event", {"sent": time.perf_counter(),
+                                                                         "payload": payload})
+
+        started = time.perf_counter()
+        await asyncio.gather(*[sender(index, connection) for index, connection in enumerate(self.connections)])
+        try:
+            await asyncio.wait_for(delivered.wait(), 30)
+        except asyncio.TimeoutError:
+            pass
+        seconds = time.perf_counter() - started
+        self.connections[0].event_callbacks.remove(callback)
+
+        summary = summarize(latencies, len(latencies), seconds)
+        summary["lost"] = expected - len(latencies)
+        return summary
+
+    async def _bench_auth(self, size):
+        return await self._measure(lambda index, connection, interface, n: connection.authenticate(connection.name,
+                                                                                                  TOKEN))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks an ACI Server and its clients on a temporary database")
+    parser.add_argument("--connections", type=int, default=4, help="concurrent client connections")
+    parser.add_argument("--ops", type=int, default=1000, help="operations per connection and scenario")
+    parser.add_argument("--value-sizes", type=int, nargs="+", default=[100], help="value sizes in bytes")
+    parser.add_argument("--scenarios", nargs="+", default=list(SCENARIOS), choices=SCENARIOS)
+    parser.add_argument("--ip", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8790)
+    parser.add_argument("--codec", choices=available_codecs(), help="wire encoding, defaults to the best available")
+    parser.add_argument("--recent", type=int, default=100, help="elements read by get_recent")
+    parser.add_argument("--output", help="file to write the JSON report to, defaults to stdout")
+    args = parser.parse_args(argv)
+
+    benchmark = Benchmark(args.connections, args.ops, args.value_sizes, args.scenarios, args.ip, args.port,
+                          [args.codec] if args.codec else None, args.recent)
+    # The Server and clients log to stdout, which is kept for the report
+    with contextlib.redirect_stdout(sys.stderr):
+        report = asyncio.run(benchmark.run())
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,250 @@
+import array
+import json
+import struct
+import sys
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class JSONCodec:
+    """
+        Text frames of json, understood by every client and the fallback when nothing else is agreed on
+    """
+    name = "json"
+
+    def encode(self, packet):
+        return json.dumps(packet, default=_json_default)
+
+    def decode(self, raw):
+        return json.loads(raw)
+
+
+def _json_default(value):
+    if isinstance(value, array.array):
+        return value.tolist()
+    raise TypeError("Can not serialize " + type(value).__name__)
+
+
+class MsgPackCodec:
+    """
+        Binary frames of MessagePack, only offered when the msgpack package is installed
+    """
+    name = "msgpack"
+
+    def encode(self, packet):
+        return msgpack.packb(packet, use_bin_type=True, default=_msgpack_default)
+
+    def decode(self, raw):
+        return msgpack.unpackb(raw, raw=False, strict_map_key=False)
+
+
+def _msgpack_default(value):
+    if isinstance(value, array.array):
+        return value.tolist()
+    raise TypeError("Can not serialize " + type(value).__name__)
+
+
+# Tags of the values in a BinaryCodec frame
+_NONE = b"N"
+_TRUE = b"T"
+_FALSE = b"F"
+_INT = b"i"
+_BIG_INT = b"I"
+_FLOAT = b"d"
+_STR = b"s"
+_BYTES = b"b"
+_LIST = b"l"
+_DICT = b"m"
+_ARRAY = b"a"
+
+_INT64 = struct.Struct("<q")
+_FLOAT64 = struct.Struct("<d")
+_LENGTH = struct.Struct("<I")
+_INT64_MIN = -2 ** 63
+_INT64_MAX = 2 ** 63 - 1
+
+
+class BinaryCodec:
+    """
+        Built in struct based binary frames, numeric lists are sent as packed little endian arrays
+    """
+    name = "aci-binary"
+
+    def encode(self, packet):
+        out = bytearray()
+        self._encode(packet, out)
+        return bytes(out)
+
+    def decode(self, raw):
+        value, _ = self._decode(memoryview(raw), 0)
+        return value
+
+    def _encode(self, value, out):
+        if value is None:
+            out += _NONE
+        elif value is True:
+            out += _TRUE
+        elif value is False:
+            out += _FALSE
+        elif isinstance(value, int):
+            if _INT64_MIN <= value <= _INT64_MAX:
+                out += _INT
+                out += _INT64.pack(value)
+            else:
+                self._encode_sized(_BIG_INT, str(value).encode(), out)
+        elif isinstance(value, float):
+            out += _FLOAT
+            out += _FLOAT64.pack(value)
+        elif isinstance(value, str):
+            self._encode_sized(_STR, value.encode(), out)
+        elif isinstance(value, (bytes, bytearray)):
+            self._encode_sized(_BYTES, value, out)
+        elif isinstance(value, array.array):
+            self._encode_array(value, out)
+        elif isinstance(value, (list, tuple)):
+            typecode = _numeric_typecode(value)
+            if typecode is not None:
+                self._encode_array(array.array(typecode, value), out)
+            else:
+                out += _LIST
+                out += _LENGTH.pack(len(value))
+                for element in value:
+                    self._encode(element, out)
+        elif isinstance(value, dict):
+            out += _DICT
+            out += _LENGTH.pack(len(value))
+            for key in value:
+                self._encode(key, out)
+                self._encode(value[key], out)
+        else:
+            raise TypeError("Can not serialize " + type(value).__name__)
+
+    def _encode_sized(self, tag, data, out):
+        out += tag
+        out += _LENGTH.pack(len(data))
+        out += data
+
+    def _encode_array(self, values, out):
+        if values.typecode not in ("q", "d"):
+            values = array.array("d" if values.typecode in ("f", "d") else "q", values)
+        if sys.byteorder != "little":
+            values = array.array(values.typecode, values)
+            values.byteswap()
+        out += _ARRAY
+        out += values.typecode.encode()
+        out += _LENGTH.pack(len(values))
+        out += values.tobytes()
+
+    def _decode(self, data, offset):
+        tag = bytes(data[offset:offset + 1])
+        offset += 1
+
+        if tag == _NONE:
+            return None, offset
+        if tag == _TRUE:
+            return True, offset
+        if tag == _FALSE:
+            return False, offset
+        if tag == _INT:
+            return _INT64.unpack_from(data, offset)[0], offset + _INT64.size
+        if tag == _FLOAT:
+            return _FLOAT64.unpack_from(data, offset)[0], offset + _FLOAT64.size
+        if tag in (_STR, _BYTES, _BIG_INT):
+            length = _LENGTH.unpack_from(data, offset)[0]
+            offset += _LENGTH.size
+            raw = bytes(data[offset:offset + length])
+            if tag == _STR:
+                raw = raw.decode()
+            elif tag == _BIG_INT:
+                raw = int(raw)
+            return raw, offset + length
+        if tag == _LIST:
+            length = _LENGTH.unpack_from(data, offset)[0]
+            offset += _LENGTH.size
+            values = []
+            for _ in range(length):
+                value, offset = self._decode(data, offset)
+                values.append(value)
+            return values, offset
+        if tag == _DICT:
+            length = _LENGTH.unpack_from(data, offset)[0]
+            offset += _LENGTH.size
+            values = {}
+            for _ in range(length):
+                key, offset = self._decode(data, offset)
+                values[key], offset = self._decode(data, offset)
+            return values, offset
+        if tag == _ARRAY:
+            typecode = bytes(data[offset:offset + 1]).decode()
+            length = _LENGTH.unpack_from(data, offset + 1)[0]
+            offset += 1 + _LENGTH.size
+            values = array.array(typecode)
+            end = offset + length * values.itemsize
+            values.frombytes(data[offset:end])
+            if sys.byteorder != "little":
+                values.byteswap()
+            return values.tolist(), end
+
+        raise ValueError("Unknown value tag %r" % tag)
+
+
+def _numeric_typecode(values):
+    """
+    Gets the array typecode able to hold every element of a list, or None if it is not purely numeric
+
+    :param values:
+    :return:
+    """
+    if len(values) == 0:
+        return None
+
+    kind = type(values[0])
+    if kind is float:
+        return "d" if all(type(value) is float for value in values) else None
+    if kind is int:
+        if all(type(value) is int and _INT64_MIN <= value <= _INT64_MAX for value in values):
+            return "q"
+    return None
+
+
+CODECS = {codec.name: codec for codec in (JSONCodec(), BinaryCodec())}
+if msgpack is not None:
+    CODECS[MsgPackCodec.name] = MsgPackCodec()
+
+
+def available_codecs():
+    """
+    Gets the names of the codecs usable in this process, most preferred first
+
+    :return:
+    """
+    return [name for name in ("msgpack", "aci-binary", "json") if name in CODECS]
+
+
+def negotiate(offered):
+    """
+    Picks the first offered codec usable in this process
+
+    :param offered: codec names in the peer's order of preference
+    :return: the codec
+    """
+    for name in offered:
+        if name in CODECS:
+            return CODECS[name]
+    return CODECS["json"]
+
+
+def decode_frame(codec, raw):
+    """
+    Decodes a websocket frame, text frames are always json
+
+    :param codec:
+    :param raw:
+    :return:
+    """
+    if isinstance(raw, str):
+        return json.loads(raw)
+    return codec.decode(raw)
@@ -1,39 +1,154 @@
 import json
 import os
+import threading
+import time
 import traceback
+from collections import OrderedDict
+
+try:
+    from wal import WriteAheadLog
+    from ringbuffer import RingBuffer
+    from packed import PackedStorage
+    from permissions import compile_permissions
+    from series import Series, SERIES_TYPES
+    from aggregate import aggregate, downsample, to_numbers
+    from tracing import current_trace
+    from snapshot import Snapshot
+except Exception:
+    from ACIpy.wal import WriteAheadLog
+    from ACIpy.ringbuffer import RingBuffer
+    from ACIpy.packed import PackedStorage
+    from ACIpy.permissions import compile_permissions
+    from ACIpy.series import Series, SERIES_TYPES
+    from ACIpy.aggregate import aggregate, downsample, to_numbers
+    from ACIpy.tracing import current_trace
+    from ACIpy.snapshot import Snapshot
 
 
 ACIVersion = "2020.07.01.1"
 
+# Values of list items, readable and writable by index
+LIST_TYPES = (RingBuffer, Series)
+# Number of elements list items keep by default
+DEFAULT_MAX_LEN = 100000
+
+
+def _number(value):
+    """
+    Reads a number sent by a client, text clients send them json encoded
+
+    :param value:
+    :return: int or float
+    """
+    if isinstance(value, str):
+        try:
+            value = json.loads(value)
+        except ValueError:
+            pass
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError("not a number: " + repr(value))
+    return value
+
+
+def _unpack(record):
+    """
+    Splits a logged transaction into the set of each key it wrote, or the creation of each key it created
+
+    :param record:
+    :return: list of records changing a single key
+    """
+    if record["op"] != "txn":
+        return [record]
+
+    changes = []
+    for key in record["writes"]:
+        if key in record.get("creates", {}):
+            changes.append(dict(record["creates"][key], op="create", key=key, value=record["writes"][key],
+                                seq=record.get("seq")))
+        else:
+            changes.append({"op": "set", "key": key, "value": record["writes"][key], "seq": record.get("seq")})
+    return changes
+
+
 class Item:
-    def __init__(self, key, value, owner, read=False, root_dir="./", read_db="", type="string"):
+    def __init__(self, key, value, owner, read=False, root_dir="./", read_db="", type="string", permissions=None):
         self.key = key
-        self.value = value
         self.owner = owner
-        self.subs = []
+        # Sessions subscribed to changes of this item, only held in memory
+        self.subs = set()
         self.root_dir = root_dir
-        self.permissions = {}
+        self.permissions = permissions if permissions is not None else {}
         self.type = type
         self.ver = ACIVersion
-        self.maxLen = 100000
+        self.maxLen = DEFAULT_MAX_LEN
+        # Sequence number of the last write-ahead log record applied to this item
+        self.seq = 0
+        # Approximate memory footprint in bytes, measured from the serialized item
+        self.size = 0
+        self.value = self._coerce_value(value)
 
         if read:
             self.read_from_disk(read_db)
+
+    def _coerce_value(self, value):
+        """
+        Stores list values in a RingBuffer holding at most maxLen elements, or a Series for typed items
+
+        :param value:
+        :return: the value to store
+        """
+        if self.type in SERIES_TYPES:
+            series = Series.from_value(self.type, self.maxLen, value)
+            self.maxLen = series.capacity
+            return series
+        if isinstance(value, RingBuffer):
+            self.type = "list"
+            return value
+        if isinstance(value, list):
+            self.type = "list"
+            return RingBuffer(self.maxLen, value)
+        if self.type == "list":
+            self.type = "string"
+        return value
+
+    def serialize_value(self):
+        """
+        Gets the value in its on-disk and wire format
+
+        :return:
+        """
+        if isinstance(self.value, RingBuffer):
+            return self.value.to_list()
+        if isinstance(self.value, Series):
+            return self.value.to_wire()
+        return self.value
     
     def get_val(self, user):
         hasPermission = self.authenticate(user, "read")
 
         if hasPermission == True:
-            return self.value
+            return self.serialize_value()
         else:
             return "Access Denied: Your User ID is not listed in the item permissions table."
 
+    def prepare_value(self, value):
+        """
+        Converts a value to the form set_val stores, without changing the item
+
+        :param value:
+        :return: the value to pass to set_val
+        :raises ValueError: if the item can not hold the value
+        """
+        if self.type in SERIES_TYPES:
+            return Series.from_value(self.type, self.maxLen, value)
+        return value
+
     def set_val(self, value, user):
         hasPermission = self.authenticate(user, "write")
 
         if hasPermission:
-            self.value = value
-            return self.value
+            self.value = self._coerce_value(value)
+            return self.serialize_value()
         else:
             return "Access Denied: Your User ID is not listed in the item permissions table."
 
@@ -48,44 +163,45 @@ class Item:
             else:
                 indexs = index
 
-            table = self.get_val(user)
-            if isinstance(table, list):
+            table = self.value
+            if isinstance(table, LIST_TYPES):
                 values = {}
                 for x in range(len(indexs)):
                     values[int(indexs[x])] = table[int(indexs[x])]
                     
                 return values
             else:
-                return "ERROR - " + table
+                return "ERROR - " + str(table)
         else:
             return "Access Denied"
              
     
     def set_index(self, index, value, user):
         if self.authenticate(user, "write"):
+            # Json encoded strings from text clients, binary clients send the values themselves
             try:
-                index = json.loads(index)
-                value = json.loads(value)
-            except Exception as e:
-                tb_str = traceback.format_exception(etype=type(e), value=e, tb=e.__traceback__)
-                print(tb_str)
+                if isinstance(index, str):
+                    index = json.loads(index)
+                if isinstance(value, str):
+                    value = json.loads(value)
+            except Exception:
+                traceback.print_exc()
                 return "ERROR - Failed to read command ind(ex/ices) and value(s)"
             if not isinstance(index, list):
                 indexs = [index]
-                values = {int(index):value}
+                values = {str(index):value}
             else:
                 indexs = index
-                values = value
+                values = {str(key):value[key] for key in value}
 
-            table = self.get_val(user)
-            if isinstance(table, list):
+            table = self.value
+            if isinstance(table, LIST_TYPES):
                 for x in range(len(indexs)):
                     if (int(indexs[x]) < len(table)):
                         table[int(indexs[x])] = values[str(indexs[x])]
                     else:
                         return "ERROR - index does not exist"
 
-                self.set_val(table, user)
                 return "Success"
             else:
                 return "ERROR"
@@ -99,31 +215,98 @@ class Item:
             else:
                 values = value
 
-            table = self.get_val(user)
-            if isinstance(table, list):
-                for x in range(len(values)):
-                    table.append(values[x])
-                
-                if len(table) > self.maxLen:
-                    while len(table) > self.maxLen:
-                        table.pop(0)
-
-                self.set_val(table, user)
+            table = self.value
+            if isinstance(table, LIST_TYPES):
+                # The ring buffer evicts the oldest elements past maxLen
+                table.extend(values)
                 return "Success"
             else:
                 return "ERROR"
         else:
             return "Access Denied"
 
+    def get_range(self, start, stop, step, user):
+        """
+        Reads a slice of a list item, negative bounds count back from the end like a python slice
+
+        :param start:
+        :param stop:
+        :param step:
+        :param user:
+        :return: list of the elements in the slice
+        """
+        if self.authenticate(user, "read"):
+            table = self.value
+            if not isinstance(table, LIST_TYPES):
+                return "ERROR - " + str(self.key) + " is not a list"
+
+            start, stop, step = [None if bound is None else int(bound) for bound in (start, stop, step)]
+            if step == 0:
+                return "ERROR - slice step cannot be zero"
+            return table.slice(start, stop, step)
+        else:
+            return "Access Denied"
+
+    def aggregate(self, op, user, window=None, start=None, stop=None, since=None, q=None, bucket=None):
+        """
+        Computes an aggregate of a list of numbers without sending the list
+
+        :param op: sum, mean, min, max, count or percentile
+        :param user:
+        :param window: only the newest window elements
+        :param start: first index, negative indexes count back from the end
+        :param stop: index after the last one
+        :param since: only timeseries elements from the last since seconds
+        :param q: percentile from 0 to 100
+        :param bucket: downsample, returning one aggregate per bucket elements instead of a single number
+        :return: the number, or a list, of [timestamp, number] pairs for a timeseries
+        """
+        if not self.authenticate(user, "read"):
+            return "Access Denied"
+
+        table = self.value
+        if not isinstance(table, LIST_TYPES):
+            return "ERROR - " + str(self.key) + " is not a list"
+
+        try:
+            lower, upper, _ = slice(None if start is None else int(start),
+                                    None if stop is None else int(stop)).indices(len(table))
+            if window is not None:
+                lower = max(lower, upper - int(window))
+            if since is not None:
+                if self.type != "timeseries":
+                    return "ERROR - since needs a timeseries"
+                lower = max(lower, table.index_at(time.time() - float(since)))
+            upper = max(lower, upper)
+
+            if isinstance(table, Series):
+                values = table.values(lower, upper)
+            else:
+                values = to_numbers(table.slice(lower, upper))
+
+            if bucket is None:
+                return aggregate(values, op, q)
+
+            results = downsample(values, op, bucket, q)
+            if self.type == "timeseries":
+                # Each bucket is stamped with the time of its first element
+                stamps = table.timestamps(lower, upper)[::int(bucket)]
+                return [[stamp, result] for stamp, result in zip(stamps, results)]
+            return results
+        except (ValueError, TypeError) as e:
+            return "ERROR - " + str(e)
+
     def get_len(self, user):
         if self.authenticate(user, "read"):
-            table = self.get_val(user)
-            return len(table)
+            return len(self.value)
 
     def get_recent(self, num, user):
         num = int(num)
         if self.authenticate(user, "read"):
-            table = self.get_val(user)
+            table = self.value
+            if isinstance(table, LIST_TYPES):
+                return table.recent(num)
+
             values = []
             i = 0
             while i < num:
@@ -132,25 +315,46 @@ class Item:
                 i += 1
             return values
     
+    @property
+    def permissions(self):
+        return self._permissions
+
+    @permissions.setter
+    def permissions(self, permissions):
+        """
+        Replaces the permissions table, which must not be mutated in place afterwards
+        """
+        self._permissions = permissions
+        self._compiled_permissions = compile_permissions(permissions) if permissions is not None else {}
+        # Authorization decisions by (user_type, user_id, permission)
+        self._decisions = {}
+
     def authenticate(self, user, permission):
-        hasPermission = False
-        if user == "backend":
-            hasPermission = True
-        elif permission in self.permissions:
-            for userPermission in self.permissions[permission]:
-                if user == "NotAuthed":
-                    if userPermission[0] == "a_user" and userPermission[1] == "any":
-                        hasPermission = True
-                else:
-                    if userPermission[0] == user["user_type"] and userPermission[1] == user["user_id"] or userPermission[1] == "authed":
-                        hasPermission = True
-                    if userPermission[0] == user["user_type"] and userPermission[1] == "any" or userPermission[1] == "authed":
-                        hasPermission = True
+        trace = current_trace()
+        if trace is None:
+            return self._authenticate(user, permission)
 
-        if hasPermission:
+        started = time.perf_counter()
+        decision = self._authenticate(user, permission)
+        trace.add("auth", time.perf_counter() - started)
+        return decision
+
+    def _authenticate(self, user, permission):
+        if user == "backend":
             return True
+
+        if user == "NotAuthed":
+            decision_key = (None, None, permission)
         else:
-            return False
+            decision_key = (user["user_type"], user["user_id"], permission)
+
+        decision = self._decisions.get(decision_key)
+        if decision is None:
+            compiled = self._compiled_permissions.get(permission)
+            decision = compiled is not None and compiled.allows(user)
+            self._decisions[decision_key] = decision
+
+        return decision
 
 
     def upgrade_item(self, data):
@@ -171,24 +375,43 @@ class Item:
             return new_data
 
 
+    def to_json(self):
+        value = self.value.encode() if isinstance(self.value, Series) else self.serialize_value()
+        return json.dumps({"key":self.key, "value":value, "owner":self.owner, "permissions":self.permissions, "subs":[], "type":self.type, "seq":self.seq})
+
     def write_to_disk(self, database):
-        filename = "./databases/%s/" % database
-        if not os.path.exists(os.path.dirname(filename)):
-            try:
-                os.makedirs(os.path.dirname(filename))
-            except OSError as exc:  # Guard against race condition
-                if exc.errno != os.errno.EEXIST:
-                    raise
+        filename = self.root_dir + "databases/%s/" % database
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
 
-        with open("./databases/%s/%s.item" % (database, self.key), 'w') as file:
-            file.write(json.dumps({"key":self.key, "value":self.value, "owner":self.owner, "permissions":self.permissions, "subs":self.subs, "type":self.type}))
+        with open(self.root_dir + "databases/%s/%s.item" % (database, self.key), 'w') as file:
+            file.write(self.to_json())
 
     def read_from_disk(self, read_db):
+        filename = self.root_dir + "databases/%s/%s.item" % (read_db, self.key)
         try:
-            filename = self.root_dir + "databases/%s/%s.item" % (read_db, self.key)
             with open(filename, 'r') as file:
                 print("Reading", filename)
-                data = json.loads(file.read())
+                raw = file.read()
+        except Exception:
+            print("WARNING")
+            print("-Unable to read " + filename)
+            traceback.print_exc()
+            print(" ")
+            return
+
+        self.read_from_json(raw, filename)
+
+    def read_from_json(self, raw, source):
+        """
+        Loads the item from its serialized form
+
+        :param raw: the serialized item
+        :param source: where the item was read from, for error messages
+        :return:
+        """
+        try:
+            data = json.loads(raw)
+            self.size = len(raw)
 
             if isinstance(data, list):
                 data = self.upgrade_item(data)
@@ -203,29 +426,266 @@ class Item:
             self.permissions = data["permissions"]
             if self.permissions == None:
                 self.permissions = {"read":[], "write":[]}
-            self.subs = data["subs"]
-            if self.subs == None:
-                self.subs = []
             self.type = data["type"]
             if self.type == None:
                 self.type = "string"
+            self.seq = data.get("seq", 0)
+            self.value = self._coerce_value(self.value)
 
         except Exception as e:
             print("WARNING")
             
-            print("-Unable to read " + str(self.root_dir + "/databases/" + read_db + "/" + self.key + ".item"))
+            print("-Unable to read " + str(source))
+
+            traceback.print_exc()
+            print(" ")
+
+
+class ItemCache:
+    """
+        LRU of the items loaded across every Database of a Server, evicting clean items past a memory budget
+    """
+    def __init__(self, budget=None):
+        # Budget in bytes, None never evicts
+        self.budget = budget
+        self.size = 0
+        self._entries = OrderedDict()
+        # Entries found dirty or subscribed, skipped by evict until enough new entries came in to recheck them
+        self._pinned = OrderedDict()
+        self._added = 0
+
+    def touch(self, table, key, item):
+        entry = (table, key)
+        if entry in self._entries:
+            self._entries.move_to_end(entry)
+            return
+        if entry in self._pinned:
+            self._entries[entry] = self._pinned.pop(entry)
+            return
+
+        self._entries[entry] = item.size
+        self.size += item.size
+        self._added += 1
+        self.evict()
+
+    def resize(self, table, key, size):
+        entry = (table, key)
+        entries = self._entries if entry in self._entries else self._pinned
+        if entry in entries:
+            grown = size > entries[entry]
+            self.size += size - entries[entry]
+            entries[entry] = size
+            if grown:
+                self.evict()
+
+    def recheck(self):
+        # Items were written to disk, the pinned entries are looked at again by the next eviction
+        self._added = len(self._pinned)
+
+    def evict(self):
+        if self.budget is None or self.size <= self.budget:
+            return
+
+        # The most recently touched item is in use by the caller and is never evicted, only the entries before it are
+        # looked at
+        while self.size > self.budget:
+            if len(self._entries) > 1:
+                entry = next(iter(self._entries))
+                table, key = entry
+                if table.can_evict(key):
+                    table.evict(key)
+                    self.size -= self._entries.pop(entry)
+                else:
+                    self._pinned[entry] = self._entries.pop(entry)
+            elif self._pinned and self._added >= len(self._pinned):
+                # Pinned entries are only rechecked once as many entries were added since, each costs O(1) amortized
+                self._added = 0
+                for entry, size in reversed(self._pinned.items()):
+                    self._entries[entry] = size
+                    self._entries.move_to_end(entry, last=False)
+                self._pinned.clear()
+            else:
+                break
+
+    def drop(self, table):
+        for entries in (self._entries, self._pinned):
+            for entry in list(entries):
+                if entry[0] is table:
+                    self.size -= entries.pop(entry)
+
+
+class ItemTable:
+    """
+        Items of a Database by key, each read from disk the first time it is accessed
+    """
+    def __init__(self, database, cache=None):
+        self.database = database
+        self.cache = cache
+        # Every key of the database, in insertion order, and the subset currently in memory
+        self._keys = {}
+        self._items = {}
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def __getitem__(self, key):
+        item = self._items.get(key)
+        if item is None:
+            if key not in self._keys:
+                raise KeyError(key)
+            item = self.database.load_item(key)
+            self._items[key] = item
+
+        if self.cache is not None:
+            self.cache.touch(self, key, item)
+        return item
+
+    def __setitem__(self, key, item):
+        self._keys[key] = None
+        self._items[key] = item
+        if self.cache is not None:
+            self.cache.touch(self, key, item)
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def keys(self):
+        return self._keys.keys()
+
+    def add_key(self, key):
+        """
+        Adds a key whose item is on disk but not yet loaded
+
+        :param key:
+        :return:
+        """
+        self._keys[key] = None
+
+    def loaded_keys(self):
+        return list(self._items.keys())
+
+    def resize(self, key, size):
+        if key in self._items:
+            self._items[key].size = size
+            if self.cache is not None:
+                self.cache.resize(self, key, size)
+
+    def can_evict(self, key):
+        item = self._items.get(key)
+        if item is not None and item.subs:
+            return False
+        return self.database.is_clean(key)
+
+    def evict(self, key):
+        self._items.pop(key, None)
+
+
+class FileStorage:
+    """
+        Stores each item of a Database in its own .item file, listed by a .database manifest
+    """
+    def __init__(self, name, root_dir="./"):
+        self.name = name
+        self.directory = root_dir + "databases/%s/" % name
+
+    def read_manifest(self):
+        filename = self.directory + "%s.database" % self.name
+        if not os.path.exists(filename):
+            return None
 
-            tb_str = traceback.format_exception(etype=type(e), value=e, tb=e.__traceback__)
-            print(tb_str)
+        with open(filename, 'r') as file:
+            print(filename)
+            return json.loads(file.read())
+
+    def load(self, key):
+        filename = self.directory + "%s.item" % key
+        try:
+            with open(filename, 'r') as file:
+                print("Reading", filename)
+                return file.read()
+        except OSError:
+            print("WARNING")
+            print("-Unable to read " + filename)
+            traceback.print_exc()
             print(" ")
+            return None
+
+    def write(self, items, manifest):
+        """
+        Writes serialized items and the manifest
+
+        :param items: dict of key to serialized item
+        :param manifest: dict listing every key of the database
+        :return:
+        """
+        os.makedirs(self.directory, exist_ok=True)
+
+        for key in items:
+            with open(self.directory + "%s.item" % key, "w") as file:
+                file.write(items[key])
+                file.flush()
+                os.fsync(file.fileno())
+
+        with open(self.directory + "%s.database" % self.name, "w") as file:
+            file.write(json.dumps(manifest))
+            file.flush()
+            os.fsync(file.fileno())
+
+    def close(self):
+        pass
+
+
+def open_storage(name, root_dir="./", storage=None):
+    """
+    Opens the storage engine of a Database
+
+    :param name:
+    :param root_dir:
+    :param storage: "files" or "packed", None picks packed if the database has a pack file
+    :return:
+    """
+    if storage is None:
+        storage = "packed" if os.path.exists(PackedStorage.pack_path(name, root_dir)) else "files"
+
+    if storage == "packed":
+        return PackedStorage(name, root_dir)
+    if storage == "files":
+        return FileStorage(name, root_dir)
+    raise ValueError("Unknown storage engine " + str(storage))
 
 
 class Database:
-    def __init__(self, name, read=False, root_dir="./"):
-        self.data = {}
+    def __init__(self, name, read=False, root_dir="./", compact_threshold=4 * 1024 * 1024, flusher=None, cache=None,
+                 storage=None, metrics=None):
+        self.data = ItemTable(self, cache)
         self.name = name
         self.root_dir = root_dir
         self.ver = ACIVersion
+        self.storage = open_storage(name, root_dir, storage)
+
+        # Mutations are appended to the log and only written to the item files when the log is compacted
+        self.log = WriteAheadLog(root_dir + "databases/%s/%s.log" % (name, name))
+        self.log_bytes = self.log.size
+        self.compact_threshold = compact_threshold
+        self.dirty = set()
+        self.seq = 0
+        # Keys serialized by a compaction which the flusher has not finished writing, with their job count
+        self._writing = {}
+        self._writing_lock = threading.Lock()
+
+        # Background writer, when None the log and compactions are written inline
+        self.flusher = flusher
+        # Called with the database and the log record after every mutation
+        self.listeners = []
+        # Server Metrics the persistence paths are timed into, if any
+        self.metrics = metrics
+        self._labels = (("db", name),)
+        # Latest background snapshot, and the one still being serialized if any
+        self.snapshot = None
+        self._snapshotting = None
 
         if read:
             self.read_from_disk()
@@ -236,15 +696,385 @@ class Database:
         else:
             return None
 
+    def get_version(self, key):
+        """
+        Gets the version stamp of an item, the sequence number of its last mutation
+
+        :param key:
+        :return: the version, or None if the key does not exist
+        """
+        if key in self.data:
+            return self.data[key].seq
+        else:
+            return None
+
     def set(self, key, value, user):
-        if not (key in self.data):
-            self.new_item(key, value)
-        response = self.data[key].set_val(value, user)
+        if key in self.data and not self.data[key].authenticate(user, "write"):
+            return self.data[key].set_val(value, user)
+
+        return self._write(key, value)
+
+    def store(self, key, value, user):
+        """
+        Sets a whole value, creating a missing item readable and writable by the user as the atomic operations do
+
+        :param key:
+        :param value:
+        :param user:
+        :return: "Success", "Access Denied", or an error if the item can not hold the value
+        """
+        if not self._allowed(key, user, "write"):
+            return "Access Denied"
 
-        self.data[key].write_to_disk(self.name)
+        if key in self.data:
+            try:
+                # Checked before anything changes, a typed item refusing the value is left as it was
+                self.data[key].prepare_value(value)
+            except (ValueError, TypeError) as e:
+                return "ERROR - " + str(e)
+
+        self._write(key, value, user)
+        return "Success"
+
+    def _write(self, key, value, user=None):
+        """
+        Sets the value and logs it, creating the item if needed
+
+        :param key:
+        :param value:
+        :param user: if given, a missing item is created readable and writable by this user
+        :return: the value set
+        """
+        if key not in self.data and user is not None:
+            record = self._creation(key, "string", user)
+            record["value"] = value
+            self._apply(record)
+            self._log(record)
+            return self.data[key].serialize_value()
+
+        self._before_write(key)
+        response = self._apply({"op": "set", "key": key, "value": value})
+        self._log({"op": "set", "key": key, "value": value})
 
         return response
 
+    def _creation(self, key, type, user):
+        """
+        Builds the log record creating an item owned by a user
+
+        :param key:
+        :param type:
+        :param user:
+        :return: the create record
+        """
+        if user == "backend":
+            owner, permissions = "backend", {"read": [], "write": []}
+        else:
+            owner = user["user_id"]
+            permissions = {"read": [[user["user_type"], user["user_id"]]],
+                           "write": [[user["user_type"], user["user_id"]]]}
+
+        return {"op": "create", "key": key, "type": type, "owner": owner, "permissions": permissions}
+
+    def _allowed(self, key, user, *permissions):
+        """
+        Whether the user holds every permission on an item, any authenticated user may create a missing item
+
+        :param key:
+        :param user:
+        :param permissions:
+        :return:
+        """
+        if key not in self.data:
+            return user != "NotAuthed"
+        item = self.data[key]
+        return all(item.authenticate(user, permission) for permission in permissions)
+
+    def increment(self, key, amount, user):
+        """
+        Adds to a number in one step, a missing key counts as 0
+
+        :param key:
+        :param amount: number added, negative to decrement
+        :param user:
+        :return: the new value
+        """
+        if not self._allowed(key, user, "read", "write"):
+            return "Access Denied"
+        try:
+            amount = _number(amount)
+        except ValueError:
+            return "ERROR - increment needs a number, not " + repr(amount)
+
+        current = self.data[key].value if key in self.data else 0
+        if isinstance(current, bool) or not isinstance(current, (int, float)):
+            return "ERROR - " + str(key) + " is not a number"
+
+        return self._write(key, current + amount, user)
+
+    def decrement(self, key, amount, user):
+        try:
+            return self.increment(key, -_number(amount), user)
+        except ValueError:
+            return "ERROR - decrement needs a number, not " + repr(amount)
+
+    def append_string(self, key, suffix, user):
+        """
+        Appends to a string in one step, a missing key counts as empty
+
+        :param key:
+        :param suffix:
+        :param user:
+        :return: the new value
+        """
+        if not self._allowed(key, user, "read", "write"):
+            return "Access Denied"
+
+        current = self.data[key].value if key in self.data else ""
+        if not isinstance(current, str):
+            return "ERROR - " + str(key) + " is not a string"
+
+        return self._write(key, current + str(suffix), user)
+
+    def compare_and_set(self, key, value, user, expected, by="value"):
+        """
+        Sets the value only if the item still holds the expected value or version
+
+        A missing key holds None at version None, so compare_and_set(key, value, user, None) creates it only if it does
+        not exist yet.
+        :param key:
+        :param value:
+        :param user:
+        :param expected: value, or version as returned with get_value, the item must have
+        :param by: "value" or "version"
+        :return: True if the value was set, False if the item did not match
+        """
+        if by not in ("value", "version"):
+            return "ERROR - compare_and_set compares by value or version, not " + str(by)
+        if not self._allowed(key, user, "read", "write"):
+            return "Access Denied"
+
+        if by == "version":
+            current = self.get_version(key)
+        else:
+            current = self.data[key].serialize_value() if key in self.data else None
+        if current != expected:
+            return False
+
+        self._write(key, value, user)
+        return True
+
+    def get_and_set(self, key, value, user):
+        """
+        Sets a value and gets the one it replaced in one step
+
+        :param key:
+        :param value:
+        :param user:
+        :return: the previous value, None if the key did not exist
+        """
+        if not self._allowed(key, user, "read", "write"):
+            return "Access Denied"
+
+        previous = self.data[key].serialize_value() if key in self.data else None
+        self._write(key, value, user)
+        return previous
+
+    def transaction(self, reads, writes, user):
+        """
+        Sets several values at once if none of the keys read has changed, logged as one record
+
+        :param reads: dict of the version of each key read, as returned with get_value, None for a missing key
+        :param writes: dict of the value to set for each key
+        :param user:
+        :return: "Success", or the list of keys read whose version changed, in which case nothing is written
+        """
+        for key in reads:
+            if key in self.data and not self.data[key].authenticate(user, "read"):
+                return "Access Denied"
+        for key in writes:
+            if not self._allowed(key, user, "write"):
+                return "Access Denied"
+
+        conflicts = [key for key in reads if self.get_version(key) != reads[key]]
+        if conflicts:
+            return conflicts
+        if not writes:
+            return "Success"
+
+        record = {"op": "txn", "writes": writes}
+        # Keys the transaction creates are readable and writable by the committing user, as with _write
+        creates = {}
+        for key in writes:
+            if key not in self.data:
+                creation = self._creation(key, "string", user)
+                creates[key] = {"type": creation["type"], "owner": creation["owner"],
+                                "permissions": creation["permissions"]}
+        if creates:
+            record["creates"] = creates
+        changes = _unpack(record)
+        try:
+            # Every value is checked before anything changes, so the writes apply all or not at all
+            for change in changes:
+                if change["key"] in self.data:
+                    change["value"] = self.data[change["key"]].prepare_value(change["value"])
+        except (ValueError, TypeError) as e:
+            return "ERROR - " + str(e)
+
+        # Marked before applying, creating an item may evict clean items from the cache
+        self.dirty.update(writes)
+        for change in changes:
+            self._before_write(change["key"])
+            self._apply(change)
+        self._log(record)
+
+        return "Success"
+
+    def push_trim(self, key, value, user, max_len=None, expected_version=None):
+        """
+        Appends to a list and evicts its oldest elements past max_len, optionally only if it is unchanged
+
+        :param key:
+        :param value: a value or a list of values
+        :param user:
+        :param max_len: number of elements kept, None only applies the item's own limit
+        :param expected_version: only appends if the item is still at this version, as returned with get_value
+        :return: the length of the list, or False if the version did not match
+        """
+        if key not in self.data:
+            return "ERROR - " + str(key) + " does not exist"
+        item = self.data[key]
+        if not (item.authenticate(user, "read") and item.authenticate(user, "write")):
+            return "Access Denied"
+        if not isinstance(item.value, LIST_TYPES):
+            return "ERROR - " + str(key) + " is not a list"
+        if expected_version is not None and item.seq != expected_version:
+            return False
+
+        if isinstance(item.value, Series):
+            value = item.value.normalize(value)
+        elif not isinstance(value, list):
+            value = [value]
+        record = {"op": "push_trim", "key": key, "value": value,
+                  "max_len": None if max_len is None else int(max_len)}
+        self._before_write(key)
+        self._apply(record)
+        self._log(record)
+
+        return len(item.value)
+
+    def set_index(self, key, index, value, user):
+        self._before_write(key)
+        response = self.data[key].set_index(index, value, user)
+        if response == "Success":
+            self._log({"op": "set_index", "key": key, "index": index, "value": value})
+
+        return response
+
+    def append_index(self, key, value, user):
+        if isinstance(self.data[key].value, Series):
+            # Logged with the timestamps given to bare timeseries values
+            value = self.data[key].value.normalize(value)
+        self._before_write(key)
+        response = self.data[key].append_index(value, user)
+        if response == "Success":
+            self._log({"op": "append_index", "key": key, "value": value})
+
+        return response
+
+    def create_series(self, key, dtype, user, capacity=None):
+        """
+        Creates a typed numeric item, readable and writable by the user creating it
+
+        :param key:
+        :param dtype: one of SERIES_TYPES
+        :param user:
+        :param capacity: number of elements kept, the oldest are evicted past it
+        :return:
+        """
+        if key in self.data:
+            return "ERROR - key already exists"
+        if dtype not in SERIES_TYPES:
+            return "ERROR - unknown series type " + str(dtype)
+        if user == "NotAuthed":
+            return "Access Denied"
+
+        record = self._creation(key, dtype, user)
+        record["capacity"] = int(capacity or DEFAULT_MAX_LEN)
+        response = self._apply(record)
+        self._log(record)
+
+        return response
+
+    def _apply(self, record):
+        """
+        Applies a logged mutation to the in memory items
+
+        :param record:
+        :return: the result of the mutation
+        """
+        key = record["key"]
+        if record["op"] == "set":
+            if not (key in self.data):
+                self.new_item(key, record["value"])
+            return self.data[key].set_val(record["value"], "backend")
+        elif record["op"] == "set_index":
+            return self.data[key].set_index(record["index"], record["value"], "backend")
+        elif record["op"] == "append_index":
+            return self.data[key].append_index(record["value"], "backend")
+        elif record["op"] == "push_trim":
+            table = self.data[key].value
+            table.extend(record["value"])
+            if record["max_len"] is not None:
+                table.trim(record["max_len"])
+            return "Success"
+        elif record["op"] == "create":
+            item = Item(key, record.get("value", []), record["owner"], root_dir=self.root_dir, type=record["type"],
+                        permissions=record["permissions"])
+            if record["type"] in SERIES_TYPES:
+                item.maxLen = record["capacity"]
+                item.value = Series(record["type"], record["capacity"])
+            self.data[key] = item
+            return "Success"
+
+    def _log(self, record):
+        started = time.perf_counter()
+        self.seq += 1
+        record["seq"] = self.seq
+        changes = _unpack(record)
+        for change in changes:
+            self.data[change["key"]].seq = self.seq
+            self.dirty.add(change["key"])
+
+        # Serialized now, the value may be mutated in place before the flusher writes it
+        line = json.dumps(record)
+        self.log_bytes += len(line) + 1
+        # Whole new values are measured from their record, until a compaction measures the serialized item
+        if record["op"] in ("set", "create"):
+            self.data.resize(record["key"], len(line))
+        elif record["op"] == "txn":
+            for change in changes:
+                self.data.resize(change["key"], len(json.dumps(change["value"])))
+        if self.flusher is not None:
+            self.flusher.submit_record(self, record.get("key"), record["op"], line)
+        else:
+            self.log.append_lines([line])
+
+        if self.metrics is not None:
+            self.metrics.observe("aci_log_record_seconds", time.perf_counter() - started, self._labels)
+
+        # A running snapshot ends with a compaction of its own
+        if self.log_bytes >= self.compact_threshold and self._snapshotting is None:
+            self.compact()
+
+        trace = current_trace()
+        if trace is not None:
+            trace.add("persist", time.perf_counter() - started)
+
+        for change in changes:
+            for listener in self.listeners:
+                listener(self, change)
+
     def new_item(self, key, value, owner="self"):
         self.data[key] = Item(key, value, owner, root_dir=self.root_dir, permissions={"read":[],"write":[]})
 
@@ -259,31 +1089,186 @@ class Database:
 
             return new_data
 
+    def _before_write(self, key):
+        if self._snapshotting is not None:
+            self._snapshotting.before_write(key)
+
+    def compact(self, serialized=None):
+        """
+        Writes the items changed since the last compaction to disk and empties the log
+
+        The items are serialized immediately and written by the flusher, if there is one.
+        :param serialized: items already serialized by a snapshot, the changed items take precedence over them
+        :return:
+        """
+        items = dict(serialized) if serialized else {}
+        items.update({key: self.data[key].to_json() for key in self.dirty if key in self.data})
+        manifest = {"dbKey":self.name, "keys":list(self.data.keys()), "ver":self.ver, "seq":self.seq}
+        self.dirty.clear()
+        self.log_bytes = 0
+
+        self._hold(items)
+        for key in items:
+            self.data.resize(key, len(items[key]))
+
+        if self.flusher is not None:
+            self.flusher.submit_compaction(self, (items, manifest))
+        else:
+            self.write_compaction((items, manifest))
+
+    def write_compaction(self, job):
+        """
+        Writes serialized items and the manifest to disk, then truncates the log
+
+        :param job: tuple of the serialized items by key and the manifest
+        :return:
+        """
+        started = time.perf_counter()
+        items, manifest = job
+        self.storage.write(items, manifest)
+        self.log.truncate()
+
+        if self.metrics is not None:
+            self.metrics.observe("aci_compaction_seconds", time.perf_counter() - started, self._labels)
+            self.metrics.inc("aci_compaction_bytes_total", self._labels, sum(len(items[key]) for key in items))
+
+        self._release(items)
+
+    def is_clean(self, key):
+        """
+        Whether the item on disk is up to date, so the loaded item may be evicted
+
+        :param key:
+        :return:
+        """
+        with self._writing_lock:
+            return key not in self.dirty and key not in self._writing
+
+    def load_item(self, key):
+        started = time.perf_counter()
+        item = Item(key, "None", "None", root_dir=self.root_dir)
+        raw = self.storage.load(key)
+        if raw is not None:
+            item.read_from_json(raw, "%s[%s]" % (self.name, key))
+
+        if self.metrics is not None:
+            self.metrics.observe("aci_item_load_seconds", time.perf_counter() - started, self._labels)
+        return item
+
+    def close(self):
+        """
+        Waits for the flusher to write what is queued and releases the memory budget held by the loaded items
+
+        :return:
+        """
+        self.cancel_snapshot()
+        if self.flusher is not None:
+            # Records and compactions still queued must reach the log before it is read again
+            self.flusher.flush()
+        if self.data.cache is not None:
+            self.data.cache.drop(self.data)
+        self.storage.close()
+
     def write_to_disk(self):
-        filename = "./databases/" + self.name + "/"
-        if not os.path.exists(os.path.dirname(filename)):
-            try:
-                os.makedirs(os.path.dirname(filename))
-            except OSError as exc:  # Guard against race condition
-                if exc.errno != os.errno.EEXIST:
-                    raise
+        self.cancel_snapshot()
+        self.dirty.update(self.data.loaded_keys())
+        self.compact()
+
+    def start_snapshot(self, call_soon):
+        """
+        Writes every loaded item to disk as of now without blocking, serializing them on a background thread
+
+        Items changed since the snapshot started are written with it as they are when it completes.
+        :param call_soon: schedules a callback on the thread using the database, such as loop.call_soon_threadsafe
+        :return: the Snapshot, or the one already running
+        """
+        if self._snapshotting is not None:
+            return self._snapshotting
 
-        item_keys = []
-        for val in self.data.values():
-            val.write_to_disk(self.name)
-            item_keys.append(val.key)
+        items = {key: self.data[key] for key in self.data.loaded_keys()}
+        # Kept loaded until written, their changes are only in the log and the snapshot now
+        self.dirty.clear()
+        self._hold(items)
 
-        with open(self.root_dir + "databases/%s/%s.database" % (self.name, self.name), "w") as file:
-            file.write(json.dumps({"dbKey":self.name, "keys":item_keys, "ver":self.ver}))
+        self.snapshot = self._snapshotting = Snapshot(self, items, self.seq,
+                                                      lambda snapshot: call_soon(self._finish_snapshot, snapshot))
+        return self.snapshot
+
+    def _finish_snapshot(self, snapshot):
+        if snapshot is not self._snapshotting:
+            return
+        self._snapshotting = None
+        if snapshot.error is not None:
+            self.dirty.update(snapshot.keys)
+            self._release(snapshot.keys)
+            print("WARNING - Snapshot of %s failed: %s" % (self.name, snapshot.error))
+            return
+
+        self.compact(snapshot.serialized)
+        self._release(snapshot.serialized)
+        snapshot.finish()
+
+        if self.metrics is not None:
+            self.metrics.observe("aci_snapshot_seconds", snapshot.duration, self._labels)
+            self.metrics.inc("aci_snapshot_copied_on_write_total", self._labels, snapshot.copied_on_write)
+        print("Snapshot of %s serialized %i items in %.3fs" % (self.name, snapshot.total, snapshot.duration))
+
+    def cancel_snapshot(self):
+        """
+        Stops a running snapshot, its items are written by the next compaction instead
+
+        :return:
+        """
+        snapshot = self._snapshotting
+        if snapshot is None:
+            return
+        self._snapshotting = None
+
+        snapshot.cancel()
+        self.dirty.update(snapshot.keys)
+        self._release(snapshot.keys)
+
+    def _hold(self, keys):
+        # Marks keys as being written so they are not evicted
+        with self._writing_lock:
+            for key in keys:
+                self._writing[key] = self._writing.get(key, 0) + 1
+
+    def _release(self, keys):
+        with self._writing_lock:
+            for key in keys:
+                self._writing[key] -= 1
+                if self._writing[key] == 0:
+                    del self._writing[key]
+        if self.data.cache is not None:
+            self.data.cache.recheck()
 
     def read_from_disk(self):
-        filename = self.root_dir + "databases/%s/%s.database" % (self.name, self.name)
-        with open(filename, 'r') as file:
-            print(filename)
-            db_data = json.loads(file.read())
+        db_data = self.storage.read_manifest()
+        if db_data is not None:
+            if isinstance(db_data, list):
+                db_data = self.upgrade_database(db_data)
+
+            for itemKey in db_data["keys"]:
+                self.data.add_key(itemKey)
+            self.seq = db_data.get("seq", 0)
+
+        self.replay_log()
+
+    def replay_log(self):
+        """
+        Re-applies logged mutations which had not been compacted into the item files
 
-        if isinstance(db_data, list):
-            db_data = self.upgrade_database(db_data)
+        :return:
+        """
+        for record in self.log.replay():
+            self.seq = max(self.seq, record["seq"])
+            for change in _unpack(record):
+                key = change["key"]
+                if key in self.data and self.data[key].seq >= record["seq"]:
+                    # Already written to the item file before the log was truncated
+                    continue
 
-        for itemKey in db_data["keys"]:
-            self.data[itemKey] = Item(itemKey, "None", "None", read=True, read_db=self.name)
+                self._apply(change)
+                self.data[key].seq = record["seq"]
+                self.dirty.add(key)
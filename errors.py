@@ -4,3 +4,16 @@ class ACIException(Exception):
 
 class InvalidACITypeException(Exception):
     pass
+
+
+class ACIConnectionError(ACIException):
+    pass
+
+
+class ACIConflictError(ACIException):
+    """
+        A transaction was not committed because keys it read were changed by another writer
+    """
+    def __init__(self, keys):
+        super().__init__("Keys changed since they were read: " + ", ".join(str(key) for key in keys))
+        self.keys = keys
@@ -0,0 +1,232 @@
+import asyncio
+import threading
+import time
+import traceback
+from collections import deque
+
+
+# Durability modes
+#   per_write - every record is written and fsynced on its own as soon as it is queued, and the Server only answers
+#               a write once it is on disk
+#   batch     - every record queued while the previous flush was running is written and fsynced together, writes
+#               are answered before they are on disk
+#   interval  - queued records are written and fsynced together every flush_interval seconds, writes are answered
+#               before they are on disk
+FLUSH_MODES = ("per_write", "batch", "interval")
+
+# Log record ops which only change a value, a later set of the same key makes them redundant. Others, such as create,
+# also give the item its type and permissions.
+VALUE_OPS = ("set", "set_index", "append_index", "push_trim")
+
+
+class Flusher:
+    """
+        Background writer thread which persists Database write-ahead log records and compactions
+    """
+    def __init__(self, mode="batch", flush_interval=0.05):
+        if mode not in FLUSH_MODES:
+            raise ValueError("Unknown flush mode " + str(mode))
+
+        self.mode = mode
+        self.flush_interval = flush_interval
+
+        # FIFO of ("record", database, key, op, line, queued_at) and ("compact", database, job, queued_at)
+        self._queue = deque()
+        self._condition = threading.Condition()
+        self._busy = False
+        # Entries queued and entries written so far, entries are written in the order they are queued
+        self.submitted = 0
+        self.completed = 0
+        # (submitted count, future) of coroutines waiting for everything queued before them to be written
+        self._waiters = []
+
+        self.flushes = 0
+        self.fsyncs = 0
+        self.records_written = 0
+        self.records_coalesced = 0
+        self.compactions = 0
+        self.last_flush_duration = 0.0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        # Server Metrics the writes are timed into, if any
+        self.metrics = None
+
+        self._thread = threading.Thread(target=self._run, name="ACI-Flusher", daemon=True)
+        self._thread.start()
+
+    def configure(self, mode=None, flush_interval=None):
+        if mode is not None:
+            if mode not in FLUSH_MODES:
+                raise ValueError("Unknown flush mode " + str(mode))
+            self.mode = mode
+        if flush_interval is not None:
+            self.flush_interval = float(flush_interval)
+
+        with self._condition:
+            self._condition.notify_all()
+
+    def submit_record(self, database, key, op, line):
+        """
+        Queues a serialized write-ahead log record
+
+        :param database:
+        :param key:
+        :param op:
+        :param line:
+        :return:
+        """
+        with self._condition:
+            self._queue.append(("record", database, key, op, line, time.monotonic()))
+            self.submitted += 1
+            if self.mode != "interval":
+                self._condition.notify_all()
+
+    def submit_compaction(self, database, job):
+        """
+        Queues a compaction, written after every record queued before it
+
+        :param database:
+        :param job: argument passed to database.write_compaction on the writer thread
+        :return:
+        """
+        with self._condition:
+            self._queue.append(("compact", database, job, time.monotonic()))
+            self.submitted += 1
+            self._condition.notify_all()
+
+    def flush(self, timeout=None):
+        """
+        Blocks until everything queued so far has been written
+
+        :param timeout:
+        :return: True if the queue was drained
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            self._condition.notify_all()
+            while self._queue or self._busy:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+    async def wait_written(self):
+        """
+        Waits without blocking the event loop until everything queued so far has been written
+
+        :return:
+        """
+        future = asyncio.get_running_loop().create_future()
+        with self._condition:
+            if self.completed >= self.submitted:
+                return
+            self._waiters.append((self.submitted, future))
+            self._condition.notify_all()
+        await future
+
+    def stats(self):
+        with self._condition:
+            pending = len(self._queue)
+            oldest = self._queue[0][-1] if pending else None
+
+        return {"mode": self.mode,
+                "flush_interval": self.flush_interval,
+                "pending": pending,
+                "lag": 0.0 if oldest is None else time.monotonic() - oldest,
+                "last_lag": self.last_lag,
+                "max_lag": self.max_lag,
+                "last_flush_duration": self.last_flush_duration,
+                "flushes": self.flushes,
+                "fsyncs": self.fsyncs,
+                "records_written": self.records_written,
+                "records_coalesced": self.records_coalesced,
+                "compactions": self.compactions}
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if self.mode == "interval":
+                    self._condition.wait(self.flush_interval)
+                while not self._queue:
+                    self._condition.wait(self.flush_interval if self.mode == "interval" else None)
+
+                if self.mode == "per_write":
+                    entries = [self._queue.popleft()]
+                else:
+                    entries = list(self._queue)
+                    self._queue.clear()
+                self._busy = True
+
+            try:
+                self._write(entries)
+            except Exception:
+                traceback.print_exc()
+                print("WARNING - Flusher failed to write %i queued entries" % len(entries))
+            finally:
+                with self._condition:
+                    self._busy = False
+                    self.completed += len(entries)
+                    ready = [future for submitted, future in self._waiters if submitted <= self.completed]
+                    self._waiters = [(submitted, future) for submitted, future in self._waiters
+                                     if submitted > self.completed]
+                    self._condition.notify_all()
+
+                for future in ready:
+                    future.get_loop().call_soon_threadsafe(_resolve, future)
+
+    def _write(self, entries):
+        started = time.monotonic()
+        lag = started - entries[0][-1]
+        self.last_lag = lag
+        self.max_lag = max(self.max_lag, lag)
+
+        records = []
+        for entry in entries:
+            if entry[0] == "record":
+                records.append(entry)
+            else:
+                # The compaction already contains every record of its database queued before it
+                covered = [record for record in records if record[1] is entry[1]]
+                records = [record for record in records if record[1] is not entry[1]]
+                self.records_coalesced += len(covered)
+                entry[1].write_compaction(entry[2])
+                self.compactions += 1
+        self._write_records(records)
+
+        self.flushes += 1
+        self.last_flush_duration = time.monotonic() - started
+        if self.metrics is not None:
+            self.metrics.observe("aci_flush_seconds", self.last_flush_duration)
+            self.metrics.observe("aci_flush_lag_seconds", lag)
+
+    def _write_records(self, records):
+        if not records:
+            return
+
+        # A set replaces the whole value, so any earlier change of the value of the same key in this batch is redundant
+        superseded = set()
+        lines = {}
+        for kind, database, key, op, line, _ in reversed(records):
+            if (database, key) in superseded and op in VALUE_OPS:
+                self.records_coalesced += 1
+                continue
+            if op == "set":
+                superseded.add((database, key))
+            lines.setdefault(database, []).append(line)
+
+        for database in lines:
+            started = time.monotonic()
+            lines[database].reverse()
+            database.log.append_lines(lines[database], fsync=True)
+            self.records_written += len(lines[database])
+            self.fsyncs += 1
+            if self.metrics is not None:
+                labels = (("db", database.name),)
+                self.metrics.observe("aci_log_write_seconds", time.monotonic() - started, labels)
+                self.metrics.inc("aci_log_records_total", labels, len(lines[database]))
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
@@ -0,0 +1,220 @@
+import bisect
+import threading
+
+
+# Upper bounds in seconds of the latency histogram buckets, the last bucket is unbounded
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+                   2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """
+        Counts of observations falling in fixed buckets, cheap enough to record every command
+    """
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """
+        Estimates a quantile as the upper bound of the bucket holding it
+
+        :param q: from 0 to 1
+        :return: the bound, inf if it falls past the last bound, or None if nothing was observed
+        """
+        if self.count == 0:
+            return None
+
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return self.bounds[index] if index < len(self.bounds) else float("inf")
+        return float("inf")
+
+    def snapshot(self):
+        cumulative = []
+        seen = 0
+        for count in self.counts:
+            seen += count
+            cumulative.append(seen)
+
+        return {"count": self.count,
+                "sum": self.sum,
+                "buckets": {_bound_label(bound): cumulative[index] for index, bound in
+                            enumerate(self.bounds + (float("inf"),))},
+                "p50": self.quantile(0.5),
+                "p99": self.quantile(0.99)}
+
+
+class Metrics:
+    """
+        Counters, latency histograms and gauges of a Server, labelled by command and database
+
+        Observations come from the event loop and the flusher thread, gauges are only read when a snapshot is taken.
+    """
+    def __init__(self):
+        # (name, labels) -> value, labels being a tuple of (label, value) pairs
+        self.counters = {}
+        self.histograms = {}
+        # name -> function returning the value, or a dict of labels tuple to value
+        self.gauges = {}
+        self.help = {}
+        # Gauge values merged in from another process
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+    def inc(self, name, labels=(), amount=1):
+        key = (name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, labels=()):
+        key = (name, labels)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def gauge(self, name, function):
+        """
+        Registers a value read when a snapshot is taken
+
+        :param name:
+        :param function: returns a number, or a dict of labels tuple to number
+        :return:
+        """
+        self.gauges[name] = function
+
+    def _gauge_values(self):
+        values = dict(self.values)
+        for name, function in self.gauges.items():
+            value = function()
+            if isinstance(value, dict):
+                for labels, number in value.items():
+                    values[(name, labels)] = number
+            else:
+                values[(name, ())] = value
+        return values
+
+    def export(self):
+        """
+        Gets the raw state of every metric in json safe form, to be merged into another process's Metrics
+
+        :return: dict
+        """
+        with self._lock:
+            counters = [[name, list(labels), value] for (name, labels), value in self.counters.items()]
+            histograms = [[name, list(labels), histogram.counts, histogram.count, histogram.sum]
+                          for (name, labels), histogram in self.histograms.items()]
+        gauges = [[name, list(labels), value] for (name, labels), value in self._gauge_values().items()]
+        return {"counters": counters, "histograms": histograms, "gauges": gauges, "help": self.help}
+
+    def merge(self, exported, labels=()):
+        """
+        Adds metrics exported by another process
+
+        :param exported: result of export
+        :param labels: labels added to every merged metric, telling the processes apart
+        :return:
+        """
+        with self._lock:
+            for name, own_labels, value in exported["counters"]:
+                key = (name, tuple(tuple(label) for label in own_labels) + labels)
+                self.counters[key] = self.counters.get(key, 0) + value
+            for name, own_labels, counts, count, total in exported["histograms"]:
+                key = (name, tuple(tuple(label) for label in own_labels) + labels)
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    histogram = self.histograms[key] = Histogram()
+                histogram.counts = [mine + theirs for mine, theirs in zip(histogram.counts, counts)]
+                histogram.count += count
+                histogram.sum += total
+            for name, own_labels, value in exported["gauges"]:
+                self.values[(name, tuple(tuple(label) for label in own_labels) + labels)] = value
+            for name in exported["help"]:
+                self.help.setdefault(name, exported["help"][name])
+
+    def snapshot(self):
+        """
+        Gets every metric, keyed by its name and labels in Prometheus notation
+
+        :return: dict of counters, histograms and gauges
+        """
+        with self._lock:
+            counters = {_series_name(name, labels): value for (name, labels), value in self.counters.items()}
+            histograms = {_series_name(name, labels): histogram.snapshot()
+                          for (name, labels), histogram in self.histograms.items()}
+
+        gauges = {_series_name(name, labels): value for (name, labels), value in self._gauge_values().items()}
+        return {"counters": counters, "histograms": histograms, "gauges": gauges}
+
+    def to_prometheus(self):
+        """
+        Renders every metric in the Prometheus text exposition format
+
+        :return: str
+        """
+        lines = []
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, histogram.snapshot()) for key, histogram in self.histograms.items())
+        gauges = sorted(self._gauge_values().items())
+
+        for kind, entries in (("counter", counters), ("gauge", gauges)):
+            described = set()
+            for (name, labels), value in entries:
+                if name not in described:
+                    described.add(name)
+                    lines.extend(self._header(name, kind))
+                lines.append("%s %s" % (_series_name(name, labels), _number(value)))
+
+        described = set()
+        for (name, labels), snapshot in histograms:
+            if name not in described:
+                described.add(name)
+                lines.extend(self._header(name, "histogram"))
+            for bound, count in snapshot["buckets"].items():
+                lines.append("%s %i" % (_series_name(name + "_bucket", labels + (("le", bound),)), count))
+            lines.append("%s %s" % (_series_name(name + "_sum", labels), _number(snapshot["sum"])))
+            lines.append("%s %i" % (_series_name(name + "_count", labels), snapshot["count"]))
+
+        return "\n".join(lines) + "\n"
+
+    def _header(self, name, kind):
+        header = []
+        if name in self.help:
+            header.append("# HELP %s %s" % (name, self.help[name]))
+        header.append("# TYPE %s %s" % (name, kind))
+        return header
+
+
+def _bound_label(bound):
+    return "+Inf" if bound == float("inf") else repr(bound)
+
+
+def _number(value):
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, float):
+        return "+Inf" if value == float("inf") else repr(value)
+    return str(value)
+
+
+def _series_name(name, labels):
+    if not labels:
+        return name
+    return "%s{%s}" % (name, ",".join('%s="%s"' % (label, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                                      for label, value in labels))
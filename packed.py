@@ -0,0 +1,219 @@
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+
+
+# Layout of a pack file:
+#   MAGIC, then serialized items back to back, then a json index of every live item's (offset, length) and the
+#   database manifest, then a footer of the index offset and FOOTER_MAGIC.
+# Compactions append the changed items and a new index and footer, the newest valid footer wins. Once more than
+# half of the file is superseded records the pack is rewritten.
+MAGIC = b"ACIPACK1"
+FOOTER_MAGIC = b"ACIPKEND"
+FOOTER = struct.Struct(">Q8s")
+
+
+class PackedStorage:
+    """
+        Stores every item of a Database in a single memory mapped pack file with an offset index
+    """
+    def __init__(self, name, root_dir="./", repack_ratio=0.5):
+        self.name = name
+        self.path = self.pack_path(name, root_dir)
+        self.repack_ratio = repack_ratio
+
+        self.index = {}
+        self.manifest = None
+        self.live_bytes = 0
+
+        self._file = None
+        self._mmap = None
+        # Guards the index and mapping, which the flusher swaps while the event loop reads
+        self._lock = threading.Lock()
+
+        if os.path.exists(self.path):
+            self._map()
+
+    @staticmethod
+    def pack_path(name, root_dir="./"):
+        return root_dir + "databases/%s/%s.pack" % (name, name)
+
+    def _map(self):
+        file = open(self.path, "rb")
+        if os.fstat(file.fileno()).st_size == 0:
+            file.close()
+            raise ValueError("Empty pack file " + self.path)
+
+        mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        index = self._read_index(mapped)
+
+        with self._lock:
+            self._unmap()
+            self._file = file
+            self._mmap = mapped
+            self.index = {key: tuple(entry) for key, entry in index["items"].items()}
+            self.manifest = index["manifest"]
+            self.live_bytes = sum(entry[1] for entry in self.index.values())
+
+    def _read_index(self, mapped):
+        end = len(mapped)
+        while True:
+            # A crash during a compaction can leave a torn tail, fall back to the previous footer
+            position = mapped.rfind(FOOTER_MAGIC, 0, end)
+            if position < FOOTER.size - len(FOOTER_MAGIC):
+                raise ValueError("No valid index in pack file " + self.path)
+
+            footer_start = position - (FOOTER.size - len(FOOTER_MAGIC))
+            index_offset, _ = FOOTER.unpack(mapped[footer_start:position + len(FOOTER_MAGIC)])
+            try:
+                return json.loads(mapped[index_offset:footer_start].decode())
+            except ValueError:
+                end = position
+
+    def _unmap(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def read_manifest(self):
+        return self.manifest
+
+    def load(self, key):
+        with self._lock:
+            if key not in self.index or self._mmap is None:
+                return None
+            offset, length = self.index[key]
+            return self._mmap[offset:offset + length].decode()
+
+    def write(self, items, manifest):
+        """
+        Appends the serialized items and a new index to the pack
+
+        :param items: dict of key to serialized item
+        :param manifest: dict listing every key of the database
+        :return:
+        """
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        with self._lock:
+            index = dict(self.index)
+
+        with open(self.path, "ab") as file:
+            if file.tell() == 0:
+                file.write(MAGIC)
+
+            offset = file.tell()
+            for key in items:
+                data = items[key].encode()
+                file.write(data)
+                index[key] = (offset, len(data))
+                offset += len(data)
+
+            index = {key: index[key] for key in manifest["keys"] if key in index}
+            self._write_index(file, index, manifest)
+
+        self._map()
+
+        size = os.path.getsize(self.path)
+        if self.live_bytes < size * self.repack_ratio:
+            self.repack()
+
+    def _write_index(self, file, index, manifest):
+        index_offset = file.tell()
+        file.write(json.dumps({"manifest": manifest, "items": index}).encode())
+        file.write(FOOTER.pack(index_offset, FOOTER_MAGIC))
+        file.flush()
+        os.fsync(file.fileno())
+
+    def repack(self):
+        """
+        Rewrites the pack with only its live records
+
+        :return:
+        """
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "wb") as file:
+            file.write(MAGIC)
+            index = {}
+            for key in list(self.index):
+                data = self.load(key).encode()
+                index[key] = (file.tell(), len(data))
+                file.write(data)
+            self._write_index(file, index, self.manifest)
+
+        os.replace(temp_path, self.path)
+        self._map()
+
+    def close(self):
+        with self._lock:
+            self._unmap()
+
+
+def import_database(name, root_dir="./"):
+    """
+    Converts a database from the per item file layout to a pack file
+
+    :param name:
+    :param root_dir:
+    :return:
+    """
+    try:
+        from database import Database
+    except Exception:
+        from ACIpy.database import Database
+
+    source = Database(name, read=True, root_dir=root_dir, storage="files")
+    items = {key: source.data[key].to_json() for key in source.data}
+    manifest = {"dbKey": name, "keys": list(source.data.keys()), "ver": source.ver, "seq": source.seq}
+
+    if os.path.exists(PackedStorage.pack_path(name, root_dir)):
+        os.remove(PackedStorage.pack_path(name, root_dir))
+    target = PackedStorage(name, root_dir)
+    target.write(items, manifest)
+    target.close()
+
+    # Every logged mutation is now in the pack
+    source.log.truncate()
+    print("Imported %i items of %s into %s" % (len(items), name, target.path))
+
+
+def export_database(name, root_dir="./"):
+    """
+    Converts a database from a pack file to the per item file layout, removing the pack
+
+    :param name:
+    :param root_dir:
+    :return:
+    """
+    try:
+        from database import Database, FileStorage
+    except Exception:
+        from ACIpy.database import Database, FileStorage
+
+    source = Database(name, read=True, root_dir=root_dir, storage="packed")
+    items = {key: source.data[key].to_json() for key in source.data}
+    manifest = {"dbKey": name, "keys": list(source.data.keys()), "ver": source.ver, "seq": source.seq}
+
+    FileStorage(name, root_dir).write(items, manifest)
+    source.log.truncate()
+    source.storage.close()
+    os.remove(PackedStorage.pack_path(name, root_dir))
+    print("Exported %i items of %s to %s" % (len(items), name, root_dir + "databases/%s/" % name))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3 or sys.argv[1] not in ("import", "export"):
+        print("Usage: python packed.py import|export [database] [root_dir]")
+        sys.exit(1)
+
+    root = sys.argv[3] if len(sys.argv) > 3 else "./"
+    if sys.argv[1] == "import":
+        import_database(sys.argv[2], root)
+    else:
+        export_database(sys.argv[2], root)
@@ -0,0 +1,38 @@
+class PermissionSet:
+    """
+        Set based form of one permission's [user_type, user_id] table, checked in constant time
+    """
+    def __init__(self, entries):
+        # ["a_user", "any"] lets users who have not authenticated in
+        self.anonymous = False
+        # [<any type>, "authed"] lets every authenticated user in
+        self.authed = False
+        # [user_type, "any"] lets every user of that type in
+        self.any_types = set()
+        self.users = set()
+
+        for user_type, user_id in entries:
+            if user_id == "authed":
+                self.authed = True
+            elif user_id == "any":
+                self.any_types.add(user_type)
+                if user_type == "a_user":
+                    self.anonymous = True
+            else:
+                self.users.add((user_type, user_id))
+
+    def allows(self, user):
+        if user == "NotAuthed":
+            return self.anonymous
+        return self.authed or user["user_type"] in self.any_types or \
+            (user["user_type"], user["user_id"]) in self.users
+
+
+def compile_permissions(permissions):
+    """
+    Compiles an item's permissions table
+
+    :param permissions: dict of permission to a list of [user_type, user_id]
+    :return: dict of permission to PermissionSet
+    """
+    return {permission: PermissionSet(permissions[permission]) for permission in permissions}
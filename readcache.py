@@ -0,0 +1,72 @@
+import time
+from collections import OrderedDict
+
+
+class ReadCache:
+    """
+        Bounded LRU of values read from one Database, with optional time to live and version stamps
+    """
+    def __init__(self, max_size=1024, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        # key -> (value, version, stored_at)
+        self._entries = OrderedDict()
+        # Keys with a read in flight, mapped to the newest version invalidated while it was in flight
+        self._filling = {}
+
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        """
+        Looks up a key
+
+        :param key:
+        :return: (True, value) on a hit, (False, None) on a miss
+        """
+        entry = self._entries.get(key)
+        if entry is None or (self.ttl is not None and time.monotonic() - entry[2] > self.ttl):
+            self.misses += 1
+            return False, None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return True, entry[0]
+
+    def begin_fill(self, key):
+        self._filling.setdefault(key, -1)
+
+    def fill(self, key, value, version):
+        """
+        Stores the result of a read started with begin_fill
+
+        A value older than an invalidation received while the read was in flight is not stored.
+        :param key:
+        :param value:
+        :param version:
+        :return: list of keys evicted to make room
+        """
+        invalidated = self._filling.pop(key, -1)
+        if version is None or version < invalidated:
+            return []
+
+        self._entries[key] = (value, version, time.monotonic())
+        self._entries.move_to_end(key)
+
+        evicted = []
+        while len(self._entries) > self.max_size:
+            evicted.append(self._entries.popitem(last=False)[0])
+        return evicted
+
+    def invalidate(self, key, version=None):
+        self._entries.pop(key, None)
+        if key in self._filling:
+            self._filling[key] = max(self._filling[key], version if version is not None else float("inf"))
+
+    def clear(self):
+        self._entries.clear()
+        for key in self._filling:
+            self._filling[key] = float("inf")
@@ -0,0 +1,97 @@
+class RingBuffer:
+    """
+        Bounded list which evicts its oldest element when appending past its capacity
+    """
+    def __init__(self, capacity, values=()):
+        self.capacity = capacity
+        self._data = []
+        # Position in _data of the oldest element, only moves once the buffer is full
+        self._start = 0
+
+        self.extend(values)
+
+    def __len__(self):
+        return len(self._data)
+
+    def _position(self, index):
+        length = len(self._data)
+        if index < 0:
+            index += length
+        if index < 0 or index >= length:
+            raise IndexError("RingBuffer index out of range")
+
+        return (self._start + index) % length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.slice(index.start, index.stop, index.step)
+        return self._data[self._position(index)]
+
+    def __setitem__(self, index, value):
+        self._data[self._position(index)] = value
+
+    def __iter__(self):
+        length = len(self._data)
+        for index in range(length):
+            yield self._data[(self._start + index) % length]
+
+    def __eq__(self, other):
+        if isinstance(other, RingBuffer):
+            other = other.to_list()
+        return self.to_list() == other
+
+    def __repr__(self):
+        return "RingBuffer(%i, %r)" % (self.capacity, self.to_list())
+
+    def append(self, value):
+        if len(self._data) < self.capacity:
+            self._data.append(value)
+        else:
+            self._data[self._start] = value
+            self._start = (self._start + 1) % self.capacity
+
+    def extend(self, values):
+        values = list(values)
+        if len(values) >= self.capacity:
+            # Everything currently stored would be evicted
+            self._data = values[len(values) - self.capacity:]
+            self._start = 0
+            return
+
+        for value in values:
+            self.append(value)
+
+    def trim(self, length):
+        """
+        Evicts the oldest elements until at most length are left
+
+        :param length:
+        :return:
+        """
+        length = max(int(length), 0)
+        if len(self._data) > length:
+            self._data = self.to_list()[len(self._data) - length:]
+            self._start = 0
+
+    def slice(self, start=None, stop=None, step=None):
+        """
+        Reads a slice, costing only the number of elements returned
+
+        :return: list of the elements in the slice
+        """
+        length = len(self._data)
+        data = self._data
+        begin = self._start
+        return [data[(begin + index) % length] for index in range(*slice(start, stop, step).indices(length))]
+
+    def recent(self, num):
+        """
+        Reads the newest num elements, oldest first
+
+        :param num:
+        :return: list
+        """
+        return self.slice(max(len(self._data) - num, 0), None)
+
+    def to_list(self):
+        return self._data[self._start:] + self._data[:self._start]
@@ -0,0 +1,283 @@
+import array
+import base64
+import bisect
+import sys
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Item types stored as a Series, mapped to the array typecode of their values
+SERIES_TYPES = {"int64": "q", "float64": "d", "timeseries": "d"}
+
+
+class Series:
+    """
+        Bounded list of machine numbers in array buffers, evicting its oldest element past its capacity
+
+        A timeseries holds [timestamp, value] elements in two parallel float64 arrays.
+    """
+    def __init__(self, dtype, capacity, values=()):
+        if dtype not in SERIES_TYPES:
+            raise ValueError("Unknown series type " + str(dtype))
+
+        self.dtype = dtype
+        self.capacity = capacity
+        self._data = array.array(SERIES_TYPES[dtype])
+        self._times = array.array("d") if dtype == "timeseries" else None
+        # Position in the arrays of the oldest element, the evicted prefix is dropped once it outgrows the rest
+        self._start = 0
+
+        self.extend(values)
+
+    def __len__(self):
+        return len(self._data) - self._start
+
+    def _position(self, index):
+        length = len(self)
+        if index < 0:
+            index += length
+        if index < 0 or index >= length:
+            raise IndexError("Series index out of range")
+
+        return self._start + index
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.slice(index.start, index.stop, index.step)
+
+        position = self._position(index)
+        if self._times is not None:
+            return [self._times[position], self._data[position]]
+        return self._data[position]
+
+    def __setitem__(self, index, value):
+        position = self._position(index)
+        if self._times is not None:
+            timestamp, value = self._sample(value, self._times[position])
+            self._times[position] = timestamp
+        self._data[position] = self._number(value)
+
+    def __iter__(self):
+        for position in range(self._start, len(self._data)):
+            if self._times is not None:
+                yield [self._times[position], self._data[position]]
+            else:
+                yield self._data[position]
+
+    def __eq__(self, other):
+        if isinstance(other, Series):
+            other = other.to_list()
+        return self.to_list() == other
+
+    def __repr__(self):
+        return "Series(%r, %i, %r)" % (self.dtype, self.capacity, self.to_list())
+
+    def _number(self, value):
+        return int(value) if self.dtype == "int64" else float(value)
+
+    def _sample(self, value, timestamp=None):
+        """
+        Splits a timeseries element into its timestamp and value, bare values are stamped with the given time
+
+        :param value: [timestamp, value] or a bare value
+        :param timestamp:
+        :return: (timestamp, value)
+        """
+        if isinstance(value, (list, tuple)):
+            return float(value[0]), float(value[1])
+        return (time.time() if timestamp is None else timestamp), float(value)
+
+    def normalize(self, values):
+        """
+        Converts appended values to the elements stored, stamping bare timeseries values with the current time
+
+        Appends are logged in this form, so replaying them stores the same timestamps.
+        :param values: a value or a list of values
+        :return: list of elements
+        """
+        if not isinstance(values, (list, tuple, array.array)):
+            values = [values]
+        if self._times is not None:
+            now = time.time()
+            return [list(self._sample(value, now)) for value in values]
+        return [self._number(value) for value in values]
+
+    def append(self, value):
+        self.extend([value])
+
+    def extend(self, values):
+        if self._times is None and isinstance(values, array.array) and values.typecode == self._data.typecode:
+            self._data.extend(values)
+        elif self._times is not None:
+            for timestamp, value in self.normalize(values):
+                self._times.append(timestamp)
+                self._data.append(value)
+        else:
+            self._data.extend(self.normalize(values))
+
+        self._trim()
+
+    def trim(self, length):
+        """
+        Evicts the oldest elements until at most length are left
+
+        :param length:
+        :return:
+        """
+        excess = len(self) - max(int(length), 0)
+        if excess > 0:
+            self._start += excess
+            self._trim()
+
+    def _trim(self):
+        excess = len(self) - self.capacity
+        if excess > 0:
+            self._start += excess
+
+        if self._start > len(self):
+            del self._data[:self._start]
+            if self._times is not None:
+                del self._times[:self._start]
+            self._start = 0
+
+    def slice(self, start=None, stop=None, step=None):
+        """
+        Reads a slice, numbers come back as an array and timeseries elements as a list of [timestamp, value]
+
+        :return:
+        """
+        indexes = range(*slice(start, stop, step).indices(len(self)))
+        if len(indexes) == 0:
+            data, times = array.array(self._data.typecode), array.array("d")
+        else:
+            begin = self._start + indexes.start
+            end = self._start + indexes.stop
+            # A negative step running to the first element must not wrap around to the end
+            end = end if end >= 0 else None
+            data = self._data[begin:end:indexes.step]
+            times = self._times[begin:end:indexes.step] if self._times is not None else None
+
+        if self._times is not None:
+            return [[timestamp, value] for timestamp, value in zip(times, data)]
+        return data
+
+    def recent(self, num):
+        """
+        Reads the newest num elements, oldest first
+
+        :param num:
+        :return:
+        """
+        return self.slice(max(len(self) - num, 0), None)
+
+    def values(self, start=0, stop=None):
+        """
+        Gets a copy of the values between two indexes, without timestamps
+
+        :param start:
+        :param stop:
+        :return: array
+        """
+        start, stop, _ = slice(start, stop).indices(len(self))
+        return self._data[self._start + start:self._start + max(start, stop)]
+
+    def timestamps(self, start=0, stop=None):
+        if self._times is None:
+            return None
+        start, stop, _ = slice(start, stop).indices(len(self))
+        return self._times[self._start + start:self._start + max(start, stop)]
+
+    def index_at(self, timestamp):
+        """
+        Finds the first element of a timeseries stamped at or after a time, timestamps are assumed to be ascending
+
+        :param timestamp:
+        :return: the index
+        """
+        return bisect.bisect_left(self._times, timestamp, self._start) - self._start
+
+    def to_numpy(self):
+        """
+        Gets a numpy view of the values without copying them, the series can not grow while the view is alive
+
+        :return: numpy array, or None if numpy is not installed
+        """
+        if numpy is None:
+            return None
+        view = numpy.frombuffer(self._data, dtype=numpy.int64 if self.dtype == "int64" else numpy.float64)
+        return view[self._start:]
+
+    def to_list(self):
+        if self._times is not None:
+            return self.slice()
+        return self.values().tolist()
+
+    def to_wire(self):
+        """
+        Gets the value sent to clients, codecs send arrays as packed numbers
+
+        :return:
+        """
+        if self._times is not None:
+            return {"times": self.timestamps(), "values": self.values()}
+        return self.values()
+
+    def encode(self):
+        """
+        Gets the on-disk form, the buffers as base64 of little endian bytes
+
+        :return: dict
+        """
+        encoded = {"dtype": self.dtype, "capacity": self.capacity, "data": _encode_array(self.values())}
+        if self._times is not None:
+            encoded["times"] = _encode_array(self.timestamps())
+        return encoded
+
+    @classmethod
+    def from_value(cls, dtype, capacity, value):
+        """
+        Builds a series from a list of elements, or from its on-disk or wire form
+
+        :param dtype:
+        :param capacity:
+        :param value:
+        :return:
+        """
+        if isinstance(value, Series):
+            return value
+        if isinstance(value, dict) and "data" in value:
+            return cls.decode(value, capacity)
+        if isinstance(value, dict) and "values" in value:
+            value = [[timestamp, number] for timestamp, number in zip(value["times"], value["values"])] \
+                if dtype == "timeseries" else value["values"]
+        if not isinstance(value, (list, tuple, array.array)):
+            raise ValueError("A %s item holds a list of numbers, not %r" % (dtype, value))
+        return cls(dtype, capacity, value)
+
+    @classmethod
+    def decode(cls, encoded, capacity=None):
+        series = cls(encoded["dtype"], encoded.get("capacity", capacity))
+        series._data = _decode_array(SERIES_TYPES[series.dtype], encoded["data"])
+        if series._times is not None:
+            series._times = _decode_array("d", encoded["times"])
+        series._trim()
+        return series
+
+
+def _encode_array(values):
+    if sys.byteorder != "little":
+        values = array.array(values.typecode, values)
+        values.byteswap()
+    return base64.b64encode(values.tobytes()).decode()
+
+
+def _decode_array(typecode, encoded):
+    values = array.array(typecode)
+    values.frombytes(base64.b64decode(encoded))
+    if sys.byteorder != "little":
+        values.byteswap()
+    return values
@@ -0,0 +1,376 @@
+import asyncio
+import itertools
+import multiprocessing
+import os
+import pickle
+import signal
+import socket
+import struct
+import sys
+import time
+import zlib
+
+import websockets
+
+try:
+    from ACIServer import Server, ServerClient, command
+    from metrics import Metrics
+except Exception:
+    from ACIpy.ACIServer import Server, ServerClient, command
+    from ACIpy.metrics import Metrics
+
+
+# Messages between the front process and a worker are length prefixed pickles:
+#   front -> worker: ("cmd", forward_id, session_id, user, cmd) and ("close", session_id)
+#   worker -> front: ("resp", forward_id, response) and ("push", session_id, packet)
+_LENGTH = struct.Struct(">I")
+
+
+def shard_for(db_key, count):
+    """
+    Gets the index of the worker owning a database
+
+    :param db_key:
+    :param count: number of workers
+    :return:
+    """
+    return zlib.crc32(db_key.encode()) % count
+
+
+def _frame(message):
+    data = pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL)
+    return _LENGTH.pack(len(data)) + data
+
+
+async def _read_message(reader):
+    try:
+        header = await reader.readexactly(_LENGTH.size)
+        data = await reader.readexactly(_LENGTH.unpack(header)[0])
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return None
+    return pickle.loads(data)
+
+
+class FrontSession(ServerClient):
+    """
+        Client session held by the front process, known to workers by its session id
+    """
+    def __init__(self, clientWebsocket, session_id):
+        super().__init__(clientWebsocket)
+        self.session_id = session_id
+        # Indexes of the workers which hold state for this session
+        self.shards = set()
+
+
+class ShardSession:
+    """
+        Stand in for a front process session inside a worker, pushes are relayed through the front
+    """
+    def __init__(self, worker, session_id):
+        self.worker = worker
+        self.session_id = session_id
+        self.id = None
+        self.user_type = None
+        self.user_id = None
+        self.user = "NotAuthed"
+        self.subscriptions = set()
+        self.streams = {}
+        self.uploads = {}
+
+    async def send(self, packet):
+        await self.worker.send_message(("push", self.session_id, packet))
+
+
+class WorkerLink:
+    """
+        Front process end of the connection to one worker
+    """
+    def __init__(self, index, process, reader, writer):
+        self.index = index
+        self.process = process
+        self.reader = reader
+        self.writer = writer
+        # Futures awaiting the worker's response, keyed by forward id
+        self.pending = {}
+
+
+class ShardedServer(Server):
+    """
+        Server spreading its databases across worker processes
+
+        The front process accepts every websocket, authenticates sessions and owns the config database. Commands on
+        any other database are forwarded to the worker owning it, chosen by hashing the database key, so each
+        database still has a single writer while separate databases use separate cores. The worker count is read
+        from the "workers" config item and defaults to the number of CPUs.
+
+        Workers are started with the spawn method, so the script starting the server needs an
+        if __name__ == "__main__" guard.
+    """
+    # Commands always handled by the front process
+    front_commands = {"hello", "g_auth", "a_auth", "event"}
+
+    def __init__(self, loop, ip="localhost", port=8765, _="", workers=None):
+        super().__init__(loop, ip, port, _)
+        self.worker_count = workers
+        self.workers = []
+        self.sessions = {}
+        self._session_ids = itertools.count()
+        self._forward_ids = itertools.count()
+
+    def start(self):
+        """
+        Starts the workers, then the server running
+        :return:
+        """
+        asyncio.set_event_loop(self.loop)
+        self.load_config()
+        self.loop.run_until_complete(self.start_workers())
+        self.loop.run_until_complete(websockets.serve(self.connection_handler, self.ip, self.port))
+        self.serve_metrics()
+        self.loop.run_forever()
+
+    async def start_workers(self):
+        count = self.worker_count or self.dbs["config"].get("workers", "backend") or os.cpu_count() or 1
+        context = multiprocessing.get_context("spawn")
+
+        for index in range(count):
+            front_socket, worker_socket = socket.socketpair()
+            process = context.Process(target=_run_worker, args=(index, count, worker_socket, self.worker_settings()),
+                                      daemon=True, name="ACI shard %i" % index)
+            process.start()
+            worker_socket.close()
+
+            reader, writer = await asyncio.open_connection(sock=front_socket)
+            link = WorkerLink(index, process, reader, writer)
+            self.workers.append(link)
+            asyncio.ensure_future(self._read_worker(link))
+
+        print("Started %i shard workers" % count)
+
+    def worker_settings(self):
+        """
+        Gets the settings a worker starts with before reading config, as they may have been set on this instance
+        :return:
+        """
+        return {"rootDir": self.rootDir, "storage": self.storage, "flush_mode": self.flusher.mode,
+                "flush_interval": self.flusher.flush_interval}
+
+    def open_database(self, db_key, read, storage=None):
+        # Every other database is opened by the worker owning it
+        if db_key == "config":
+            return super().open_database(db_key, read, storage)
+        return None
+
+    def create_session(self, websocket):
+        session = FrontSession(websocket, next(self._session_ids))
+        self.sessions[session.session_id] = session
+        return session
+
+    def close_session(self, session):
+        super().close_session(session)
+        self.sessions.pop(session.session_id, None)
+        for index in session.shards:
+            self.workers[index].writer.write(_frame(("close", session.session_id)))
+
+    async def dispatch(self, session, cmd, errors=False):
+        db_key = cmd.get("db_key")
+        if cmd.get("cmd") in self.front_commands or db_key is None or db_key == "config" or not self.workers:
+            return await super().dispatch(session, cmd, errors)
+
+        if db_key == "":
+            # An empty db_key addresses every database, as wtd does
+            responses = await asyncio.gather(*[self.forward(link, session, cmd) for link in self.workers])
+            await super().dispatch(session, cmd)
+            return responses[0]
+
+        return await self.forward(self.workers[shard_for(db_key, len(self.workers))], session, cmd)
+
+    @command("snapshot_status")
+    async def _snapshot_status(self, session, cmd):
+        if cmd.get("db_key") or not self.workers:
+            return await super()._snapshot_status(session, cmd)
+
+        # Every shard reports its own databases
+        status = (await super()._snapshot_status(session, cmd))["msg"]
+        for response in await asyncio.gather(*[self.forward(link, session, cmd) for link in self.workers]):
+            if response is not None and response.get("cmd") == "snapshot_statusResp":
+                status.update(response["msg"])
+        return {"cmd": "snapshot_statusResp", "msg": status}
+
+    @command("stats")
+    async def _stats(self, session, cmd):
+        if not self.workers or cmd.get("format") == "raw":
+            return await super()._stats(session, cmd)
+
+        # Worker metrics are merged in with a shard label
+        combined = Metrics()
+        combined.merge(self.metrics.export())
+        responses = await asyncio.gather(*[self.forward(link, session, {"cmd": "stats", "format": "raw",
+                                                                         "req_id": cmd.get("req_id")})
+                                           for link in self.workers])
+        for link, response in zip(self.workers, responses):
+            if response is not None and response.get("cmd") == "statsResp":
+                combined.merge(response["msg"], (("shard", str(link.index)),))
+
+        if cmd.get("format") == "prometheus":
+            return {"cmd": "statsResp", "msg": combined.to_prometheus()}
+        return {"cmd": "statsResp", "msg": combined.snapshot()}
+
+    async def forward(self, link, session, cmd):
+        """
+        Runs a command on a worker
+        :param link:
+        :param session:
+        :param cmd:
+        :return: the worker's response packet, or None
+        """
+        if link.reader.at_eof():
+            print("Shard worker %i is not running" % link.index)
+            if cmd.get("req_id") is None:
+                return None
+            return {"cmd": "error", "msg": "ERROR - shard worker %i is not running" % link.index}
+
+        forward_id = next(self._forward_ids)
+        future = self.loop.create_future()
+        link.pending[forward_id] = future
+        session.shards.add(link.index)
+        try:
+            link.writer.write(_frame(("cmd", forward_id, session.session_id, session.user, cmd)))
+            await link.writer.drain()
+            return await future
+        finally:
+            link.pending.pop(forward_id, None)
+
+    async def _read_worker(self, link):
+        while True:
+            message = await _read_message(link.reader)
+            if message is None:
+                break
+
+            if message[0] == "resp":
+                future = link.pending.get(message[1])
+                if future is not None and not future.done():
+                    future.set_result(message[2])
+            elif message[0] == "push":
+                session = self.sessions.get(message[1])
+                if session is not None:
+                    asyncio.ensure_future(self._push(session, message[2]))
+
+        print("Shard worker %i exited" % link.index)
+        for forward_id in list(link.pending):
+            future = link.pending.pop(forward_id)
+            if not future.done():
+                future.set_result({"cmd": "error", "msg": "ERROR - shard worker %i exited" % link.index})
+
+
+class ShardWorker(Server):
+    """
+        Worker process of a ShardedServer, runs the commands on the databases it owns
+    """
+    def __init__(self, loop, index, count):
+        super().__init__(loop)
+        self.index = index
+        self.count = count
+        self.sessions = {}
+        self._writer = None
+        # Tasks of the forwarded commands still running, keyed by forward id
+        self._running = {}
+
+    def open_database(self, db_key, read, storage=None):
+        # The config database is only read here, the front process owns it
+        if db_key != "config" and shard_for(db_key, self.count) != self.index:
+            return None
+        return super().open_database(db_key, read, storage)
+
+    def write_to_disk(self, db_key):
+        # The worker's copy of config is only read at startup, writing it would undo the front process's changes
+        for db in (list(self.dbs) if db_key == "" else [db_key]):
+            if db != "config":
+                super().write_to_disk(db)
+
+    def trace_log_path(self):
+        # Each process rotates its own log
+        return super().trace_log_path() + ".shard%i" % self.index
+
+    async def serve(self, sock):
+        """
+        Runs the commands forwarded by the front process until it disconnects
+
+        Each command runs in its own task, so a command waiting on disk in the per_write flush mode does not hold
+        back the other sessions of the shard. The front process sends a session's next command only once it has the
+        previous response, which keeps every session's commands in order.
+        :param sock:
+        :return:
+        """
+        reader, self._writer = await asyncio.open_connection(sock=sock)
+        while True:
+            message = await _read_message(reader)
+            if message is None:
+                break
+
+            if message[0] == "cmd":
+                _, forward_id, session_id, user, cmd = message
+                session = self.sessions.get(session_id)
+                if session is None:
+                    session = self.sessions[session_id] = ShardSession(self, session_id)
+                session.user = user
+                if user != "NotAuthed":
+                    session.user_type = user["user_type"]
+                    session.user_id = user["user_id"]
+
+                self._running[forward_id] = asyncio.ensure_future(self.run_forwarded(forward_id, session, cmd))
+            elif message[0] == "close":
+                session = self.sessions.pop(message[1], None)
+                if session is not None:
+                    self.close_session(session)
+
+        if self._running:
+            await asyncio.gather(*self._running.values(), return_exceptions=True)
+
+    async def run_forwarded(self, forward_id, session, cmd):
+        """
+        Runs one forwarded command and sends its response back to the front process
+        :param forward_id:
+        :param session:
+        :param cmd:
+        :return:
+        """
+        try:
+            started = time.perf_counter()
+            trace = self.tracer.begin(0) if self.tracer is not None else None
+            if trace is not None:
+                trace.describe(cmd)
+            response = await self.execute(session, cmd)
+            if trace is not None:
+                trace.add("execute", time.perf_counter() - started)
+            await self.send_message(("resp", forward_id, response))
+
+            self.record_command(cmd, response, 0, time.perf_counter() - started)
+            if trace is not None:
+                self.tracer.end(trace)
+        except ConnectionError:
+            pass
+        finally:
+            self._running.pop(forward_id, None)
+
+    async def send_message(self, message):
+        self._writer.write(_frame(message))
+        await self._writer.drain()
+
+
+def _run_worker(index, count, sock, settings):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    # Terminating the worker still writes out its queued log records
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+    worker = ShardWorker(loop, index, count)
+    # Config is read from the front process's root, not the worker's working directory
+    worker.rootDir = settings["rootDir"]
+    worker.storage = settings["storage"]
+    worker.flusher.configure(settings["flush_mode"], settings["flush_interval"])
+    worker.load_config()
+    try:
+        loop.run_until_complete(worker.serve(sock))
+    finally:
+        worker.flusher.flush()
@@ -0,0 +1,98 @@
+import threading
+import time
+import traceback
+
+
+class Snapshot:
+    """
+        Point in time copy of the items loaded in a Database, serialized on its own thread while writes keep flowing
+
+        Items are captured by reference. One about to be mutated before the thread reached it is serialized first by
+        the writer, so the snapshot keeps the value it had when the snapshot started.
+    """
+    def __init__(self, database, items, seq, done_callback):
+        """
+        :param database:
+        :param items: dict of the captured Items by key
+        :param seq: sequence number of the last log record the snapshot contains
+        :param done_callback: called from the snapshot thread with the Snapshot once every item is serialized
+        """
+        self.database = database
+        self.seq = seq
+        self.keys = list(items)
+        self.total = len(items)
+        self.serialized = {}
+        self._pending = items
+        self._lock = threading.Lock()
+        self._done_callback = done_callback
+        self.cancelled = False
+
+        self.state = "running"
+        self.error = None
+        self.copied_on_write = 0
+        self.started_at = time.time()
+        self._started = time.perf_counter()
+        self.serialize_duration = None
+        self.duration = None
+
+        self._thread = threading.Thread(target=self._run, name="ACI-Snapshot-%s" % database.name, daemon=True)
+        self._thread.start()
+
+    def before_write(self, key):
+        """
+        Serializes an item still waiting for the snapshot thread, called before the item is mutated
+
+        :param key:
+        :return:
+        """
+        with self._lock:
+            item = self._pending.pop(key, None)
+            if item is not None:
+                self.serialized[key] = item.to_json()
+                self.copied_on_write += 1
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            self._pending.clear()
+        self.state = "cancelled"
+
+    def _run(self):
+        try:
+            while True:
+                with self._lock:
+                    if not self._pending:
+                        break
+                    key, item = self._pending.popitem()
+                    self.serialized[key] = item.to_json()
+        except Exception as e:
+            traceback.print_exc()
+            self.error = str(e)
+            self.state = "failed"
+
+        self.serialize_duration = time.perf_counter() - self._started
+        if not self.cancelled:
+            self._done_callback(self)
+
+    def finish(self):
+        """
+        Marks the snapshot written, called once its compaction has been handed to the writer
+
+        :return:
+        """
+        if self.state == "running":
+            self.state = "done"
+        self.duration = time.perf_counter() - self._started
+
+    def status(self):
+        return {"state": self.state,
+                "seq": self.seq,
+                "items": self.total,
+                "serialized": len(self.serialized),
+                "progress": len(self.serialized) / self.total if self.total else 1.0,
+                "copied_on_write": self.copied_on_write,
+                "started_at": self.started_at,
+                "elapsed": (time.perf_counter() - self._started) if self.duration is None else self.duration,
+                "serialize_duration": self.serialize_duration,
+                "duration": self.duration,
+                "error": self.error}
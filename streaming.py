@@ -0,0 +1,99 @@
+import asyncio
+
+
+# Defaults of the chunked transfers, chunks are list elements or characters of a string
+DEFAULT_CHUNK_SIZE = 1000
+DEFAULT_WINDOW = 4
+
+
+def chunk_kind(value):
+    """
+    Gets how a value is split into chunks
+
+    :param value:
+    :return: "list", "string", or "value" for values sent whole in a single chunk
+    """
+    if isinstance(value, (list, tuple)):
+        return "list"
+    if isinstance(value, str):
+        return "string"
+    return "value"
+
+
+def split_chunks(value, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Splits a value into the chunks it is transferred in
+
+    :param value:
+    :param chunk_size: list elements or characters per chunk
+    :return: generator of chunks
+    """
+    kind = chunk_kind(value)
+    if kind == "value":
+        yield value
+        return
+
+    for start in range(0, len(value), chunk_size):
+        chunk = value[start:start + chunk_size]
+        yield list(chunk) if kind == "list" else chunk
+
+
+def join_chunks(kind, chunks):
+    """
+    Rebuilds a value from its chunks
+
+    :param kind: chunk_kind of the value
+    :param chunks:
+    :return:
+    """
+    if kind == "list":
+        value = []
+        for chunk in chunks:
+            value.extend(chunk)
+        return value
+    if kind == "string":
+        return "".join(chunks)
+    return chunks[0] if chunks else None
+
+
+class StreamState:
+    """
+        Server side flow control of one outgoing stream, at most window chunks are sent ahead of the client's acks
+    """
+    def __init__(self, window=DEFAULT_WINDOW):
+        self.window = max(int(window), 1)
+        # Number of chunks the client has consumed
+        self.acked = 0
+        self.cancelled = False
+        self._event = asyncio.Event()
+
+    def ack(self, seq):
+        self.acked = max(self.acked, seq + 1)
+        self._event.set()
+
+    def cancel(self):
+        self.cancelled = True
+        self._event.set()
+
+    async def wait_for_credit(self, seq):
+        while seq - self.acked >= self.window and not self.cancelled:
+            self._event.clear()
+            await self._event.wait()
+
+
+class UploadState:
+    """
+        Server side staging of one chunked upload, applied as a single write once complete
+    """
+    def __init__(self, key, kind):
+        self.key = key
+        self.kind = kind
+        self.chunks = []
+
+    def add(self, seq, data):
+        if seq != len(self.chunks):
+            raise ValueError("Expected chunk %i of %s, got %i" % (len(self.chunks), self.key, seq))
+        self.chunks.append(data)
+
+    def value(self):
+        return join_chunks(self.kind, self.chunks)
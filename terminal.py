@@ -20,7 +20,9 @@ usages = {"help": "help",
           "set_ind":"set_ind [key] [database] [index] [value]",
           "app_ind":"app_ind [key] [database] [value]",
           "get_len_ind":"get_len_ind [key] [database]",
-          "get_rec_ind":"get_rec_ind [key] [database] [num]"}
+          "get_rec_ind":"get_rec_ind [key] [database] [num]",
+          "get_range":"get_range [key] [database] [start] [stop] [step]",
+          "cser":"cser [key] [database] [type] [capacity]"}
 info = {"help": "Displays help information",
         "conn": "Connects to a new server defaults to [main] 127.0.0.1:8765",
         "lsconn": "Lists all of the currently open connections",
@@ -37,11 +39,13 @@ info = {"help": "Displays help information",
         "set_ind":"Sets a value at an index in a table",
         "app_ind":"Appends a value to the end of a table",
         "get_len_ind":"Gets the length of a table",
-        "get_rec_ind":"Returns given number of recent indexs from a table"}
+        "get_rec_ind":"Returns given number of recent indexs from a table",
+        "get_range":"Returns a slice of a table, negative indexs count from the end",
+        "cser":"Creates a typed table of int64, float64 or timeseries values"}
 
 
 async def _test():
-    connections["main"]["db1"]["val"] += "1"
+    await connections["main"]["db1"].append_string("val", "1")
 
 
 async def _help():
@@ -135,10 +139,17 @@ async def _get_len_index(key, db_key, server="main"):
 async def _get_recent_index(key, db_key, num, server="main"):
     print(await connections[server][db_key].get_recent_index(key, num))
 
+async def _get_range(key, db_key, start=None, stop=None, step=None, server="main"):
+    print(await connections[server][db_key].get_range(key, start, stop, step))
+
+async def _create_series(key, db_key, dtype, capacity=None, server="main"):
+    print(await connections[server][db_key].create_series(key, dtype, capacity))
+
 
 instructions = {"help": _help, "conn": _connect, "lsconn": _list_connections, "get": _get, "set": _set, "ls": _list,
                 "write": _write, "read": _read, "test": _test, "cdb": _create_database, "auth":_authenticate, "get_ind":_get_index,
-                "set_ind":_set_index, "app_ind":_append_index, "get_len_ind":_get_len_index, "get_rec_ind":_get_recent_index}
+                "set_ind":_set_index, "app_ind":_append_index, "get_len_ind":_get_len_index, "get_rec_ind":_get_recent_index,
+                "get_range":_get_range, "cser":_create_series}
 
 
 async def main():
@@ -0,0 +1,60 @@
+import array
+import math
+
+import pytest
+
+from codec import BinaryCodec, CODECS, decode_frame, negotiate
+
+
+def roundtrip(value):
+    codec = BinaryCodec()
+    return codec.decode(codec.encode(value))
+
+
+@pytest.mark.parametrize("value", [0, 1, -1, 2 ** 63 - 1, -2 ** 63])
+def test_int64_bounds_roundtrip(value):
+    assert roundtrip(value) == value
+    assert roundtrip([value, 0]) == [value, 0]
+
+
+@pytest.mark.parametrize("value", [2 ** 63, -2 ** 63 - 1, 10 ** 40, -10 ** 40])
+def test_big_ints_roundtrip(value):
+    assert roundtrip(value) == value
+    # A list holding one is not packed as an int64 array
+    assert roundtrip([1, value]) == [1, value]
+
+
+def test_floats_roundtrip():
+    values = [0.0, -0.0, 1.5, -2.25e-300, 1.7976931348623157e308, math.inf, -math.inf]
+    for value in values:
+        assert roundtrip(value) == value
+    assert roundtrip(values) == values
+    assert math.isnan(roundtrip(math.nan))
+    assert math.copysign(1, roundtrip(-0.0)) == -1
+
+
+def test_nested_dicts_and_empty_lists_roundtrip():
+    packet = {"cmd": "getResp", "req_id": 7, "val": {"nested": {"list": [], "mixed": [1, "two", None, True, 3.5],
+                                                                  "deeper": {"": [[], [[]]]}}},
+              "empty": {}, "flag": False, "raw": b"\x00\xff", 5: "int key"}
+
+    assert roundtrip(packet) == packet
+    assert roundtrip([]) == []
+    assert roundtrip({}) == {}
+
+
+def test_arrays_are_sent_packed():
+    assert roundtrip(array.array("q", [1, -2, 3])) == [1, -2, 3]
+    assert roundtrip(array.array("f", [0.5, 1.5])) == [0.5, 1.5]
+    assert roundtrip(array.array("i", [4, 5])) == [4, 5]
+
+
+def test_frames_are_decoded_by_their_type():
+    binary = CODECS["aci-binary"]
+    assert decode_frame(binary, '{"cmd": "hello"}') == {"cmd": "hello"}
+    assert decode_frame(binary, binary.encode({"cmd": "hello"})) == {"cmd": "hello"}
+
+
+def test_negotiate_falls_back_to_json():
+    assert negotiate(["unknown"]).name == "json"
+    assert negotiate(["aci-binary", "json"]).name == "aci-binary"
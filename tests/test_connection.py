@@ -0,0 +1,30 @@
+import asyncio
+
+import pytest
+
+websockets = pytest.importorskip("websockets")
+
+from ACIConnection import Connection
+
+
+def test_hello_keeps_json_when_the_server_never_answers():
+    async def scenario():
+        async def server_without_hello(websocket, path=None):
+            async for _ in websocket:
+                pass
+
+        server = await websockets.serve(server_without_hello, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        connection = Connection(asyncio.get_running_loop(), "127.0.0.1", port, "test", codecs=["aci-binary", "json"])
+        connection.hello_timeout = 0.1
+        task = asyncio.ensure_future(connection.start())
+        try:
+            await asyncio.wait_for(connection._wait_ready(), 5)
+            return connection.codec.name
+        finally:
+            await connection.close()
+            task.cancel()
+            server.close()
+            await server.wait_closed()
+
+    assert asyncio.run(scenario()) == "json"
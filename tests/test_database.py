@@ -0,0 +1,84 @@
+from database import Database, ItemCache
+
+
+def open_db(tmp_path, **kwargs):
+    return Database("db1", read=True, root_dir=str(tmp_path) + "/", **kwargs)
+
+
+def test_transaction_writes_nothing_if_a_value_does_not_fit(tmp_path):
+    db = open_db(tmp_path)
+    db.set("a", "old", "backend")
+    db.create_series("s", "int64", "backend")
+
+    assert db.transaction({}, {"a": "new", "s": "not a list"}, "backend").startswith("ERROR")
+    assert db.get("a", "backend") == "old"
+
+    db.close()
+    assert open_db(tmp_path).get("a", "backend") == "old"
+
+
+def test_transaction_keeps_writes_when_the_cache_evicts(tmp_path):
+    db = open_db(tmp_path, cache=ItemCache(budget=1))
+    db.set("k1", "OLD", "backend")
+    db.write_to_disk()
+
+    assert db.transaction({}, {"k1": "NEW", "k2": "fresh"}, "backend") == "Success"
+    assert db.get("k1", "backend") == "NEW"
+
+    db.close()
+    reopened = open_db(tmp_path)
+    assert reopened.get("k1", "backend") == "NEW"
+    assert reopened.get("k2", "backend") == "fresh"
+
+
+def test_atomic_ops_let_the_creator_use_the_keys_they_create(tmp_path):
+    user = {"user_type": "a_user", "user_id": "creator"}
+    other = {"user_type": "a_user", "user_id": "other"}
+    db = open_db(tmp_path)
+
+    assert db.increment("ctr", 1, user) == 1
+    assert db.increment("ctr", 1, user) == 2
+    assert db.append_string("log", "a", user) == "a"
+    assert db.compare_and_set("lock", "held", user, None) is True
+    assert db.compare_and_set("lock", "free", user, "held") is True
+    assert db.increment("ctr", 1, other) == "Access Denied"
+    assert db.increment("anon", 1, "NotAuthed") == "Access Denied"
+
+    db.close()
+    reopened = open_db(tmp_path)
+    assert reopened.get("ctr", user) == 2
+    assert reopened.get("log", user) == "a"
+    assert reopened.get("lock", user) == "free"
+
+
+def test_transaction_lets_the_creator_use_the_keys_it_creates(tmp_path):
+    user = {"user_type": "a_user", "user_id": "creator"}
+    other = {"user_type": "a_user", "user_id": "other"}
+    db = open_db(tmp_path)
+
+    assert db.transaction({"new": None}, {"new": "value"}, user) == "Success"
+    assert db.get("new", user) == "value"
+    assert db.get("new", other) != "value"
+    assert db.transaction({}, {"anon": "value"}, "NotAuthed") == "Access Denied"
+    assert "anon" not in db.data
+
+    db.close()
+    assert open_db(tmp_path).get("new", user) == "value"
+
+
+def test_cache_counts_new_values_against_the_budget(tmp_path):
+    cache = ItemCache(budget=5000)
+    db = open_db(tmp_path, cache=cache)
+    for index in range(10):
+        db.set("k%i" % index, "x" * 1000, "backend")
+    # Not compacted yet, so every item is dirty and kept, but measured
+    assert cache.size >= 10000
+
+    db.data["k0"].subs.add("subscriber")
+    db.write_to_disk()
+    db.set("new", "y" * 1000, "backend")
+
+    assert cache.size <= 5000
+    assert "k0" in db.data.loaded_keys()
+    assert "new" in db.data.loaded_keys()
+    assert db.get("k5", "backend") == "x" * 1000
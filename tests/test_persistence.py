@@ -0,0 +1,99 @@
+import asyncio
+import queue
+import time
+
+from database import Database
+from flusher import Flusher
+
+
+def open_db(tmp_path, **kwargs):
+    return Database("db1", read=True, root_dir=str(tmp_path) + "/", **kwargs)
+
+
+def test_log_is_replayed_after_restart(tmp_path):
+    db = open_db(tmp_path)
+    db.set("val", "v1", "backend")
+    db.set("lst", [1, 2], "backend")
+    db.append_index("lst", [3], "backend")
+    db.set("val", "v2", "backend")
+    db.close()
+
+    reopened = open_db(tmp_path)
+    assert reopened.get("val", "backend") == "v2"
+    assert reopened.get("lst", "backend") == [1, 2, 3]
+    assert reopened.seq == db.seq
+
+
+def test_close_writes_records_still_queued(tmp_path):
+    # As rfd does, reopening a database must not lose acknowledged writes the flusher has not written yet
+    flusher = Flusher("interval", flush_interval=60)
+    db = open_db(tmp_path, flusher=flusher)
+    db.set("val", "v1", "backend")
+    flusher.flush()
+    db.set("val", "v2", "backend")
+    db.close()
+
+    reopened = open_db(tmp_path, flusher=flusher)
+    assert reopened.get("val", "backend") == "v2"
+    reopened.compact()
+    reopened.close()
+    assert open_db(tmp_path).get("val", "backend") == "v2"
+
+
+def test_per_write_waits_for_the_record_on_disk(tmp_path):
+    flusher = Flusher("per_write")
+    db = open_db(tmp_path, flusher=flusher)
+    append_lines = db.log.append_lines
+
+    def slow_append_lines(lines, fsync=False):
+        time.sleep(0.2)
+        append_lines(lines, fsync)
+
+    db.log.append_lines = slow_append_lines
+    db.set("val", "v1", "backend")
+    assert flusher.completed < flusher.submitted
+
+    asyncio.run(flusher.wait_written())
+    assert flusher.completed == flusher.submitted
+    assert db.log.size > 0
+
+
+def test_snapshot_keeps_writes_made_while_it_runs(tmp_path):
+    db = open_db(tmp_path)
+    for index in range(1000):
+        db.set("k%i" % index, "old%i" % index, "backend")
+
+    # Stands in for the event loop the snapshot hands its completion to
+    callbacks = queue.Queue()
+    snapshot = db.start_snapshot(lambda function, *args: callbacks.put((function, args)))
+    for index in range(0, 1000, 10):
+        db.set("k%i" % index, "new%i" % index, "backend")
+    db.set("created", "during", "backend")
+
+    function, args = callbacks.get(timeout=10)
+    function(*args)
+    assert snapshot.status()["state"] == "done"
+    assert snapshot.status()["serialized"] == 1000
+    db.close()
+
+    reopened = open_db(tmp_path)
+    assert reopened.get("k0", "backend") == "new0"
+    assert reopened.get("k1", "backend") == "old1"
+    assert reopened.get("created", "backend") == "during"
+
+
+def test_batched_set_keeps_the_create_before_it(tmp_path):
+    user = {"user_type": "a_user", "user_id": "creator"}
+    flusher = Flusher("interval", flush_interval=60)
+    db = open_db(tmp_path, flusher=flusher)
+    db.set("val", "v1", "backend")
+    db.set("val", "v2", "backend")
+    db.create_series("s", "int64", user)
+    db.set("s", [1, 2, 3], user)
+    flusher.flush()
+
+    reopened = open_db(tmp_path)
+    assert reopened.data["s"].type == "int64"
+    assert list(reopened.get("s", user)) == [1, 2, 3]
+    assert reopened.get("val", "backend") == "v2"
+    assert flusher.records_coalesced == 1
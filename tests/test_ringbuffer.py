@@ -0,0 +1,52 @@
+import pytest
+
+from ringbuffer import RingBuffer
+
+
+def test_append_past_capacity_evicts_the_oldest():
+    buffer = RingBuffer(3, [1, 2, 3])
+    buffer.append(4)
+    buffer.append(5)
+
+    assert len(buffer) == 3
+    assert buffer.to_list() == [3, 4, 5]
+    assert list(buffer) == [3, 4, 5]
+    assert buffer == [3, 4, 5]
+
+
+def test_indexing_follows_the_wrap_around():
+    buffer = RingBuffer(4, range(6))
+
+    assert [buffer[index] for index in range(4)] == [2, 3, 4, 5]
+    assert buffer[-1] == 5
+    assert buffer[-4] == 2
+    with pytest.raises(IndexError):
+        buffer[4]
+    with pytest.raises(IndexError):
+        buffer[-5]
+
+    buffer[-1] = "last"
+    buffer[0] = "first"
+    assert buffer.to_list() == ["first", 3, 4, "last"]
+
+
+def test_slices_and_recent_read_across_the_wrap():
+    buffer = RingBuffer(5, range(8))
+
+    assert buffer[1:4] == [4, 5, 6]
+    assert buffer[-2:] == [6, 7]
+    assert buffer[::-1] == [7, 6, 5, 4, 3]
+    assert buffer.recent(2) == [6, 7]
+    assert buffer.recent(10) == [3, 4, 5, 6, 7]
+
+
+def test_extend_and_trim_keep_the_newest():
+    buffer = RingBuffer(3, [1])
+    buffer.extend(range(10, 20))
+    assert buffer.to_list() == [17, 18, 19]
+
+    buffer.append(20)
+    buffer.trim(2)
+    assert buffer.to_list() == [19, 20]
+    buffer.append(21)
+    assert buffer.to_list() == [19, 20, 21]
@@ -0,0 +1,83 @@
+import array
+import time
+
+import pytest
+
+from series import Series
+
+
+def test_encode_decode_roundtrip():
+    series = Series("int64", 4, [1, -2, 2 ** 63 - 1, -2 ** 63, 5])
+    encoded = series.encode()
+
+    assert set(encoded) == {"dtype", "capacity", "data"}
+    assert isinstance(encoded["data"], str)
+    decoded = Series.decode(encoded)
+    assert decoded == [-2, 2 ** 63 - 1, -2 ** 63, 5]
+    assert decoded.capacity == 4
+    assert Series.from_value("int64", 10, encoded) == decoded
+
+
+def test_encoded_buffers_are_little_endian_base64():
+    assert Series("float64", 2, [1.0]).encode()["data"] == "AAAAAAAA8D8="
+    assert Series.decode({"dtype": "int64", "capacity": 2, "data": "AQAAAAAAAAA="}) == [1]
+
+
+def test_timeseries_roundtrip_keeps_timestamps():
+    series = Series("timeseries", 3, [[1.0, 10.0], [2.0, 20.5]])
+    decoded = Series.decode(series.encode())
+
+    assert decoded == [[1.0, 10.0], [2.0, 20.5]]
+    assert decoded.timestamps().tolist() == [1.0, 2.0]
+
+
+def test_decode_trims_to_the_capacity():
+    encoded = Series("float64", 10, [1.0, 2.0, 3.0]).encode()
+    encoded["capacity"] = 2
+
+    assert Series.decode(encoded) == [2.0, 3.0]
+
+
+def test_bare_timeseries_values_are_stamped_on_append():
+    series = Series("timeseries", 10)
+    before = time.time()
+    series.append(1.5)
+    series.extend([2.5, 3.5])
+    after = time.time()
+
+    stamps = series.timestamps().tolist()
+    assert series.values().tolist() == [1.5, 2.5, 3.5]
+    assert all(before <= stamp <= after for stamp in stamps)
+    # One extend is stamped with a single time
+    assert stamps[1] == stamps[2]
+
+    series.append([100.0, 4.5])
+    assert series[-1] == [100.0, 4.5]
+
+
+def test_normalize_stamps_values_once_for_replay():
+    series = Series("timeseries", 10)
+    elements = series.normalize([1.0, [5.0, 2.0]])
+
+    assert elements[1] == [5.0, 2.0]
+    series.extend(elements)
+    replayed = Series("timeseries", 10, elements)
+    assert replayed == series
+
+
+def test_append_past_capacity_evicts_the_oldest():
+    series = Series("int64", 3, [0, 1, 2, 3, 4])
+    series.append(5)
+
+    assert series == [3, 4, 5]
+    assert series[-1] == 5
+    assert series[0:2] == array.array("q", [3, 4])
+    with pytest.raises(IndexError):
+        series[3]
+
+
+def test_unknown_types_and_values_are_refused():
+    with pytest.raises(ValueError):
+        Series("int32", 3)
+    with pytest.raises(ValueError):
+        Series.from_value("int64", 3, "not a list")
@@ -0,0 +1,69 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("websockets")
+
+from ACIServer import Server, ServerClient
+
+
+@pytest.fixture
+def server(tmp_path):
+    loop = asyncio.new_event_loop()
+    server = Server(loop)
+    server.rootDir = str(tmp_path) + "/"
+    server.open_database("db1", read=False)
+    yield server
+    server.dbs["db1"].close()
+    loop.close()
+
+
+def run(server, session, cmd):
+    return server.loop.run_until_complete(server.dispatch(session, dict(cmd, req_id=1)))
+
+
+def test_batch_reports_failed_ops_in_their_slot(server):
+    session = ServerClient(None)
+    session.user = "backend"
+    run(server, session, {"cmd": "set_value", "db_key": "db1", "key": "val", "val": "v"})
+
+    response = run(server, session, {"cmd": "batch", "db_key": "db1",
+                                     "ops": [{"cmd": "get_value", "key": "val"},
+                                             {"cmd": "no_such_command"},
+                                             {"cmd": "get_index", "key": "missing", "index": 0},
+                                             {"cmd": "get_value", "key": "missing"}]})
+
+    results = response["msg"]
+    assert results[0] == "v"
+    assert results[1].startswith("ERROR - Unknown command")
+    assert results[2].startswith("ERROR")
+    assert results[3] is None
+
+
+def test_upload_lets_the_uploader_read_the_key_it_creates(server):
+    session = ServerClient(None)
+    session.authenticate("client", "a_user", "uploader")
+
+    run(server, session, {"cmd": "upload_begin", "db_key": "db1", "key": "big", "kind": "list"})
+    run(server, session, {"cmd": "upload_chunk", "db_key": "db1", "upload_id": 1, "seq": 0, "data": [1, 2]})
+    run(server, session, {"cmd": "upload_chunk", "db_key": "db1", "upload_id": 1, "seq": 1, "data": [3]})
+    assert run(server, session, {"cmd": "upload_end", "db_key": "db1", "upload_id": 1})["msg"] == "Success"
+
+    assert run(server, session, {"cmd": "get_list_length", "db_key": "db1", "key": "big"})["msg"] == 3
+
+    anonymous = ServerClient(None)
+    run(server, anonymous, {"cmd": "upload_begin", "db_key": "db1", "key": "anon", "kind": "string"})
+    run(server, anonymous, {"cmd": "upload_chunk", "db_key": "db1", "upload_id": 1, "seq": 0, "data": "x"})
+    assert run(server, anonymous, {"cmd": "upload_end", "db_key": "db1", "upload_id": 1})["msg"] == "Access Denied"
+
+
+def test_batch_ops_are_counted_in_the_command_metrics(server):
+    session = ServerClient(None)
+    session.user = "backend"
+    run(server, session, {"cmd": "batch", "db_key": "db1",
+                          "ops": [{"cmd": "set_value", "key": "val", "val": "v"},
+                                  {"cmd": "get_index", "key": "missing", "index": 0}]})
+
+    counters = server.metrics.snapshot()["counters"]
+    assert any("set_value" in name for name in counters if name.startswith("aci_commands_total"))
+    assert any("get_index" in name for name in counters if name.startswith("aci_command_errors_total"))
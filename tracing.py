@@ -0,0 +1,192 @@
+import collections
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import sys
+import threading
+import time
+
+
+# Trace of the command being handled by the current task, None when tracing is off
+_current = contextvars.ContextVar("aci_trace", default=None)
+
+
+def current_trace():
+    return _current.get()
+
+
+class Trace:
+    """
+        Phase timings of one command
+    """
+    def __init__(self, size):
+        self.started = time.perf_counter()
+        self.size = size
+        self.cmd = None
+        self.db_key = None
+        self.key = None
+        self.phases = {}
+
+    def describe(self, cmd):
+        self.cmd = cmd.get("cmd")
+        self.db_key = cmd.get("db_key")
+        self.key = cmd.get("key")
+
+    def add(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+
+class Tracer:
+    """
+        Logs commands slower than a threshold with their phase timings, and optionally samples the event loop's stack
+
+        Phases are decode, execute, auth, persist, encode and send. auth and persist are spent inside execute.
+    """
+    def __init__(self, threshold=0.1, log_path="./trace.log", sample_interval=None, stall_threshold=1.0,
+                 report_interval=10.0, max_bytes=10 * 1024 * 1024, backup_count=5):
+        self.threshold = threshold
+        self.slow_commands = 0
+
+        self.logger = logging.getLogger("aci.trace.%s" % os.path.abspath(log_path))
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+        if not self.logger.handlers:
+            os.makedirs(os.path.dirname(os.path.abspath(log_path)), exist_ok=True)
+            handler = logging.handlers.RotatingFileHandler(log_path, maxBytes=max_bytes, backupCount=backup_count)
+            handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+            self.logger.addHandler(handler)
+
+        self.sampler = None
+        self.sample_interval = sample_interval
+        self.stall_threshold = stall_threshold
+        self.report_interval = report_interval
+
+    def begin(self, size):
+        """
+        Starts tracing a command received by the current task
+
+        :param size: bytes received
+        :return: the Trace
+        """
+        trace = Trace(size)
+        _current.set(trace)
+        return trace
+
+    def end(self, trace):
+        _current.set(None)
+        total = time.perf_counter() - trace.started
+        if total >= self.threshold:
+            self.slow_commands += 1
+            self.log({"event": "slow_command", "cmd": trace.cmd, "db_key": trace.db_key, "key": trace.key,
+                      "size": trace.size, "total_ms": round(total * 1000, 3),
+                      "phases_ms": {phase: round(seconds * 1000, 3) for phase, seconds in trace.phases.items()}})
+
+    def log(self, entry):
+        self.logger.info(json.dumps(entry, default=str))
+
+    def start_sampling(self, loop):
+        """
+        Samples the stack of the thread running the loop, which must be the calling thread
+
+        :param loop:
+        :return:
+        """
+        if self.sample_interval and self.sampler is None:
+            self.sampler = StackSampler(self, loop, threading.get_ident(), self.sample_interval,
+                                        self.stall_threshold, self.report_interval)
+            self.sampler.start()
+
+    def close(self):
+        if self.sampler is not None:
+            self.sampler.stop()
+        for handler in list(self.logger.handlers):
+            handler.close()
+            self.logger.removeHandler(handler)
+
+
+class StackSampler(threading.Thread):
+    """
+        Periodically records the stack of the event loop thread, logging the most frequent stacks and any stall
+    """
+    def __init__(self, tracer, loop, thread_id, interval, stall_threshold, report_interval):
+        super().__init__(name="ACI-StackSampler", daemon=True)
+        self.tracer = tracer
+        self.loop = loop
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stall_threshold = stall_threshold
+        self.report_interval = report_interval
+
+        self.samples = collections.Counter()
+        self.idle_samples = 0
+        self.last_beat = time.monotonic()
+        self._stalled = False
+        self._stopped = threading.Event()
+
+        self.loop.call_soon_threadsafe(self._beat)
+
+    def _beat(self):
+        # Runs on the loop, so it stops advancing while a callback blocks the loop
+        self.last_beat = time.monotonic()
+        if not self._stopped.is_set():
+            self.loop.call_later(self.interval, self._beat)
+
+    def stop(self):
+        self._stopped.set()
+
+    def run(self):
+        reported = time.monotonic()
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                return
+
+            stack = _fold(frame)
+            if _is_idle(frame):
+                self.idle_samples += 1
+            else:
+                self.samples[stack] += 1
+
+            now = time.monotonic()
+            stalled_for = now - self.last_beat
+            if stalled_for > self.stall_threshold + self.interval and not self._stalled:
+                self._stalled = True
+                self.tracer.log({"event": "loop_stall", "stalled_ms": round(stalled_for * 1000, 3),
+                                 "stack": stack.split(";")})
+            elif stalled_for <= self.stall_threshold:
+                self._stalled = False
+
+            if now - reported >= self.report_interval:
+                self.report(now - reported)
+                reported = now
+
+    def report(self, seconds):
+        total = sum(self.samples.values()) + self.idle_samples
+        if total:
+            self.tracer.log({"event": "stack_samples", "seconds": round(seconds, 3), "samples": total,
+                             "idle": self.idle_samples, "top": self.samples.most_common(20)})
+        self.samples.clear()
+        self.idle_samples = 0
+
+
+def _fold(frame):
+    """
+    Collapses a stack into one line, outermost frame first
+
+    :param frame: innermost frame
+    :return: str of file:function:line entries joined by ;
+    """
+    entries = []
+    while frame is not None:
+        code = frame.f_code
+        entries.append("%s:%s:%i" % (os.path.basename(code.co_filename), code.co_name, frame.f_lineno))
+        frame = frame.f_back
+    entries.reverse()
+    return ";".join(entries)
+
+
+def _is_idle(frame):
+    # An idle loop sits in its selector waiting for IO
+    return os.path.basename(frame.f_code.co_filename) == "selectors.py"
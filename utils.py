@@ -1,18 +1,46 @@
 import asyncio
+import functools
+
+
+def _owner_loop(owner):
+    """
+    Gets the event loop the connection behind a Connection or interface runs on, if it is running
+    :param owner:
+    :return:
+    """
+    loop = getattr(getattr(owner, "conn", owner), "loop", None)
+    if isinstance(loop, asyncio.AbstractEventLoop) and loop.is_running():
+        return loop
+    return None
 
 
 def allow_sync(func):
     """
     Allows a function which returns a future to be run either synchronously or asynchronously
+
+    Coroutines of a Connection are run on the Connection's own event loop, so they can be called from any thread or
+    event loop. From a thread without a running loop the call blocks until the result is ready.
     :param func:
     :return:
     """
+    @functools.wraps(func)
     def wrapper(*args, **kwargs):
         future = func(*args, **kwargs)
+        loop = _owner_loop(args[0]) if args else None
+
         try:
-            asyncio.get_running_loop()
-            return future
+            running = asyncio.get_running_loop()
         except RuntimeError:
+            running = None
+
+        if loop is None or loop is running:
+            if running is not None:
+                return future
             return asyncio.run(future)
 
+        handoff = asyncio.run_coroutine_threadsafe(future, loop)
+        if running is not None:
+            return asyncio.wrap_future(handoff)
+        return handoff.result()
+
     return wrapper
@@ -0,0 +1,83 @@
+import json
+import os
+
+
+class WriteAheadLog:
+    """
+        Append-only log of the mutations made to a Database since its items were last written to disk
+    """
+    def __init__(self, path):
+        self.path = path
+        self.size = 0
+        self._file = None
+
+        if os.path.exists(path):
+            self.size = os.path.getsize(path)
+
+    def _open(self):
+        if self._file is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._file = open(self.path, "a")
+        return self._file
+
+    def append(self, record):
+        """
+        Appends a mutation record to the log
+
+        :param record: json serializable dict describing the mutation
+        :return:
+        """
+        self.append_lines([json.dumps(record)])
+
+    def append_lines(self, lines, fsync=False):
+        """
+        Appends already serialized records to the log in a single write
+
+        :param lines: list of json encoded records
+        :param fsync: whether to wait for the records to reach the disk
+        :return:
+        """
+        data = "\n".join(lines) + "\n"
+        file = self._open()
+        file.write(data)
+        file.flush()
+        if fsync:
+            os.fsync(file.fileno())
+        self.size += len(data)
+
+    def replay(self):
+        """
+        Reads every record in the log, in the order they were written
+
+        :return: list of records
+        """
+        records = []
+        if not os.path.exists(self.path):
+            return records
+
+        with open(self.path, "r") as file:
+            for line in file:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # A partially written final record, the write it describes never completed
+                    print("WARNING - Skipping incomplete record in " + self.path)
+                    break
+
+        return records
+
+    def truncate(self):
+        """
+        Empties the log, called once every logged mutation has been written to the item files
+
+        :return:
+        """
+        self.close()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        open(self.path, "w").close()
+        self.size = 0
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None